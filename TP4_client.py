@@ -8,17 +8,32 @@ Noms et numéros étudiants:
 
 import argparse
 import getpass
-import json
+import os
 import socket
 import sys
+from typing import Optional
 
+import glocodec
 import glosocket
 import gloutils
 
 class GenericFunction:
     def __init__(self, socket: socket.socket) -> None:
         self._socket = socket
-        pass
+        self._codec: glocodec.Codec = glocodec.JSON
+        self._compress_threshold: Optional[int] = None
+
+    def send(self, message: gloutils.GloMessage) -> None:
+        glosocket.send_mesg(self._socket, self._codec.encode(message), self._compress_threshold)
+
+    def negotiate(self, encodings: list[str], compression: list[str]) -> None:
+        # the HELLO exchange itself is neither encoded nor compressed
+        self.send(self.message(gloutils.Headers.HELLO, gloutils.HelloPayload(encodings=encodings, compression=compression)))
+        data = self.getResponse()
+        if data["header"] == gloutils.Headers.OK:
+            self._codec = glocodec.CODECS.get(data["payload"]["encodings"][0], glocodec.JSON)
+            if glosocket.COMPRESSION in data["payload"]["compression"]:
+                self._compress_threshold = glosocket.COMPRESS_THRESHOLD
 
     def message(self, header: gloutils.Headers, payload: dict) -> gloutils.GloMessage:
         return gloutils.GloMessage(header=header, payload=payload)
@@ -48,29 +63,51 @@ class GenericFunction:
         content = self.multipleInput()
         current_time = gloutils.get_current_utc_time()
         emailHeader = gloutils.EmailContentPayload(sender=username, destination=destination, subject=subject, date=current_time, content=content)
+        # several recipients are sent as a batch to get one result each
+        if "," in destination:
+            return self.message(gloutils.Headers.EMAIL_BATCH_SENDING, gloutils.EmailBatchPayload(emails=[emailHeader]))
         message = self.message(gloutils.Headers.EMAIL_SENDING, emailHeader)
         return message
     
+    def sendStream(self, payload: gloutils.EmailContentPayload) -> None:
+        # the body travels in chunks, the server only replies to the end
+        content = payload["content"]
+        self.send(self.message(gloutils.Headers.EMAIL_STREAM_BEGIN, gloutils.EmailContentPayload(payload, content="")))
+        for start in range(0, len(content), gloutils.STREAM_CHUNK_SIZE):
+            self.send(self.message(gloutils.Headers.EMAIL_STREAM_CHUNK, gloutils.EmailChunkPayload(data=content[start:start + gloutils.STREAM_CHUNK_SIZE])))
+        self.send(gloutils.GloMessage(header=gloutils.Headers.EMAIL_STREAM_END))
+
     def getResponse(self) -> gloutils.GloMessage:
         try:
-            data = glosocket.recv_mesg(self._socket)
-            data_json = json.loads(data)
+            data = glosocket.recv_frame(self._socket)
+            data_json = self._codec.decode(data)
             if data_json["header"] == gloutils.Headers.ERROR:
                 print(data_json["payload"]["error_message"])
             return data_json
-        except glosocket.GLOSocketError:
+        except (glosocket.GLOSocketError, ValueError):
             print("Error : Impossible to get server response", file=sys.stderr)
             exit(-1)
 
 class Client:
     """Client pour le serveur mail @glo2000.ca."""
 
-    def __init__(self, destination: str) -> None:
+    def __init__(self, destination: str, encoding: str = "json",
+                 compress: bool = False,
+                 session_file: Optional[str] = None) -> None:
         """
         Prépare et connecte le socket du client `_socket`.
 
         Prépare un attribut `_username` pour stocker le nom d'utilisateur
         courant. Laissé vide quand l'utilisateur n'est pas connecté.
+
+        Avec l'`encoding` "binary", négocie l'encodage binaire des messages
+        avec le serveur; JSON reste utilisé si le serveur le refuse. Avec
+        `compress`, négocie de même la compression des grands messages.
+
+        Avec `session_file`, le jeton de session reçu à la connexion est
+        conservé dans ce fichier: au prochain lancement, la session est
+        reprise avec l'entête `AUTH_RESUME`, sans redemander le mot de
+        passe.
         """
         try:
             self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -80,6 +117,40 @@ class Client:
             exit(-1)
         self._username = ""
         self._genericFunction = GenericFunction(self._socket)
+        if encoding == "binary" or compress:
+            encodings = [glocodec.JSON.name]
+            if encoding == "binary":
+                encodings.insert(0, glocodec.BINARY.name)
+            self._genericFunction.negotiate(encodings, [glosocket.COMPRESSION] if compress else [])
+        self._session_file = session_file
+        if session_file is not None and os.path.exists(session_file):
+            self._resume()
+
+    def _resume(self) -> None:
+        """
+        Transmet le jeton de session conservé avec l'entête `AUTH_RESUME`.
+
+        Si la session est reprise, l'attribut `_username` est mis à jour,
+        sinon le jeton est oublié.
+        """
+        with open(self._session_file, "r") as file:
+            username, token = file.read().split("\n")[:2]
+        message = self._genericFunction.message(gloutils.Headers.AUTH_RESUME, gloutils.SessionPayload(token=token))
+        self._genericFunction.send(message)
+        data = self._genericFunction.getResponse()
+        if data["header"] == gloutils.Headers.OK:
+            self._username = username
+            print("Session reprise : " + username)
+        else:
+            os.remove(self._session_file)
+
+    def _save_session(self, data: gloutils.GloMessage) -> None:
+        """Conserve le jeton de session de la réponse, s'il y a lieu."""
+        if self._session_file is None or "payload" not in data:
+            return
+        fd = os.open(self._session_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as file:
+            file.write(self._username + "\n" + data["payload"]["token"] + "\n")
 
     def _register(self) -> None:
         """
@@ -90,10 +161,11 @@ class Client:
         `_username` est mis à jour, sinon l'erreur est affichée.
         """
         message, username = self._genericFunction.getUserLoginInfo(gloutils.Headers.AUTH_REGISTER)
-        glosocket.send_mesg(self._socket, json.dumps(message))
+        self._genericFunction.send(message)
         data = self._genericFunction.getResponse()
         if data["header"] == gloutils.Headers.OK:
             self._username = username
+            self._save_session(data)
 
     def _login(self) -> None:
         """
@@ -104,10 +176,11 @@ class Client:
         est mis à jour, sinon l'erreur est affichée.
         """
         message, username = self._genericFunction.getUserLoginInfo(gloutils.Headers.AUTH_LOGIN)
-        glosocket.send_mesg(self._socket, json.dumps(message))
+        self._genericFunction.send(message)
         data = self._genericFunction.getResponse()
         if data["header"] == gloutils.Headers.OK:
             self._username = username
+            self._save_session(data)
 
 
     def _quit(self) -> None:
@@ -116,58 +189,102 @@ class Client:
         socket du client.
         """
         message = self._genericFunction.message(gloutils.Headers.BYE, {})
-        glosocket.send_mesg(self._socket, json.dumps(message))
+        self._genericFunction.send(message)
         self._socket.close()
     
-    def _display_email(self, nb_email: int) -> None:
-        choice = input("Entrez votre choix [1-{}] : ".format(nb_email))
+    def _display_email(self, choice: str) -> None:
+        """
+        Demande le courriel choisi avec l'entête `EMAIL_STREAM_REQUEST` et
+        l'affiche à l'aide du gabarit `EMAIL_DISPLAY` au fil de la
+        réception de ses morceaux.
+        """
         emailChoiceHeader = gloutils.EmailChoicePayload(choice=choice)
-        message = gloutils.GloMessage(header=gloutils.Headers.INBOX_READING_CHOICE, payload=emailChoiceHeader)
-        glosocket.send_mesg(self._socket, json.dumps(message))
+        message = gloutils.GloMessage(header=gloutils.Headers.EMAIL_STREAM_REQUEST, payload=emailChoiceHeader)
+        self._genericFunction.send(message)
         data = self._genericFunction.getResponse()
-        if data["header"] == gloutils.Headers.OK:
-            print(data["payload"]["email"])
+        if data["header"] != gloutils.Headers.EMAIL_STREAM_BEGIN:
+            return
+        before, after = gloutils.EMAIL_DISPLAY.split("{body}")
+        print(before.format(
+            sender=data["payload"]["sender"],
+            to=data["payload"]["destination"],
+            subject=data["payload"]["subject"],
+            date=data["payload"]["date"]), end="")
+        while True:
+            data = self._genericFunction.getResponse()
+            if data["header"] != gloutils.Headers.EMAIL_STREAM_CHUNK:
+                break
+            print(data["payload"]["data"], end="")
+        print(after)
 
 
     def _read_email(self) -> None:
         """
-        Demande au serveur la liste de ses courriels avec l'entête
-        `INBOX_READING_REQUEST`.
+        Demande au serveur la liste de ses courriels, page par page, avec
+        l'entête `INBOX_PAGE_REQUEST`.
 
-        Affiche la liste des courriels puis transmet le choix de l'utilisateur
-        avec l'entête `INBOX_READING_CHOICE`.
+        Affiche chaque page de la liste; l'utilisateur peut passer à la page
+        suivante ou précédente, ou choisir un courriel dont le numéro est
+        transmis avec l'entête `EMAIL_STREAM_REQUEST`.
 
-        Affiche le courriel à l'aide du gabarit `EMAIL_DISPLAY`.
+        Affiche le courriel au fil de la réception de ses morceaux (voir
+        `_display_email`).
 
         S'il n'y a pas de courriel à lire, l'utilisateur est averti avant de
         retourner au menu principal.
         """
-        message = gloutils.GloMessage(header=gloutils.Headers.INBOX_READING_REQUEST, payload={})
-        glosocket.send_mesg(self._socket, json.dumps(message))
-        data = self._genericFunction.getResponse()
-        if data["header"] == gloutils.Headers.OK:
-            if len(data["payload"]["email_list"]) == 0:
+        offset = 0
+        while True:
+            pageRequest = gloutils.InboxPageRequestPayload(offset=offset, limit=gloutils.INBOX_PAGE_SIZE)
+            message = gloutils.GloMessage(header=gloutils.Headers.INBOX_PAGE_REQUEST, payload=pageRequest)
+            self._genericFunction.send(message)
+            data = self._genericFunction.getResponse()
+            if data["header"] != gloutils.Headers.OK:
+                return
+            page = data["payload"]
+            if page["total"] == 0:
                 print("Vous n'avez aucun mail à lire")
-            else:
-                for i in range(len(data["payload"]["email_list"])):
-                    print(data["payload"]["email_list"][i])
-                self._display_email(len(data["payload"]["email_list"]))
-            
+                return
+            for line in page["email_list"]:
+                print(line)
+            last = page["offset"] + len(page["email_list"])
+            print("Courriels {}-{} sur {}".format(page["offset"] + 1, last, page["total"]))
+            choice = input("Entrez votre choix [{}-{}], 's' (suivante), 'p' (précédente) : ".format(page["offset"] + 1, last))
+            if choice == "s":
+                if last < page["total"]:
+                    offset = last
+                continue
+            if choice == "p":
+                offset = max(page["offset"] - gloutils.INBOX_PAGE_SIZE, 0)
+                continue
+            self._display_email(choice)
+            return
 
     def _send_email(self) -> None:
         """
         Demande à l'utilisateur respectivement:
-        - l'adresse email du destinataire,
+        - l'adresse email du destinataire, ou plusieurs adresses séparées
+        par des virgules,
         - le sujet du message,
         - le corps du message.
 
-        La saisie du corps se termine par un point seul sur une ligne.
+        La saisie du corps se termine par un point seul sur une ligne. Un
+        long corps est transmis par morceaux, avec les entêtes
+        `EMAIL_STREAM_BEGIN`, `EMAIL_STREAM_CHUNK` et `EMAIL_STREAM_END`.
 
-        Transmet ces informations avec l'entête `EMAIL_SENDING`.
+        Transmet ces informations avec l'entête `EMAIL_SENDING`, ou
+        `EMAIL_BATCH_SENDING` pour plusieurs destinataires, puis affiche le
+        résultat de l'envoi pour chacun.
         """
         message = self._genericFunction.createEmail(self._username)
-        glosocket.send_mesg(self._socket, json.dumps(message))
+        if message["header"] == gloutils.Headers.EMAIL_SENDING and len(message["payload"]["content"]) > gloutils.STREAM_CHUNK_SIZE:
+            self._genericFunction.sendStream(message["payload"])
+        else:
+            self._genericFunction.send(message)
         data = self._genericFunction.getResponse()
+        if data["header"] == gloutils.Headers.OK and "payload" in data:
+            for result in data["payload"]["results"]:
+                print(gloutils.DELIVERY_DISPLAY.format(destination=result["destination"], status=result["status"]))
 
     def _check_stats(self) -> None:
         """
@@ -176,25 +293,58 @@ class Client:
         Affiche les statistiques à l'aide du gabarit `STATS_DISPLAY`.
         """
         message = gloutils.GloMessage(header=gloutils.Headers.STATS_REQUEST, payload={})
-        glosocket.send_mesg(self._socket, json.dumps(message))
+        self._genericFunction.send(message)
         data = self._genericFunction.getResponse()
         if data["header"] == gloutils.Headers.OK:
             print(gloutils.STATS_DISPLAY.format(
                 count=data["payload"]["count"],
-                size=data["payload"]["size"])
+                size=data["payload"]["size"],
+                newest_date=data["payload"].get("newest_date", ""))
                 )
         else:
             print("Les statistiques n'ont pas pu être récupérées, veuillez réessayer plus tard")
 
+    def _search_emails(self) -> None:
+        """
+        Demande à l'utilisateur les mots à rechercher et les transmet avec
+        l'entête `SEARCH_REQUEST`.
+
+        Affiche les courriels trouvés, les plus récents d'abord; l'utilisateur
+        peut choisir un courriel dont le numéro est transmis avec l'entête
+        `EMAIL_STREAM_REQUEST`.
+
+        Affiche le courriel au fil de la réception de ses morceaux (voir
+        `_display_email`).
+        """
+        query = input("Mots à rechercher : ")
+        searchRequest = gloutils.SearchPayload(query=query, limit=gloutils.INBOX_PAGE_SIZE)
+        message = gloutils.GloMessage(header=gloutils.Headers.SEARCH_REQUEST, payload=searchRequest)
+        self._genericFunction.send(message)
+        data = self._genericFunction.getResponse()
+        if data["header"] != gloutils.Headers.OK:
+            return
+        result = data["payload"]
+        if not result["email_list"]:
+            print("Aucun courriel ne correspond à la recherche")
+            return
+        for line in result["email_list"]:
+            print(line)
+        print("{} courriels affichés sur {}".format(len(result["email_list"]), result["total"]))
+        choice = input("Entrez votre choix [1-{}] : ".format(len(result["email_list"])))
+        self._display_email(choice)
+
     def _logout(self) -> None:
         """
         Préviens le serveur avec l'entête `AUTH_LOGOUT`.
 
-        Met à jour l'attribut `_username`.
+        Met à jour l'attribut `_username` et oublie le jeton de session,
+        révoqué par le serveur.
         """
         message = gloutils.GloMessage(header=gloutils.Headers.AUTH_LOGOUT, payload={})
-        glosocket.send_mesg(self._socket, json.dumps(message))
+        self._genericFunction.send(message)
         self._username = ""
+        if self._session_file is not None and os.path.exists(self._session_file):
+            os.remove(self._session_file)
     
     def _authChoice(self) -> None:
         print(gloutils.CLIENT_AUTH_CHOICE)
@@ -211,7 +361,7 @@ class Client:
 
     def _userChoice(self) -> None:
         print(gloutils.CLIENT_USE_CHOICE)
-        choice = input("Entre votre choix [1-4]: ")
+        choice = input("Entre votre choix [1-5]: ")
         match choice:
             case "1":
                 self._read_email()
@@ -220,6 +370,8 @@ class Client:
             case "3":
                 self._check_stats()
             case "4":
+                self._search_emails()
+            case "5":
                 self._logout()
         pass
 
@@ -244,8 +396,19 @@ def _main() -> int:
     parser.add_argument("-d", "--destination", action="store",
                         dest="dest", required=True,
                         help="Adresse IP/URL du serveur.")
+    parser.add_argument("-e", "--encoding", action="store",
+                        dest="encoding", choices=("json", "binary"),
+                        default="json",
+                        help="Encodage des messages.")
+    parser.add_argument("-z", "--compress", action="store_true",
+                        dest="compress",
+                        help="Compresse les grands messages.")
+    parser.add_argument("-s", "--session", action="store",
+                        dest="session_file", default=None,
+                        help="Fichier conservant le jeton de session, pour"
+                             " la reprendre au prochain lancement.")
     args = parser.parse_args(sys.argv[1:])
-    client = Client(args.dest)
+    client = Client(args.dest, args.encoding, args.compress, args.session_file)
     client.run()
     return 0
 
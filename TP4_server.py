@@ -6,67 +6,340 @@ Noms et numéros étudiants:
 -
 """
 
-import hashlib
-import hmac
+import argparse
+import asyncio
+import base64
+import bisect
+import collections
+import concurrent.futures
+import functools
 import json
+import logging
 import os
-import select
+import signal
 import socket
 import sys
 import re
-from typing import Dict
+import selectors
+import threading
+import time
+from typing import (Callable, Deque, Dict, Iterator, List, NamedTuple,
+                    Optional, Set, Tuple, Union)
 
+import gloauth
+import glocache
+import glocodec
+import glodelivery
+import gloindex
+import glolimit
+import glolost
+import glometrics
+import glosession
 import glosocket
+import glostorage
+import glotimer
+import glousers
 import gloutils
 
+try:
+    import resource
+except ImportError:  # Windows: la limite de descripteurs n'est pas ajustable
+    resource = None
+
+_logger = logging.getLogger("TP4_server")
+
+# descriptors besides the clients: storage, indexes, metrics, wakeup
+_SPARE_DESCRIPTORS = 256
+
+
+class _Stream(NamedTuple):
+    """Transfert par morceaux d'un courriel vers un client."""
+    messages: Iterator[gloutils.GloMessage]
+    request_id: Optional[int]
+    codec: glocodec.Codec
+    threshold: Optional[int]
+    timer: glometrics.Timer
+    size: int
+
 
 class Server:
     """Serveur mail @glo2000.ca."""
 
-    def __init__(self) -> None:
+    def __init__(self, backlog: int = socket.SOMAXCONN,
+                 reuse_port: bool = False,
+                 cache_entries: int = 10000,
+                 cache_bytes: int = 64 * 1024 * 1024,
+                 storage: str = "files",
+                 delivery_depth: int = 1024,
+                 delivery_delay: float = 0.005,
+                 delivery_writers: int = 2,
+                 compress_threshold: int = glosocket.COMPRESS_THRESHOLD,
+                 auth_workers: int = 4,
+                 auth_queue: int = 256,
+                 session_ttl: int = gloutils.SESSION_TTL,
+                 write_high_water: int = 1024 * 1024,
+                 write_low_water: int = 256 * 1024,
+                 stall_timeout: float = 30.0,
+                 max_frame_size: int = glosocket.MAX_FRAME_SIZE,
+                 lost_max_age: float = 30 * 24 * 60 * 60,
+                 lost_max_bytes: int = 256 * 1024 * 1024,
+                 connection_limits: Optional[glolimit.Limits] = None,
+                 user_limits: Optional[glolimit.Limits] = None,
+                 fair_quantum: int = 8,
+                 max_connections: int = 10000,
+                 idle_timeout: float = 300.0,
+                 auth_timeout: float = 30.0) -> None:
         """
         Prépare le socket du serveur `_server_socket`
-        et le met en mode écoute.
+        et le met en mode écoute avec une file d'attente de `backlog`
+        connexions. Avec `reuse_port`, plusieurs processus peuvent écouter
+        sur le même port (SO_REUSEPORT), le noyau répartissant les clients.
 
         Prépare les attributs suivants:
-        - `_client_socs` une liste des sockets clients.
+        - `_client_socs` un dictionnaire associant chaque socket client, ou
+            son `asyncio.StreamWriter` avec le moteur asyncio, à l'instant
+            de sa connexion ou de la dernière déconnexion de son compte. Au
+            plus `max_connections` clients sont acceptés.
+        - `_timeouts` l'échéance de chaque client: sans requête pendant
+            `idle_timeout` secondes, ou sans authentification pendant
+            `auth_timeout` secondes, il est déconnecté (0: jamais).
+            `_activity` associe chaque socket client à l'instant de sa
+            dernière requête; l'échéance n'est recalculée qu'à son terme.
+        - `_selector` le sélecteur (epoll, kqueue...) des sockets du
+            moteur select; `_interest` associe chaque socket client aux
+            événements qui y sont surveillés, mis à jour pour les clients
+            de `_dirty` dont l'état a changé.
         - `_logged_users` un dictionnaire associant chaque
             socket client à un nom d'utilisateur.
+        - `_users` l'annuaire en mémoire des utilisateurs existants, dont
+            les dossiers sont répartis selon le préfixe du hachage de leur
+            nom.
+        - `_frame_readers` un dictionnaire associant chaque socket
+            client à son décodeur de messages incrémental.
+        - `_codecs` un dictionnaire associant chaque socket client à
+            l'encodage négocié de ses messages, JSON par défaut.
+        - `_compression` un dictionnaire associant chaque socket client
+            ayant négocié la compression au seuil `compress_threshold` à
+            partir duquel ses réponses sont compressées.
+        - `_store` le stockage des boîtes de réception, les nouvelles
+            boîtes étant créées dans le stockage `storage`.
+        - `_shown_emails` un dictionnaire associant chaque socket client
+            à la dernière liste de courriels qui lui a été envoyée: la
+            position du premier courriel et les noms des fichiers.
+        - `_cache` un cache LRU des courriels analysés et des listes
+            affichées, borné à `cache_entries` entrées et `cache_bytes`
+            octets.
+        - `_delivery` la file de dépôt des courriels, d'au plus
+            `delivery_depth` dépôts, vidée par `delivery_writers` fils qui
+            regroupent les dépôts reçus en `delivery_delay` secondes.
+        - `_lost` les courriels destinés à des utilisateurs inexistants,
+            rangés par destinataire et redéposés à la création de leur
+            compte. Ils expirent après `lost_max_age` secondes et le
+            dossier est borné à `lost_max_bytes` octets.
+        - `_pending` un dictionnaire associant chaque socket client à la
+            réponse qu'il attend d'un dépôt en cours, avec la mesure de sa
+            requête, et `_inbound` à ses
+            requêtes reçues entre-temps. Les fils de dépôt réveillent la
+            boucle principale par le socket `_wakeup`.
+        - `_auth` le bassin de `auth_workers` fils hachant et vérifiant
+            les mots de passe, refusant les authentifications au-delà de
+            `auth_queue` en attente.
+        - `_indexer` le fil reconstruisant les index périmés des boîtes
+            et complétant leurs index de recherche, qui demandent la
+            lecture de toute la boîte.
+        - `_tagged` un dictionnaire associant chaque socket client aux
+            réponses en attente de ses requêtes étiquetées d'un
+            `request_id`, avec leur étiquette et leur mesure.
+        - `_sessions` les jetons de session, valides `session_ttl`
+            secondes, et `_session_tokens` un dictionnaire associant chaque
+            socket client connecté au jeton de sa session.
+        - `_metrics` les compteurs et histogrammes de latence des
+            requêtes par entête, et les jauges de l'état du serveur.
+        - `_frame_writers` un dictionnaire associant chaque socket client,
+            non bloquant, au tampon de ses réponses pas encore transmises,
+            vidé lorsque le socket est prêt en écriture. `_unflushed`
+            associe chaque socket dont le tampon n'est pas vide à l'instant
+            de son dernier envoi: sans envoi pendant `stall_timeout`
+            secondes, échéance tenue par `_stalls`, le client est
+            déconnecté. Les décodeurs de `_frame_readers` partagent le
+            tampon de lecture `_scratch`.
+        - `_paused` l'ensemble des sockets clients dont le tampon a dépassé
+            `write_high_water` octets: leurs requêtes ne sont plus lues
+            avant qu'il ne redescende à `write_low_water` octets.
+        - `_uploads` un dictionnaire associant chaque socket client à
+            l'en-tête et au corps, écrit dans un fichier temporaire, du
+            courriel qu'il transfère par morceaux, et `_streams` au
+            transfert par morceaux d'un courriel qu'il a demandé, produit
+            au fil du vidage de son tampon. Aucun message ne dépasse
+            `max_frame_size` octets.
+        - `_limiter` les seaux à jetons de chaque connexion et de chaque
+            utilisateur, selon les limites par entête `connection_limits`
+            et `user_limits` (par défaut celles de glolimit). Une requête
+            hors limite est retenue, décodée, dans `_deferred` jusqu'à
+            l'échéance de son seau; le client n'est plus lu entre-temps.
+        - `_ready` les clients ayant encore des requêtes reçues après en
+            avoir traité `fair_quantum` au cours d'un tour de boucle: ils
+            les traitent aux tours suivants, à tour de rôle.
 
         S'assure que les dossiers de données du serveur existent.
         """
         self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+        if reuse_port:
+            self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, True)
         self._server_socket.bind(("127.0.0.1", gloutils.APP_PORT))
-        self._server_socket.listen(1)
-        self._client_socs : List[socket.socket] = [] 
+        self._server_socket.listen(backlog)
+        self._client_socs: Dict[socket.socket, float] = {}
         self._logged_users : Dict[socket.socket, str] = {}
-        if (os.path.exists(gloutils.SERVER_DATA_DIR) is False):
-            os.mkdir(gloutils.SERVER_DATA_DIR)
-            os.mkdir(gloutils.SERVER_DATA_DIR + "/" + gloutils.SERVER_LOST_DIR)
-        if (os.path.exists(gloutils.SERVER_DATA_DIR + "/" + gloutils.SERVER_LOST_DIR) is False):  # noqa: E501
-            os.mkdir(gloutils.SERVER_DATA_DIR + "/" + gloutils.SERVER_LOST_DIR)
-        self._mail_list = []
-        # ...
+        self._users = glousers.UserDirectory()
+        self._frame_readers: Dict[socket.socket, glosocket.FrameReader] = {}
+        self._codecs: Dict[socket.socket, glocodec.Codec] = {}
+        self._compression: Dict[socket.socket, int] = {}
+        self._compress_threshold = compress_threshold
+        self._store = glostorage.MailStore(storage)
+        self._cache = glocache.LRUCache(cache_entries, cache_bytes)
+        self._lost = glolost.LostMail(self._store, lost_max_age, lost_max_bytes)
+        self._delivery = glodelivery.DeliveryQueue(
+            self._store, self._lost, delivery_depth, delivery_delay,
+            delivery_writers)
+        self._auth = gloauth.AuthPool(auth_workers, auth_queue)
+        self._indexer = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="index")
+        self._session_tokens: Dict[socket.socket, str] = {}
+        self._pending: Dict[socket.socket, Tuple[concurrent.futures.Future, glometrics.Timer]] = {}
+        self._inbound: Dict[socket.socket, Deque[bytearray]] = {}
+        self._tagged: Dict[socket.socket, List[Tuple[concurrent.futures.Future, int, glometrics.Timer]]] = {}
+        self._wakeup, self._wakeup_writer = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self._sessions = glosession.SessionManager(
+            gloutils.SERVER_DATA_DIR + "/" + gloutils.SESSION_KEY_FILENAME,
+            gloutils.SERVER_DATA_DIR + "/" + gloutils.SESSION_REVOKED_FILENAME,
+            session_ttl)
+        self._frame_writers: Dict[socket.socket, glosocket.FrameWriter] = {}
+        self._unflushed: Dict[socket.socket, float] = {}
+        self._paused: Set[socket.socket] = set()
+        self._uploads: Dict[socket.socket, Tuple[gloutils.EmailContentPayload, Optional[glostorage.SpooledBody]]] = {}
+        self._streams: Dict[socket.socket, _Stream] = {}
+        self._max_frame_size = max_frame_size
+        self._limiter = glolimit.RateLimiter(
+            glolimit.CONNECTION_LIMITS if connection_limits is None else connection_limits,
+            glolimit.USER_LIMITS if user_limits is None else user_limits)
+        self._deferred: Dict[socket.socket, Tuple[float, dict, glometrics.Timer]] = {}
+        self._ready: Dict[socket.socket, None] = {}
+        self._fair_quantum = fair_quantum
+        self._max_connections = max_connections
+        self._idle_timeout = idle_timeout
+        self._auth_timeout = auth_timeout
+        self._timeouts = glotimer.Deadlines()
+        self._activity: Dict[socket.socket, float] = {}
+        self._stalls = glotimer.Deadlines()
+        self._selector = selectors.DefaultSelector()
+        self._interest: Dict[socket.socket, int] = {}
+        self._dirty: Set[socket.socket] = set()
+        self._scratch = bytearray(glosocket.SCRATCH_SIZE)
+        self._write_high_water = write_high_water
+        self._write_low_water = write_low_water
+        self._stall_timeout = stall_timeout
+        self._metrics = glometrics.Metrics()
+        self._metrics.gauge("glo_connected_clients", "Clients connectés.", lambda: len(self._client_socs))
+        self._metrics.gauge("glo_users", "Utilisateurs existants.", lambda: len(self._users))
+        self._metrics.gauge("glo_logged_users", "Clients authentifiés.", lambda: len(self._logged_users))
+        self._metrics.gauge("glo_deferred_replies", "Réponses attendant un dépôt ou une authentification.", lambda: len(self._pending) + sum(map(len, list(self._tagged.values()))))
+        self._metrics.gauge("glo_delivery_queue_depth", "Dépôts en attente d'écriture.", lambda: self._delivery.stats()["queued"])
+        self._metrics.gauge("glo_auth_pending", "Authentifications en attente ou en cours.", lambda: self._auth.stats()["pending"])
+        self._metrics.gauge("glo_outbound_bytes", "Octets des réponses en attente d'envoi.", lambda: sum(map(len, list(self._frame_writers.values()))))
+        self._metrics.gauge("glo_paused_clients", "Clients dont les requêtes ne sont plus lues.", lambda: len(self._paused))
+        self._metrics.gauge("glo_lost_bytes", "Octets des courriels perdus en attente de leur destinataire.", lambda: self._lost.stats()["pending_bytes"])
+        self._metrics.gauge("glo_throttled_clients", "Clients dont une requête hors limite est retenue.", lambda: len(self._deferred))
+        self._metrics.gauge("glo_cache_bytes", "Octets occupés par le cache.", lambda: self._cache.stats()["bytes"])
+        self._metrics.gauge("glo_cache_hits", "Lectures servies par le cache.", lambda: self._cache.stats()["hits"])
+        self._metrics.gauge("glo_cache_misses", "Lectures absentes du cache.", lambda: self._cache.stats()["misses"])
+        self._metrics.gauge("glo_cache_evictions", "Entrées évincées du cache.", lambda: self._cache.stats()["evictions"])
+        self._shown_emails: Dict[socket.socket, Tuple[int, List[str]]] = {}
 
     def cleanup(self) -> None:
-        """Ferme toutes les connexions résiduelles."""
+        """
+        Termine les redépôts et les dépôts en attente et ferme toutes les
+        connexions résiduelles.
+        """
+        self._lost.close()
+        self._delivery.close()
+        self._auth.close()
+        self._indexer.shutdown(wait=True)
         for client_soc in self._client_socs:
             client_soc.close()
         self._server_socket.close()
+        self._wakeup.close()
+        self._wakeup_writer.close()
+        self._selector.close()
+        _logger.info("Cache : %s", self._cache.stats())
+        _logger.info("Dépôts : %s", self._delivery.stats())
+        _logger.info("Courriels perdus : %s", self._lost.stats())
+        _logger.info("Authentifications : %s", self._auth.stats())
+        _logger.info("Limites : %s", self._limiter.stats())
 
     def _accept_client(self) -> None:
-        """Accepte un nouveau client."""
+        """
+        Accepte un nouveau client, ou le refuse avec un message d'erreur si
+        `max_connections` clients sont déjà connectés.
+        """
         client_soc, _ = self._server_socket.accept()
-        self._client_socs.append(client_soc)
-        print("Un nouveau client est connecté")
+        client_soc.setblocking(False)
+        if len(self._client_socs) >= self._max_connections:
+            writer = glosocket.FrameWriter()
+            writer.write(glocodec.JSON.encode(self._server_full()))
+            try:
+                writer.flush(client_soc)
+            except glosocket.GLOSocketError:
+                pass
+            client_soc.close()
+            _logger.warning("Connexion refusée, %d clients connectés", len(self._client_socs))
+            return
+        now = time.monotonic()
+        self._client_socs[client_soc] = now
+        self._activity[client_soc] = now
+        self._schedule_timeout(client_soc)
+        self._frame_readers[client_soc] = glosocket.FrameReader(self._max_frame_size, self._scratch)
+        self._frame_writers[client_soc] = glosocket.FrameWriter()
+        self._selector.register(client_soc, selectors.EVENT_READ)
+        self._interest[client_soc] = selectors.EVENT_READ
+        _logger.debug("Un nouveau client est connecté")
+
+    def _server_full(self) -> gloutils.GloMessage:
+        """Réponse à une connexion refusée, le serveur étant plein."""
+        message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="Le serveur a atteint son nombre maximal de connexions."))
+        return message
 
     def _remove_client(self, client_soc: socket.socket) -> None:
         """Retire le client des structures de données et ferme sa connexion."""
-        if client_soc in self._client_socs:
-            self._client_socs.remove(client_soc)
+        self._client_socs.pop(client_soc, None)
+        self._activity.pop(client_soc, None)
+        self._timeouts.discard(client_soc)
+        self._stalls.discard(client_soc)
+        if self._interest.pop(client_soc, 0):
+            self._selector.unregister(client_soc)
+        self._dirty.discard(client_soc)
         if client_soc in self._logged_users:
             self._logged_users.pop(client_soc)
+        self._shown_emails.pop(client_soc, None)
+        self._session_tokens.pop(client_soc, None)
+        self._frame_readers.pop(client_soc, None)
+        self._codecs.pop(client_soc, None)
+        self._compression.pop(client_soc, None)
+        self._pending.pop(client_soc, None)
+        self._tagged.pop(client_soc, None)
+        self._inbound.pop(client_soc, None)
+        self._frame_writers.pop(client_soc, None)
+        self._unflushed.pop(client_soc, None)
+        self._paused.discard(client_soc)
+        self._deferred.pop(client_soc, None)
+        self._ready.pop(client_soc, None)
+        self._limiter.forget(client_soc)
+        self._discard_upload(client_soc)
+        stream = self._streams.pop(client_soc, None)
+        if stream is not None:
+            stream.messages.close()
         client_soc.close()
 
 
@@ -79,20 +352,26 @@ class Server:
 
     def _create_account(self, client_soc: socket.socket,
                         payload: gloutils.AuthPayload
-                        ) -> gloutils.GloMessage:
+                        ) -> Union[gloutils.GloMessage, concurrent.futures.Future]:
         """
         Crée un compte à partir des données du payload.
 
-        Si les identifiants sont valides, créee le dossier de l'utilisateur,
-        associe le socket au nouvel l'utilisateur et retourne un succès,
-        sinon retourne un message d'erreur.
+        Si les identifiants sont valides, le mot de passe est haché dans le
+        bassin d'authentification; de retour dans la boucle du serveur,
+        crée le dossier de l'utilisateur, associe le socket au nouvel
+        utilisateur et retourne un succès portant un jeton de session. Les
+        courriels perdus qui lui étaient destinés sont déposés dans sa
+        boîte en arrière-plan. Sinon retourne un message d'erreur.
         """
+        if not _valid_credentials(payload):
+            message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="La création a échouée:\n- Le nom d'utilisateur ou le mot de passe est invalide."))
+            return message
         error_message = []
         # check username is alphanumeric _ . -
         if not self._is_alphanumeric(payload["username"]):
             error_message.append("- Le nom d'utilisateur est invalide.")
         # check username already exist
-        if os.path.exists(gloutils.SERVER_DATA_DIR + "/" + payload["username"]):
+        if self._users.exists(payload["username"]):
             error_message.append("- Le nom d'utilisateur est déjà utilisé")
         # check password length
         if not self._password_valid(payload["password"]):
@@ -101,88 +380,302 @@ class Server:
             error_message.insert(0, "La création a échouée:")
             message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="\n".join(error_message)))
             return message
-        # create folder
-        os.mkdir(gloutils.SERVER_DATA_DIR + "/" + payload["username"])
-        # hash password sha3_512 in filte PASSWORD_FILENAME
-        password_hash = hashlib.sha3_512(payload["password"].encode()).hexdigest()
-        # create file PASSWORD_FILENAME in folder
-        with open(gloutils.SERVER_DATA_DIR + "/" + payload["username"] + "/" + gloutils.PASSWORD_FILENAME, "w") as file:
-            file.write(password_hash)
-        # create folder INBOX to store email
-        os.mkdir(gloutils.SERVER_DATA_DIR + "/" + payload["username"] + "/INBOX")
-        # OK message
-        message = gloutils.GloMessage(header=gloutils.Headers.OK)
-        self._logged_users[client_soc] = payload["username"]
-        return message
+        # hash password with a salted KDF, off the event loop
+        hashed = self._auth.submit(gloauth.hash_password, payload["password"])
+        if hashed is None:
+            return self._auth_busy()
+
+        def resume(hashed: concurrent.futures.Future) -> gloutils.GloMessage:
+            # create folder, another worker may have created it meanwhile
+            user_dir = glousers.user_dir(payload["username"])
+            os.makedirs(os.path.dirname(user_dir), exist_ok=True)
+            try:
+                os.mkdir(user_dir)
+            except FileExistsError:
+                return gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="La création a échouée:\n- Le nom d'utilisateur est déjà utilisé"))
+            # create file PASSWORD_FILENAME in folder
+            with open(user_dir + "/" + gloutils.PASSWORD_FILENAME, "w") as file:
+                file.write(hashed.result())
+            # create the mailbox to store email
+            self._store.create_mailbox(payload["username"])
+            self._users.add(payload["username"])
+            self._lost.release(payload["username"])
+            return self._log_in(client_soc, payload["username"])
+
+        return _on_loop(hashed, resume)
 
     def _login(self, client_soc: socket.socket, payload: gloutils.AuthPayload
-               ) -> gloutils.GloMessage:
+               ) -> Union[gloutils.GloMessage, concurrent.futures.Future]:
         """
         Vérifie que les données fournies correspondent à un compte existant.
 
-        Si les identifiants sont valides, associe le socket à l'utilisateur et
-        retourne un succès, sinon retourne un message d'erreur.
+        Le mot de passe est vérifié dans le bassin d'authentification; de
+        retour dans la boucle du serveur, si les identifiants sont valides,
+        associe le socket à l'utilisateur et retourne un succès portant un
+        jeton de session, sinon retourne un message d'erreur.
         """
+        invalid = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="Nom d'utilisateur ou mot de passe invalide."))
         # check if username exist
-        if not os.path.exists(gloutils.SERVER_DATA_DIR + "/" + payload["username"]):
-            message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="Nom d'utilisateur ou mot de passe invalide."))
-            return message
-        # check password from username
-        with open(gloutils.SERVER_DATA_DIR + "/" + payload["username"] + "/" + gloutils.PASSWORD_FILENAME, "r") as file:
-            password_hash = file.read()
-        if password_hash != hashlib.sha3_512(payload["password"].encode()).hexdigest():
-            message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="Nom d'utilisateur ou mot de passe invalide."))
+        if not _valid_credentials(payload) or not self._is_alphanumeric(payload["username"]) or not self._users.exists(payload["username"]):
+            return invalid
+        # check password from username, off the event loop
+        checked = self._auth.submit(gloauth.check_password, glousers.user_dir(payload["username"]) + "/" + gloutils.PASSWORD_FILENAME, payload["password"])
+        if checked is None:
+            return self._auth_busy()
+
+        def resume(checked: concurrent.futures.Future) -> gloutils.GloMessage:
+            try:
+                valid = checked.result()
+            except (OSError, ValueError):
+                # unreadable or corrupt password file
+                valid = False
+            if not valid:
+                return invalid
+            return self._log_in(client_soc, payload["username"])
+
+        return _on_loop(checked, resume)
+
+    def _log_in(self, client_soc: socket.socket, username: str,
+                token: Optional[str] = None) -> gloutils.GloMessage:
+        """
+        Associe le socket à l'utilisateur, s'il est toujours connecté, et
+        retourne un succès portant le jeton de sa session: `token` si la
+        session est reprise, un nouveau jeton sinon.
+        """
+        if isinstance(client_soc, asyncio.StreamWriter):
+            connected = not client_soc.is_closing()
+        else:
+            connected = client_soc in self._client_socs
+        if token is None:
+            token = self._sessions.issue(username)
+        if connected:
+            self._logged_users[client_soc] = username
+            self._session_tokens[client_soc] = token
+        message = gloutils.GloMessage(header=gloutils.Headers.OK, payload=gloutils.SessionPayload(token=token))
+        return message
+
+    def _resume(self, client_soc: socket.socket,
+                payload: gloutils.SessionPayload) -> gloutils.GloMessage:
+        """
+        Reprend la session du jeton fourni, sans vérifier de mot de passe.
+
+        Si le jeton est authentique, non expiré, non révoqué et que son
+        utilisateur existe toujours, associe le socket à l'utilisateur et
+        retourne un succès, sinon retourne un message d'erreur.
+        """
+        username = self._sessions.verify(payload["token"])
+        if username is None or not self._users.exists(username):
+            message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="Session invalide ou expirée."))
             return message
-        # OK message
-        message = gloutils.GloMessage(header=gloutils.Headers.OK)
-        self._logged_users[client_soc] = payload["username"]
+        return self._log_in(client_soc, username, payload["token"])
+
+    def _auth_busy(self) -> gloutils.GloMessage:
+        """Réponse à une authentification refusée, le bassin étant plein."""
+        message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="Le serveur est occupé, veuillez réessayer."))
+        return message
+
+    def _not_logged_in(self) -> gloutils.GloMessage:
+        """Réponse à une requête exigeant un client authentifié."""
+        message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="Le client n'est pas authentifié."))
         return message
 
     def _logout(self, client_soc: socket.socket) -> None:
-        """Déconnecte un utilisateur."""
+        """Déconnecte un utilisateur et révoque le jeton de sa session."""
         if client_soc in self._logged_users:
             self._logged_users.pop(client_soc)
-            print("Le client a été déconnecté")
+            self._shown_emails.pop(client_soc, None)
+            self._sessions.revoke(self._session_tokens.pop(client_soc))
+            if client_soc in self._client_socs:
+                # unauthenticated again, from now on
+                self._client_socs[client_soc] = time.monotonic()
+                if client_soc in self._activity:
+                    self._schedule_timeout(client_soc)
+            _logger.debug("Le client a été déconnecté")
         else:
-            print("Le client n'est pas connecté")
+            _logger.debug("Le client n'est pas connecté")
     
-    def _convert_email_list(self, email_list: list[Dict]) -> list[str]:
+    def _convert_email_list(self, email_list: List[gloindex.IndexRecord],
+                            offset: int = 0) -> list[str]:
         """
-        Convertir une liste de courriels en une liste de SUBJECT_DISPLAY.
+        Convertir une liste de courriels en une liste de SUBJECT_DISPLAY,
+        numérotée à partir de `offset` + 1.
         """
         ret = []
         for i in range (len(email_list)):
             ret.append(gloutils.SUBJECT_DISPLAY.format(
-                number=i + 1,
-                sender=email_list[i]["sender"],
-                subject=email_list[i]["subject"],
-                date=email_list[i]["date"]
+                number=offset + i + 1,
+                sender=email_list[i].sender,
+                subject=email_list[i].subject,
+                date=email_list[i].date
             ))
         return ret
 
     def _get_email_list(self, client_soc: socket.socket
-                        ) -> gloutils.GloMessage:
+                        ) -> Union[gloutils.GloMessage, concurrent.futures.Future]:
         """
         Récupère la liste des courriels de l'utilisateur associé au socket.
         Les éléments de la liste sont construits à l'aide du gabarit
         SUBJECT_DISPLAY et sont ordonnés du plus récent au plus ancien.
 
+        Seul l'index de la boîte est lu, il est reconstruit s'il est absent
+        ou périmé (voir `_indexed`).
+
         Une absence de courriel n'est pas une erreur, mais une liste vide.
         """
-        # get list of email in folder INBOX
-        email_list = os.listdir(gloutils.SERVER_DATA_DIR + "/" + self._logged_users[client_soc] + "/INBOX")
-        # sort email_list by date
-        email_list.sort(key=lambda x: os.path.getmtime(gloutils.SERVER_DATA_DIR + "/" + self._logged_users[client_soc] + "/INBOX/" + x), reverse=True)
-        # read each email and get content of file
-        email_list_content = []
-        for email in email_list:
-            with open(gloutils.SERVER_DATA_DIR + "/" + self._logged_users[client_soc] + "/INBOX/" + email, "r") as file:
-                email_list_content.append(self._parse_email(file))
-        display_list = self._convert_email_list(email_list_content)
-        self._mail_list = email_list
-        # OK message
-        message = gloutils.GloMessage(header=gloutils.Headers.OK, payload=gloutils.EmailListPayload(email_list=display_list))
-        return message
+        username = self._logged_users[client_soc]
+        index = self._store.mailbox(username)
+
+        def reply() -> gloutils.GloMessage:
+            index.refresh()
+            # the key changes whenever the index does, even from another worker
+            key = ("list", username, index.version)
+            cached = self._cache.get(key)
+            if cached is None:
+                # newest first, from the inbox index
+                records = index.records[::-1]
+                display_list = self._convert_email_list(records)
+                names = [record.name for record in records]
+                self._cache.put(key, (display_list, names),
+                                sum(map(len, display_list)) + sum(map(len, names)))
+            else:
+                display_list, names = cached
+            self._shown_emails[client_soc] = (0, names)
+            # OK message
+            message = gloutils.GloMessage(header=gloutils.Headers.OK, payload=gloutils.EmailListPayload(email_list=display_list))
+            return message
+
+        return self._indexed(username, reply)
+
+    def _indexed(self, username: str, reply: Callable[[], gloutils.GloMessage],
+                 search: bool = False
+                 ) -> Union[gloutils.GloMessage, concurrent.futures.Future]:
+        """
+        Retourne `reply()`, appelée une fois l'index de la boîte de
+        l'utilisateur à jour et, avec `search`, son index de recherche.
+
+        Reconstruire un index absent ou périmé lit toute la boîte sous son
+        verrou exclusif, tout comme compléter l'index de recherche d'une
+        boîte jamais indexée: ce travail a lieu dans `_indexer`, hors de la
+        boucle du serveur, et la réponse est différée jusqu'à sa fin.
+        """
+        index = self._store.mailbox(username)
+        if search and (index.stale or self._store.search_outdated(username)):
+            update = functools.partial(self._store.catch_up_search, username)
+        elif index.stale:
+            update = index.rebuild
+        else:
+            return reply()
+
+        def resume(updated: concurrent.futures.Future) -> gloutils.GloMessage:
+            updated.result()
+            return reply()
+
+        return _on_loop(self._indexer.submit(update), resume)
+
+    def _encode_cursor(self, record: gloindex.IndexRecord) -> str:
+        """Curseur opaque désignant la position d'un courriel dans l'index."""
+        key = json.dumps([record.order, record.name]).encode("utf-8")
+        return base64.urlsafe_b64encode(key).decode("ascii")
+
+    def _decode_cursor(self, cursor: str) -> Optional[Tuple[int, str]]:
+        """Position désignée par un curseur, ou None s'il est invalide."""
+        try:
+            order, name = json.loads(base64.urlsafe_b64decode(cursor))
+            return int(order), str(name)
+        except (ValueError, TypeError):
+            return None
+
+    def _get_email_page(self, client_soc: socket.socket,
+                        payload: gloutils.InboxPageRequestPayload
+                        ) -> Union[gloutils.GloMessage, concurrent.futures.Future]:
+        """
+        Récupère une page de la liste des courriels de l'utilisateur associé
+        au socket, du plus récent au plus ancien.
+
+        La page commence à la position `offset` ou, avec `cursor`, juste
+        après le dernier courriel de la page précédente: l'arrivée de
+        nouveaux courriels ne décale alors pas les pages suivantes. Seuls
+        les courriels de la page sont mis en forme.
+        """
+        if client_soc not in self._logged_users:
+            return self._not_logged_in()
+        if not isinstance(payload, dict):
+            message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="La page demandée n'est pas valide"))
+            return message
+        username = self._logged_users[client_soc]
+        index = self._store.mailbox(username)
+
+        def reply() -> gloutils.GloMessage:
+            records = index.refresh()
+            total = len(records)
+            try:
+                limit = int(payload.get("limit", gloutils.INBOX_PAGE_SIZE))
+                offset = int(payload.get("offset", 0))
+            except (TypeError, ValueError):
+                limit, offset = 0, -1
+            limit = min(limit, gloutils.INBOX_MAX_PAGE_SIZE)
+            # index of the record right after the page, records being oldest first
+            end = total - offset
+            if payload.get("cursor"):
+                position = self._decode_cursor(str(payload["cursor"]))
+                if position is None:
+                    offset = -1
+                else:
+                    end = bisect.bisect_left(records, position)
+                    offset = total - end
+            if limit < 1 or offset < 0:
+                message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="La page demandée n'est pas valide"))
+                return message
+            start = max(end - limit, 0)
+            page = records[start:max(end, 0)][::-1]
+            self._shown_emails[client_soc] = (offset, [record.name for record in page])
+            next_cursor = self._encode_cursor(page[-1]) if page and start > 0 else ""
+            # OK message
+            message = gloutils.GloMessage(header=gloutils.Headers.OK, payload=gloutils.InboxPagePayload(
+                email_list=self._convert_email_list(page, offset),
+                offset=offset,
+                total=total,
+                next_cursor=next_cursor))
+            return message
+
+        return self._indexed(username, reply)
+
+    def _search(self, client_soc: socket.socket,
+                payload: gloutils.SearchPayload
+                ) -> Union[gloutils.GloMessage, concurrent.futures.Future]:
+        """
+        Recherche les courriels de l'utilisateur associé au socket contenant
+        tous les mots de la requête, et retourne les plus récents d'abord.
+
+        Seul l'index de recherche de la boîte est lu, aucun courriel. Les
+        résultats peuvent ensuite être consultés avec INBOX_READING_CHOICE
+        ou EMAIL_STREAM_REQUEST.
+        """
+        if client_soc not in self._logged_users:
+            return self._not_logged_in()
+        username = self._logged_users[client_soc]
+        try:
+            query = str(payload.get("query", ""))
+            limit = int(payload.get("limit", gloutils.INBOX_PAGE_SIZE))
+        except (AttributeError, TypeError, ValueError):
+            limit = 0
+        if limit < 1:
+            message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="La recherche n'est pas valide"))
+            return message
+        limit = min(limit, gloutils.INBOX_MAX_PAGE_SIZE)
+        index = self._store.mailbox(username)
+
+        def reply() -> gloutils.GloMessage:
+            names = self._store.search(username, query)
+            # emails dropped from the inbox index since they were indexed are skipped
+            records = sorted(filter(None, map(index.get, names)), reverse=True)
+            page = records[:limit]
+            self._shown_emails[client_soc] = (0, [record.name for record in page])
+            # OK message
+            message = gloutils.GloMessage(header=gloutils.Headers.OK, payload=gloutils.SearchResultPayload(email_list=self._convert_email_list(page), total=len(records)))
+            return message
+
+        return self._indexed(username, reply, search=True)
 
     def _get_email(self, client_soc: socket.socket,
                    payload: gloutils.EmailChoicePayload
@@ -191,13 +684,12 @@ class Server:
         Récupère le contenu de l'email dans le dossier de l'utilisateur associé
         au socket.
         """
-        # check if choice is valid
-        if int(payload["choice"]) < 1 or int(payload["choice"]) > len(self._mail_list):
+        name = self._chosen_email(client_soc, payload)
+        if name is None:
             message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="Le choix n'est pas valide"))
             return message
         # read email
-        with open(gloutils.SERVER_DATA_DIR + "/" + self._logged_users[client_soc] + "/INBOX/" + self._mail_list[int(payload["choice"]) - 1], "r") as file:
-            mail_parse = self._parse_email(file)
+        mail_parse = self._read_email(self._logged_users[client_soc], name)
         mail = gloutils.EMAIL_DISPLAY.format(
             sender=mail_parse["sender"],
             to=mail_parse["destination"],
@@ -209,52 +701,254 @@ class Server:
         message = gloutils.GloMessage(header=gloutils.Headers.OK, payload=gloutils.EmailContentPayload(email=mail))
         return message
 
-    def _get_stats(self, client_soc: socket.socket) -> gloutils.GloMessage:
+    def _chosen_email(self, client_soc: socket.socket,
+                      payload: gloutils.EmailChoicePayload) -> Optional[str]:
+        """
+        Nom du courriel choisi dans la dernière liste envoyée au client, ou
+        None si le choix n'est pas valide.
+        """
+        offset, names = self._shown_emails.get(client_soc, (0, []))
+        try:
+            position = int(payload["choice"]) - 1 - offset
+        except ValueError:
+            position = -1
+        if position < 0 or position >= len(names):
+            return None
+        return names[position]
+
+    def _stream_email(self, client_soc: socket.socket,
+                      payload: gloutils.EmailChoicePayload
+                      ) -> Union[gloutils.GloMessage, Iterator[gloutils.GloMessage]]:
+        """
+        Transfère par morceaux le courriel choisi de l'utilisateur associé
+        au socket: EMAIL_STREAM_BEGIN et son en-tête, un EMAIL_STREAM_CHUNK
+        par morceau du corps puis EMAIL_STREAM_END.
+
+        Les morceaux sont lus au fil de l'envoi, sans passer par le cache:
+        la mémoire utilisée ne dépend pas de la taille du courriel.
+        """
+        name = self._chosen_email(client_soc, payload)
+        if name is None:
+            message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="Le choix n'est pas valide"))
+            return message
+        try:
+            header, chunks = self._store.stream(self._logged_users[client_soc], name)
+        except OSError as error:
+            _logger.error("Failed to read email: %s", error)
+            message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="Le courriel n'a pas pu être lu"))
+            return message
+
+        def messages() -> Iterator[gloutils.GloMessage]:
+            try:
+                yield gloutils.GloMessage(header=gloutils.Headers.EMAIL_STREAM_BEGIN, payload=header)
+                for chunk in chunks:
+                    yield gloutils.GloMessage(header=gloutils.Headers.EMAIL_STREAM_CHUNK, payload=gloutils.EmailChunkPayload(data=chunk))
+            except OSError as error:
+                _logger.error("Failed to read email: %s", error)
+                yield gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="Le courriel n'a pas pu être lu"))
+                return
+            finally:
+                chunks.close()
+            yield gloutils.GloMessage(header=gloutils.Headers.EMAIL_STREAM_END)
+
+        return messages()
+
+    def _begin_upload(self, client_soc: socket.socket,
+                      payload: gloutils.EmailContentPayload) -> None:
+        """
+        Commence la réception par morceaux d'un courriel, dont le corps est
+        écrit au fur et à mesure dans un fichier temporaire. Un transfert
+        inachevé du même client est abandonné. Aucune réponse n'est
+        transmise avant EMAIL_STREAM_END.
+        """
+        self._discard_upload(client_soc)
+        try:
+            body = glostorage.SpooledBody()
+        except OSError as error:
+            _logger.error("Failed to spool email: %s", error)
+            body = None
+        self._uploads[client_soc] = (payload, body)
+
+    def _upload_chunk(self, client_soc: socket.socket,
+                      payload: gloutils.EmailChunkPayload) -> None:
+        """
+        Ajoute un morceau au corps du courriel en cours de réception. Un
+        morceau dont `data` n'est pas une chaîne abandonne le corps; la
+        réponse ERROR suit alors EMAIL_STREAM_END.
+        """
+        payload_header, body = self._uploads.get(client_soc, (None, None))
+        if body is None:
+            return
+        if not isinstance(payload, dict) or not isinstance(payload.get("data"), str):
+            body.discard()
+            self._uploads[client_soc] = (None, None)
+            return
+        try:
+            body.write(payload["data"])
+        except OSError as error:
+            _logger.error("Failed to spool email: %s", error)
+            body.discard()
+            self._uploads[client_soc] = (payload_header, None)
+
+    def _end_upload(self, client_soc: socket.socket
+                    ) -> Union[gloutils.GloMessage, concurrent.futures.Future]:
+        """
+        Termine la réception par morceaux d'un courriel et l'envoie à ses
+        destinataires, séparés par des virgules, comme un lot d'un seul
+        courriel (voir `_send_batch`). Le fichier temporaire est supprimé
+        une fois les dépôts terminés.
+        """
+        if client_soc not in self._uploads:
+            message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="Aucun courriel n'est en cours d'envoi"))
+            return message
+        payload, body = self._uploads.pop(client_soc)
+        if not isinstance(payload, dict):
+            if body is not None:
+                body.discard()
+            return self._invalid_email()
+        if body is None:
+            message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="Le courriel n'a pas pu être enregistré"))
+            return message
+        body.close()
+        payload = gloutils.EmailContentPayload(payload, content=body)
+        message = self._send_batch(gloutils.EmailBatchPayload(emails=[payload]))
+        if isinstance(message, concurrent.futures.Future):
+            message.add_done_callback(lambda _: body.discard())
+        else:
+            body.discard()
+        return message
+
+    def _discard_upload(self, client_soc: socket.socket) -> None:
+        """Abandonne le courriel que le client transférait par morceaux."""
+        _, body = self._uploads.pop(client_soc, (None, None))
+        if body is not None:
+            body.discard()
+
+    def check_indexes(self) -> None:
+        """
+        Reconstruit l'annuaire des utilisateurs, puis vérifie l'index de
+        chaque utilisateur contre le contenu de sa boîte et reconstruit
+        ceux qui sont incohérents.
+        """
+        self._users.rebuild()
+        for username in self._store.users():
+            if not self._store.mailbox(username).check():
+                _logger.warning("Index reconstruit : %s", username)
+
+    def start_compactor(self, interval: float) -> threading.Thread:
+        """
+        Lance un fil d'exécution compactant les boîtes de tous les
+        utilisateurs toutes les `interval` secondes.
+        """
+        def compact_forever() -> None:
+            while True:
+                time.sleep(interval)
+                for username in self._store.users():
+                    try:
+                        if self._store.compact(username):
+                            _logger.info("Boîte compactée : %s", username)
+                    except OSError as error:
+                        _logger.error("Compactage impossible : %s : %s", username, error)
+
+        thread = threading.Thread(target=compact_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def start_lost_sweeper(self, interval: float) -> threading.Thread:
+        """
+        Lance le fil redéposant les courriels perdus des nouveaux
+        utilisateurs et balayant leur dossier toutes les `interval`
+        secondes.
+        """
+        return self._lost.start(self._delivery.submit, interval)
+
+    def start_metrics(self, port: int) -> None:
+        """
+        Expose les métriques au format texte de Prometheus à l'adresse
+        http://127.0.0.1:`port`/metrics.
+        """
+        glometrics.serve(self._metrics, port)
+        _logger.info("Métriques : http://127.0.0.1:%d/metrics", port)
+
+    def _read_email(self, username: str, name: str
+                    ) -> gloutils.EmailContentPayload:
+        """
+        Retourne le courriel `name` de l'utilisateur, analysé, en passant
+        par le cache. Un courriel livré n'est jamais modifié, l'entrée reste
+        donc valide jusqu'à son éviction.
+        """
+        key = ("email", username, name)
+        email = self._cache.get(key)
+        if email is None:
+            email = self._store.read(username, name)
+            self._cache.put(key, email, sum(map(len, email.values())))
+        return email
+
+    def _get_stats(self, client_soc: socket.socket
+                   ) -> Union[gloutils.GloMessage, concurrent.futures.Future]:
         """
         Récupère le nombre de courriels et la taille du dossier et des fichiers
         de l'utilisateur associé au socket.
+
+        Les compteurs sont tenus à jour par l'index de la boîte, aucun
+        fichier de courriel n'est consulté.
         """
-        # get number of email
-        email_list = os.listdir(gloutils.SERVER_DATA_DIR + "/" + self._logged_users[client_soc] + "/INBOX")
-        nb_email = len(email_list)
-        # get size of folder
-        size = 0
-        for email in email_list:
-            size += os.path.getsize(gloutils.SERVER_DATA_DIR + "/" + self._logged_users[client_soc] + "/INBOX/" + email)
-        # OK message
-        message = gloutils.GloMessage(header=gloutils.Headers.OK, payload=gloutils.StatsPayload(count=nb_email, size=size))
+        username = self._logged_users[client_soc]
+        index = self._store.mailbox(username)
 
-        return message
-    
-    def _write_message(self, file, payload: gloutils.EmailContentPayload) -> None:
-        file.write("FROM: " + payload["sender"] + "\n")
-        file.write("TO: " + payload["destination"] + "\n")
-        file.write("SUBJECT: " + payload["subject"] + "\n")
-        file.write("DATE: " + payload["date"] + "\n")
-        file.write("\n")
-        file.write(payload["content"])
-    
-    def _parse_email(self, file) -> gloutils.EmailContentPayload:
-        payload = gloutils.EmailContentPayload()
-        payload["sender"] = file.readline()[6:-1]
-        payload["destination"] = file.readline()[4:-1]
-        payload["subject"] = file.readline()[9:-1]
-        payload["date"] = file.readline()[6:-1]
-        file.readline()
-        payload["content"] = file.read()
-        return payload
+        def reply() -> gloutils.GloMessage:
+            records = index.refresh()
+            newest_date = records[-1].date if records else ""
+            # OK message
+            message = gloutils.GloMessage(header=gloutils.Headers.OK, payload=gloutils.StatsPayload(count=len(records), size=index.total_size, newest_date=newest_date))
+            return message
+
+        return self._indexed(username, reply)
 
     def _parse_email_address(self, email_address: str) -> tuple[str, bool]:
         # parse mail address @
         if "@" not in email_address:
             return ("", False)
-        # get username and domain
-        username, domain = email_address.split("@")
+        # get username and domain, the last "@" separating them
+        username, _, domain = email_address.rpartition("@")
         # compare domain with glo2000.ca
         if domain != gloutils.SERVER_DOMAIN:
             return (username, True)
         return (username, False)
 
+    def _route(self, destination: str) -> Tuple[str, str]:
+        """
+        Retourne le nom d'utilisateur du destinataire et le sort de l'envoi
+        qui lui est destiné: DELIVERY_DELIVERED pour un utilisateur
+        existant, DELIVERY_EXTERNAL pour un autre domaine, DELIVERY_LOST
+        sinon.
+        """
+        username, is_external = self._parse_email_address(destination)
+        if is_external:
+            return username, gloutils.DELIVERY_EXTERNAL
+        if username == "" or not self._users.exists(username):
+            return username, gloutils.DELIVERY_LOST
+        return username, gloutils.DELIVERY_DELIVERED
+
+    def _after_delivery(self, delivered: concurrent.futures.Future,
+                        message: gloutils.GloMessage
+                        ) -> concurrent.futures.Future:
+        """
+        Retourne la réponse `message`, disponible une fois les dépôts de
+        `delivered` durables, ou un message d'erreur si l'un d'eux a échoué.
+        """
+        reply: concurrent.futures.Future = concurrent.futures.Future()
+
+        def done(future: concurrent.futures.Future) -> None:
+            if future.exception() is None:
+                reply.set_result(message)
+            else:
+                _logger.error("Failed to deliver email: %s", future.exception())
+                reply.set_result(gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="Le courriel n'a pas pu être enregistré")))
+
+        delivered.add_done_callback(done)
+        return reply
+
     def _send_email(self, payload: gloutils.EmailContentPayload
                     ) -> gloutils.GloMessage:
         """
@@ -262,36 +956,121 @@ class Server:
         - Si l'envoi est interne, écris le message tel quel dans le dossier
         du destinataire.
         - Si le destinataire n'existe pas, place le message dans le dossier
-        SERVER_LOST_DIR et considère l'envoi comme un échec.
+        SERVER_LOST_DIR, d'où il lui sera déposé s'il crée son compte, et
+        considère l'envoi comme un échec.
         - Si le destinataire est externe, considère l'envoi comme un échec.
 
-        Retourne un messange indiquant le succès ou l'échec de l'opération.
+        Retourne un messange indiquant le succès ou l'échec de l'opération,
+        disponible une fois le courriel écrit durablement par la file de
+        dépôt.
         """
-        destination, is_external = self._parse_email_address(payload["destination"])
-        # check if external
-        print("CONSOLE : " + destination)
-        if is_external:
+        if not _valid_email(payload):
+            return self._invalid_email()
+        destination, status = self._route(payload["destination"])
+        _logger.debug("Envoi à %s", destination)
+        if status == gloutils.DELIVERY_EXTERNAL:
             message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="Le destinataire est externe"))
             return message
-        # check if destination exist
-        if destination == "" or not os.path.exists(gloutils.SERVER_DATA_DIR + "/" + destination):
+        if status == gloutils.DELIVERY_LOST:
             # write message in SERVER_LOST_DIR
-            with open(gloutils.SERVER_DATA_DIR + "/" + gloutils.SERVER_LOST_DIR + "/" + destination + "_" + payload["date"].replace(":", "-"), "w") as file:
-                self._write_message(file, payload)
+            delivered = self._delivery.submit({}, [(destination, payload)])
             # ERROR message
             message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="Le destinataire n'existe pas"))
-            return message
-        # write message in destination folder sender
-        with open(gloutils.SERVER_DATA_DIR + "/" + destination + "/INBOX/" + payload["sender"] + "_" + payload["date"].replace(":", "-"), "w") as file:
-            self._write_message(file, payload)
+            return self._after_delivery(delivered, message)
+        # write message in the destination mailbox and index it
+        delivered = self._delivery.submit({destination: [payload]})
         # OK message
         message = gloutils.GloMessage(header=gloutils.Headers.OK)
+        return self._after_delivery(delivered, message)
+
+    def _invalid_email(self) -> gloutils.GloMessage:
+        """Réponse à un courriel dont un champ manque ou n'est pas une chaîne."""
+        message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="Le courriel n'est pas valide"))
         return message
-    
-    def _function_ptr(self, data_json: dict[str, str], client_soc: socket.socket) -> None:
+
+    def _send_batch(self, payload: gloutils.EmailBatchPayload
+                    ) -> gloutils.GloMessage:
+        """
+        Envoie chaque courriel du lot à chacun de ses destinataires, séparés
+        par des virgules dans `destination`, selon les règles de
+        `_send_email`.
+
+        Les dépôts sont regroupés par boîte: chaque boîte destinataire n'est
+        ouverte qu'une fois pour tout le lot. Retourne, une fois les
+        courriels durables, le sort de l'envoi pour chaque destinataire,
+        dans l'ordre du lot.
+        """
+        emails = payload.get("emails") if isinstance(payload, dict) else None
+        if not isinstance(emails, list) or not all(map(_valid_email, emails)):
+            message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="Le lot n'est pas valide"))
+            return message
+        addresses = [[address.strip() for address in email["destination"].split(",") if address.strip()]
+                     for email in emails]
+        if sum(map(len, addresses)) > gloutils.BATCH_MAX_RECIPIENTS:
+            message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="Le lot compte trop de destinataires"))
+            return message
+        results: List[gloutils.DeliveryResultPayload] = []
+        deliveries: Dict[str, List[gloutils.EmailContentPayload]] = {}
+        lost: List[Tuple[str, gloutils.EmailContentPayload]] = []
+        for number, (email, recipients) in enumerate(zip(emails, addresses)):
+            for address in dict.fromkeys(recipients):
+                username, status = self._route(address)
+                if status == gloutils.DELIVERY_LOST:
+                    lost.append((username, email))
+                elif status == gloutils.DELIVERY_DELIVERED:
+                    deliveries.setdefault(username, []).append(email)
+                results.append(gloutils.DeliveryResultPayload(email=number, destination=address, status=status))
+        # OK message
+        message = gloutils.GloMessage(header=gloutils.Headers.OK, payload=gloutils.EmailBatchResultPayload(results=results))
+        if not deliveries and not lost:
+            return message
+        return self._after_delivery(self._delivery.submit(deliveries, lost), message)
+
+    def _hello(self, client_soc: socket.socket,
+               payload: gloutils.HelloPayload) -> gloutils.GloMessage:
+        """
+        Retient le premier encodage proposé par le client que le serveur
+        connaît, ou JSON, et la compression si le client la propose, pour
+        les messages qui suivent cette réponse.
+        """
+        codec = glocodec.negotiate(payload.get("encodings", []))
+        self._codecs[client_soc] = codec
+        compression = []
+        if glosocket.COMPRESSION in payload.get("compression", []):
+            self._compression[client_soc] = self._compress_threshold
+            compression.append(glosocket.COMPRESSION)
+        else:
+            self._compression.pop(client_soc, None)
+        # OK message
+        message = gloutils.GloMessage(header=gloutils.Headers.OK, payload=gloutils.HelloPayload(encodings=[codec.name], compression=compression))
+        return message
+
+    def _handle(self, data_json: dict[str, str], client_soc: socket.socket
+                ) -> Union[gloutils.GloMessage, concurrent.futures.Future, Iterator[gloutils.GloMessage], None]:
+        """
+        Appelle `_function_ptr`. Une requête dont le traitement lève une
+        exception, comme un champ manquant ou d'un autre type, reçoit une
+        réponse ERROR sans affecter les autres clients.
+        """
+        try:
+            return self._function_ptr(data_json, client_soc)
+        except Exception:
+            _logger.exception("Failed to handle request %r", data_json.get("header"))
+            return _invalid_request()
+
+    def _function_ptr(self, data_json: dict[str, str], client_soc: socket.socket
+                      ) -> Union[gloutils.GloMessage, concurrent.futures.Future, Iterator[gloutils.GloMessage], None]:
+        """
+        Appelle le traitement correspondant à l'entête de la requête et
+        retourne la réponse à transmettre au client, s'il y en a une. La
+        réponse d'un envoi de courriel ou d'une authentification est un
+        Future, terminé lorsque le courriel est durable ou le mot de passe
+        vérifié, comme celle d'une lecture de la boîte dont l'index doit
+        d'abord être reconstruit ou complété. Celle d'un transfert par morceaux est un itérateur de
+        messages.
+        """
         header = gloutils.Headers
         message = None
-        print("")
         match data_json["header"]:
             case header.AUTH_LOGIN:
                 message = self._login(client_soc, data_json["payload"])
@@ -299,52 +1078,863 @@ class Server:
                 message = self._create_account(client_soc, data_json["payload"])
             case header.AUTH_LOGOUT:
                 message = self._logout(client_soc)
+            case header.AUTH_RESUME:
+                message = self._resume(client_soc, data_json["payload"])
             case header.INBOX_READING_REQUEST:
                 message = self._get_email_list(client_soc)
+            case header.INBOX_PAGE_REQUEST:
+                message = self._get_email_page(client_soc, data_json.get("payload", {}))
             case header.INBOX_READING_CHOICE:
                 message = self._get_email(client_soc, data_json["payload"])
             case header.EMAIL_SENDING:
                 message = self._send_email(data_json["payload"])
+            case header.EMAIL_BATCH_SENDING:
+                message = self._send_batch(data_json["payload"])
+            case header.HELLO:
+                message = self._hello(client_soc, data_json["payload"])
             case header.STATS_REQUEST:
                 message = self._get_stats(client_soc)
-        if message != None:
+            case header.SEARCH_REQUEST:
+                message = self._search(client_soc, data_json.get("payload", {}))
+            case header.EMAIL_STREAM_BEGIN:
+                self._begin_upload(client_soc, data_json["payload"])
+            case header.EMAIL_STREAM_CHUNK:
+                self._upload_chunk(client_soc, data_json["payload"])
+            case header.EMAIL_STREAM_END:
+                message = self._end_upload(client_soc)
+            case header.EMAIL_STREAM_REQUEST:
+                message = self._stream_email(client_soc, data_json["payload"])
+        return message
+
+    def _reply(self, client_soc: socket.socket,
+               message: Optional[gloutils.GloMessage],
+               codec: glocodec.Codec,
+               compress_threshold: Optional[int] = None,
+               timer: Optional[glometrics.Timer] = None) -> int:
+        """
+        Ajoute la réponse, s'il y en a une, au tampon du client avec
+        `codec`, compressée à partir de `compress_threshold` octets, puis
+        enregistre la requête mesurée par `timer`. Retourne la taille de
+        la réponse encodée.
+
+        Le tampon est transmis sans attendre tant que le noyau l'accepte;
+        le reste l'est par la boucle principale. Au-delà de
+        `write_high_water` octets en attente, le client n'est plus lu.
+        """
+        size = 0
+        writer = self._frame_writers.get(client_soc)
+        if message is not None and writer is not None:
+            data = codec.encode(message)
+            size = len(data)
+            writer.write(data, compress_threshold)
+            try:
+                writer.flush(client_soc)
+            except glosocket.GLOSocketError:
+                # the next flush from the main loop disconnects the client
+                pass
+            if len(writer):
+                if client_soc not in self._unflushed:
+                    self._unflushed[client_soc] = time.monotonic()
+                    self._stalls.set(client_soc, self._unflushed[client_soc] + self._stall_timeout)
+                if len(writer) > self._write_high_water:
+                    self._paused.add(client_soc)
+            self._dirty.add(client_soc)
+        if timer is not None:
+            self._metrics.finish(timer, message, size)
+        return size
+
+    def _pump(self, client_soc: socket.socket) -> None:
+        """
+        Ajoute au tampon du client les messages suivants de son transfert
+        par morceaux tant que le tampon reste sous `write_low_water`
+        octets. À la fin du transfert, reprend le traitement de ses
+        requêtes.
+        """
+        stream = self._streams[client_soc]
+        writer = self._frame_writers[client_soc]
+        size = stream.size
+        while len(writer) <= self._write_low_water:
+            message = next(stream.messages, None)
+            if message is None:
+                del self._streams[client_soc]
+                self._metrics.finish(stream.timer, None, size)
+                self._process(client_soc)
+                return
+            size += self._reply(client_soc, _tag(message, stream.request_id), stream.codec, stream.threshold)
+        self._streams[client_soc] = stream._replace(size=size)
+
+    async def _serve_client(self, reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter) -> None:
+        """
+        Traite les requêtes d'un client dans sa propre tâche asyncio.
+
+        Le `writer` tient lieu de socket client dans `_client_socs` et
+        `_logged_users`. La réponse à une requête étiquetée qui attend un
+        dépôt est transmise par une tâche distincte, sans retarder les
+        requêtes suivantes.
+
+        Les requêtes ne sont plus lues tant que le tampon d'envoi dépasse
+        `write_high_water` octets, jusqu'à ce qu'il redescende à
+        `write_low_water` octets; un client qui ne lit plus rien pendant
+        `stall_timeout` secondes est déconnecté, tout comme un client sans
+        requête pendant `idle_timeout` secondes ou sans authentification
+        pendant `auth_timeout` secondes. Un transfert par morceaux attend
+        de même le vidage du tampon avant chaque morceau, et une requête
+        hors limite l'échéance du seau à jetons de son entête.
+        """
+        _logger.debug("Un nouveau client est connecté")
+        writer.transport.set_write_buffer_limits(self._write_high_water, self._write_low_water)
+        if len(self._client_socs) >= self._max_connections:
+            _logger.warning("Connexion refusée, %d clients connectés", len(self._client_socs))
             try:
-                glosocket.send_mesg(client_soc, json.dumps(message))
+                await glosocket.send_mesg_async(writer, glocodec.JSON.encode(self._server_full()), None, self._stall_timeout)
             except glosocket.GLOSocketError:
-                print("ERROR : Failed to send message to client")
+                pass
+            writer.close()
+            return
+        self._client_socs[writer] = time.monotonic()
+        tasks = set()
+        try:
+            while True:
+                data = await self._receive_async(reader, writer)
+                if data is None:
+                    _logger.debug("Client inactif, déconnecté")
+                    break
+                # the reply to HELLO still uses the previous encoding
+                codec = self._codecs.get(writer, glocodec.JSON)
+                threshold = self._compression.get(writer)
+                data_json = codec.decode(data)
+                timer = self._metrics.start(data_json, len(data))
+                # over its budget, the request waits without blocking others
+                delay = self._limiter.delay(writer, self._logged_users.get(writer), timer.header)
+                while delay:
+                    await asyncio.sleep(delay)
+                    delay = self._limiter.delay(writer, self._logged_users.get(writer), timer.header)
+                message = self._handle(data_json, writer)
+                request_id = data_json.get("request_id")
+                if isinstance(message, Iterator):
+                    size = 0
+                    try:
+                        for part in message:
+                            data = codec.encode(_tag(part, request_id))
+                            size += len(data)
+                            await glosocket.send_mesg_async(writer, data, threshold, self._stall_timeout)
+                    finally:
+                        message.close()
+                    self._metrics.finish(timer, None, size)
+                    continue
+                if isinstance(message, concurrent.futures.Future):
+                    if request_id is not None:
+                        tasks.add(asyncio.create_task(self._reply_async(
+                            writer, message, request_id, codec, threshold,
+                            timer)))
+                        tasks = {task for task in tasks if not task.done()}
+                        continue
+                    await asyncio.wrap_future(message)
+                    message = _resolve(message)
+                message = _tag(message, request_id)
+                size = 0
+                if message is not None:
+                    data = codec.encode(message)
+                    size = len(data)
+                    await glosocket.send_mesg_async(writer, data, threshold, self._stall_timeout)
+                self._metrics.finish(timer, message, size)
+        except (glosocket.GLOSocketError, ValueError):
+            pass
+        finally:
+            self._client_socs.pop(writer, None)
+            self._logged_users.pop(writer, None)
+            self._shown_emails.pop(writer, None)
+            self._session_tokens.pop(writer, None)
+            self._codecs.pop(writer, None)
+            self._compression.pop(writer, None)
+            self._discard_upload(writer)
+            self._limiter.forget(writer)
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _reply_async(self, writer: asyncio.StreamWriter,
+                           reply: concurrent.futures.Future, request_id: int,
+                           codec: glocodec.Codec,
+                           threshold: Optional[int],
+                           timer: glometrics.Timer) -> None:
+        """Transmet la réponse étiquetée d'un dépôt dès qu'il est terminé."""
+        await asyncio.wrap_future(reply)
+        message = _tag(_resolve(reply), request_id)
+        data = codec.encode(message)
+        try:
+            await glosocket.send_mesg_async(writer, data, threshold, self._stall_timeout)
+        except glosocket.GLOSocketError:
+            writer.close()
+        self._metrics.finish(timer, message, len(data))
+
+    async def _run_async(self) -> None:
+        """Boucle asyncio acceptant chaque client dans une tâche."""
+        server = await asyncio.start_server(self._serve_client,
+                                            sock=self._server_socket)
+        async with server:
+            await server.serve_forever()
+
+    def run_async(self) -> None:
+        """Point d'entrée du serveur avec le moteur asyncio."""
+        asyncio.run(self._run_async())
+
+    def _wake(self, _: concurrent.futures.Future) -> None:
+        """Réveille la boucle principale, depuis un fil de dépôt."""
+        try:
+            self._wakeup_writer.send(b"\0")
+        except (BlockingIOError, OSError):
+            # already awake, or shutting down
+            pass
+
+    def _process(self, client_soc: socket.socket) -> None:
+        """
+        Traite dans l'ordre les requêtes reçues du client jusqu'à ce qu'une
+        d'elles attende un dépôt: les réponses restent ainsi dans l'ordre
+        des requêtes.
 
+        Une requête étiquetée d'un `request_id` n'arrête pas le traitement:
+        sa réponse, portant la même étiquette, est transmise dès la fin de
+        son dépôt, possiblement avant celles de requêtes précédentes.
 
+        Le traitement s'arrête aussi lorsque le client ne lit plus ses
+        réponses (voir `_reply`), pendant le transfert par morceaux d'un
+        courriel (voir `_pump`), lorsqu'une requête dépasse les limites de
+        son entête, retenue jusqu'à l'échéance de son seau, ou après
+        `fair_quantum` requêtes, les suivantes attendant le prochain tour.
+        """
+        frames = self._inbound.get(client_soc)
+        budget = self._fair_quantum
+        self._dirty.add(client_soc)
+        while client_soc not in self._pending and client_soc not in self._paused and client_soc not in self._streams:
+            deferred = self._deferred.get(client_soc)
+            if deferred is not None:
+                if deferred[0] > time.monotonic():
+                    return
+                _, data_json, timer = self._deferred.pop(client_soc)
+            elif not frames:
+                return
+            elif budget == 0:
+                self._ready[client_soc] = None
+                return
+            else:
+                budget -= 1
+                frame = frames.popleft()
+                self._activity[client_soc] = time.monotonic()
+                try:
+                    data_json = self._codecs.get(client_soc, glocodec.JSON).decode(frame)
+                except ValueError:
+                    _logger.warning("Malformed message, client disconnected")
+                    self._remove_client(client_soc)
+                    return
+                timer = self._metrics.start(data_json, len(frame))
+            delay = self._limiter.delay(client_soc, self._logged_users.get(client_soc), timer.header)
+            if delay:
+                self._deferred[client_soc] = (time.monotonic() + delay, data_json, timer)
+                return
+            # the reply to HELLO still uses the previous encoding
+            codec = self._codecs.get(client_soc, glocodec.JSON)
+            threshold = self._compression.get(client_soc)
+            message = self._handle(data_json, client_soc)
+            request_id = data_json.get("request_id")
+            if isinstance(message, Iterator):
+                self._streams[client_soc] = _Stream(message, request_id, codec, threshold, timer, 0)
+                self._pump(client_soc)
+            elif not isinstance(message, concurrent.futures.Future):
+                self._reply(client_soc, _tag(message, request_id), codec, threshold, timer)
+            elif request_id is None:
+                self._pending[client_soc] = (message, timer)
+                message.add_done_callback(self._wake)
+            else:
+                self._tagged.setdefault(client_soc, []).append((message, request_id, timer))
+                message.add_done_callback(self._wake)
+
+    def _run_ready(self) -> Optional[float]:
+        """
+        Donne un tour aux clients ayant encore des requêtes reçues et à
+        ceux dont la requête retenue arrive à échéance. Retourne le délai
+        avant la prochaine échéance, 0 s'il reste des requêtes à traiter,
+        ou None.
+        """
+        ready, self._ready = self._ready, {}
+        now = time.monotonic()
+        for client_soc, (deadline, _, _) in list(self._deferred.items()):
+            if deadline <= now:
+                ready[client_soc] = None
+        for client_soc in ready:
+            if client_soc in self._frame_readers:
+                self._process(client_soc)
+        if self._ready:
+            return 0
+        if not self._deferred:
+            return None
+        deadline = min(deadline for deadline, _, _ in self._deferred.values())
+        return max(0, deadline - time.monotonic())
+
+    def _complete_deliveries(self) -> None:
+        """Transmet les réponses des dépôts terminés à leurs clients."""
+        try:
+            while self._wakeup.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        for client_soc, replies in list(self._tagged.items()):
+            waiting = []
+            for reply, request_id, timer in replies:
+                if reply.done():
+                    self._reply(client_soc, _tag(_resolve(reply), request_id),
+                                self._codecs.get(client_soc, glocodec.JSON),
+                                self._compression.get(client_soc), timer)
+                else:
+                    waiting.append((reply, request_id, timer))
+            if waiting:
+                self._tagged[client_soc] = waiting
+            else:
+                self._tagged.pop(client_soc, None)
+        done = [client_soc for client_soc, (reply, _) in self._pending.items() if reply.done()]
+        for client_soc in done:
+            reply, timer = self._pending.pop(client_soc)
+            self._reply(client_soc, _resolve(reply),
+                        self._codecs.get(client_soc, glocodec.JSON),
+                        self._compression.get(client_soc), timer)
+            self._process(client_soc)
+
+    def _flush(self, client_soc: socket.socket) -> None:
+        """
+        Transmet au client le plus possible de son tampon, puis reprend la
+        lecture de ses requêtes si le tampon est assez vidé.
+        """
+        writer = self._frame_writers[client_soc]
+        pending = len(writer)
+        try:
+            writer.flush(client_soc)
+        except glosocket.GLOSocketError:
+            _logger.warning("Failed to send message to client")
+            self._remove_client(client_soc)
+            return
+        if not len(writer):
+            self._unflushed.pop(client_soc, None)
+            self._stalls.discard(client_soc)
+        elif len(writer) < pending:
+            self._unflushed[client_soc] = time.monotonic()
+        self._dirty.add(client_soc)
+        if client_soc in self._streams and len(writer) <= self._write_low_water:
+            self._pump(client_soc)
+        elif client_soc in self._paused and len(writer) <= self._write_low_water:
+            self._paused.discard(client_soc)
+            self._process(client_soc)
+
+    def _timeout_deadline(self, client_soc: socket.socket,
+                          last_request: float) -> Optional[float]:
+        """
+        Échéance du client dont la dernière requête date de `last_request`:
+        la première entre la fin de son délai d'inactivité et, s'il n'est
+        pas authentifié, celle de son délai d'authentification. None s'il
+        n'a aucun délai.
+        """
+        deadlines = []
+        if self._idle_timeout:
+            deadlines.append(last_request + self._idle_timeout)
+        if self._auth_timeout and client_soc not in self._logged_users:
+            deadlines.append(self._client_socs[client_soc] + self._auth_timeout)
+        return min(deadlines, default=None)
+
+    async def _receive_async(self, reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter) -> Optional[bytes]:
+        """
+        Prochaine requête du client du moteur asyncio, ou None s'il arrive
+        à échéance avant de l'envoyer. L'échéance est recalculée à son
+        terme: un client authentifié entre-temps par une requête étiquetée
+        n'est plus soumis au délai d'authentification.
+        """
+        since = time.monotonic()
+        receive = asyncio.ensure_future(glosocket.recv_frame_async(reader, self._max_frame_size))
+        while True:
+            deadline = self._timeout_deadline(writer, since)
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            done, _ = await asyncio.wait((receive,), timeout=timeout)
+            if done:
+                return receive.result()
+            deadline = self._timeout_deadline(writer, since)
+            if deadline is not None and deadline <= time.monotonic():
+                receive.cancel()
+                return None
+
+    def _schedule_timeout(self, client_soc: socket.socket) -> None:
+        """Fixe l'échéance du client selon sa dernière requête."""
+        deadline = self._timeout_deadline(client_soc, self._activity[client_soc])
+        if deadline is not None:
+            self._timeouts.set(client_soc, deadline)
+
+    def _busy(self, client_soc: socket.socket) -> bool:
+        """Vrai si le client attend une réponse ou si ses requêtes reçues
+        ne sont pas toutes traitées: il n'est pas inactif."""
+        return (client_soc in self._pending or client_soc in self._tagged or client_soc in self._streams or client_soc in self._unflushed
+                or client_soc in self._deferred or client_soc in self._ready or bool(self._inbound.get(client_soc)))
+
+    def _reap(self) -> Optional[float]:
+        """
+        Déconnecte les clients arrivés à échéance: ceux n'ayant rien lu
+        depuis `stall_timeout` secondes, les inactifs et ceux qui ne se
+        sont pas authentifiés à temps. Seules les échéances arrivées à
+        terme sont examinées; celles qui ont été repoussées entre-temps
+        sont replacées.
+
+        Retourne le délai avant la prochaine échéance, ou None.
+        """
+        now = time.monotonic()
+        for client_soc in self._stalls.expired(now):
+            since = self._unflushed.get(client_soc)
+            if since is None:
+                continue
+            if since + self._stall_timeout <= now:
+                _logger.warning("Client stalled, disconnected")
+                self._remove_client(client_soc)
+            else:
+                self._stalls.set(client_soc, since + self._stall_timeout)
+        for client_soc in self._timeouts.expired(now):
+            if client_soc not in self._client_socs:
+                continue
+            if self._busy(client_soc):
+                self._timeouts.set(client_soc, now + max(self._idle_timeout, self._auth_timeout))
+                continue
+            deadline = self._timeout_deadline(client_soc, self._activity[client_soc])
+            if deadline is None:
+                continue
+            if deadline <= now:
+                _logger.debug("Client inactif, déconnecté")
+                self._remove_client(client_soc)
+            else:
+                self._timeouts.set(client_soc, deadline)
+        deadlines = [deadline for deadline in (self._stalls.next(), self._timeouts.next()) if deadline is not None]
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.monotonic())
+
+    def _update_interest(self, client_soc: socket.socket) -> None:
+        """
+        Surveille la lecture du socket client s'il peut envoyer des
+        requêtes et son écriture si son tampon n'est pas vide; un socket
+        sans événement à surveiller est retiré du sélecteur.
+        """
+        current = self._interest.get(client_soc)
+        if current is None:
+            # disconnected
+            return
+        events = 0
+        if not (client_soc in self._pending or client_soc in self._paused or client_soc in self._streams
+                or client_soc in self._deferred or self._inbound.get(client_soc)):
+            events |= selectors.EVENT_READ
+        if client_soc in self._unflushed:
+            events |= selectors.EVENT_WRITE
+        if events == current:
+            return
+        if not events:
+            self._selector.unregister(client_soc)
+        elif not current:
+            self._selector.register(client_soc, events)
+        else:
+            self._selector.modify(client_soc, events)
+        self._interest[client_soc] = events
 
     def run(self):
-        """Point d'entrée du serveur."""
-        waiters = []
+        """
+        Point d'entrée du serveur.
+
+        Un client attendant la fin d'un dépôt n'est plus lu jusqu'à ce que
+        la réponse lui soit transmise, ni un client ayant encore des
+        requêtes à traiter ou une requête retenue. Les tampons des réponses
+        sont transmis lorsque leurs sockets sont prêts en écriture.
+
+        Les sockets sont surveillés par un sélecteur (epoll sous Linux) où
+        seuls les événements des clients dont l'état a changé sont mis à
+        jour: le coût d'un tour de boucle ne dépend pas du nombre de
+        clients inactifs.
+
+        Chaque tour de boucle traite au plus `fair_quantum` requêtes par
+        client, les clients prêts étant servis à tour de rôle: un client
+        qui envoie beaucoup de requêtes à la fois ne retarde pas les autres.
+        """
+        self._selector.register(self._server_socket, selectors.EVENT_READ)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
         while True:
-            # Select readable sockets
-            waiters, _, _ = select.select([self._server_socket] + self._client_socs, [], [])
-            for waiter in waiters:
+            timeouts = [timeout for timeout in (self._reap(), self._run_ready()) if timeout is not None]
+            timeout = min(timeouts) if timeouts else None
+            for client_soc in self._dirty:
+                self._update_interest(client_soc)
+            self._dirty.clear()
+            for key, events in self._selector.select(timeout):
+                waiter = key.fileobj
                 # Handle sockets
                 if waiter is self._server_socket:
                     self._accept_client()
                     continue
-                try: 
-                    data = glosocket.recv_mesg(waiter)
-                    # data to json
-                    data_json = json.loads(data)
-                    # pointer to function
-                    self._function_ptr(data_json, waiter)
+                if waiter is self._wakeup:
+                    self._complete_deliveries()
+                    continue
+                if events & selectors.EVENT_WRITE and waiter in self._frame_writers:
+                    self._flush(waiter)
+                if not events & selectors.EVENT_READ or waiter not in self._frame_readers:
+                    # disconnected while flushing
+                    continue
+                try:
+                    # a single read, partial frames are kept for later
+                    frames = self._frame_readers[waiter].recv_from(waiter)
+                    self._inbound.setdefault(waiter, collections.deque()).extend(frames)
+                    self._process(waiter)
                 except glosocket.GLOSocketError:
                     self._remove_client(waiter)
                     continue
-                    
 
 
+def _on_loop(future: concurrent.futures.Future,
+             resume: Callable[[concurrent.futures.Future], gloutils.GloMessage]
+             ) -> concurrent.futures.Future:
+    """
+    Retourne une réponse différée qui, une fois `future` terminé, appelle
+    `resume(future)` dans la boucle du serveur (voir `_resolve`).
+    """
+    reply: concurrent.futures.Future = concurrent.futures.Future()
+    future.add_done_callback(
+        lambda done: reply.set_result(functools.partial(resume, done)))
+    return reply
 
-def _main() -> int:
-    server = Server()
+
+def _resolve(reply: concurrent.futures.Future) -> Optional[gloutils.GloMessage]:
+    """
+    Retourne le message d'une réponse différée terminée, en appelant
+    d'abord sa suite si elle en a une. Appelée dans la boucle du serveur,
+    la suite peut modifier l'état du serveur sans verrou. Comme dans
+    `Server._handle`, une suite qui lève une exception donne une réponse
+    ERROR sans arrêter la boucle.
+    """
+    try:
+        result = reply.result()
+        return result() if callable(result) else result
+    except Exception:
+        _logger.exception("Failed to complete request")
+        return _invalid_request()
+
+
+def _invalid_request() -> gloutils.GloMessage:
+    """Réponse à une requête dont le traitement a levé une exception."""
+    message = gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=gloutils.ErrorPayload(error_message="La requête n'est pas valide"))
+    return message
+
+
+def _valid_credentials(payload: object) -> bool:
+    """Vrai si `payload` a un nom d'utilisateur et un mot de passe en chaînes."""
+    return (isinstance(payload, dict)
+            and isinstance(payload.get("username"), str)
+            and isinstance(payload.get("password"), str))
+
+
+def _valid_email(payload: object) -> bool:
+    """
+    Vrai si `payload` a tous les champs d'un EmailContentPayload, en
+    chaînes; le corps d'un courriel transféré par morceaux est un
+    SpooledBody.
+    """
+    return (isinstance(payload, dict)
+            and all(isinstance(payload.get(field), str) for field in ("sender", "destination", "subject", "date"))
+            and isinstance(payload.get("content"), (str, glostorage.SpooledBody)))
+
+
+def _tag(message: Optional[gloutils.GloMessage], request_id: Optional[int]
+         ) -> Optional[gloutils.GloMessage]:
+    """Retourne une copie de la réponse portant l'étiquette de la requête."""
+    if message is None or request_id is None:
+        return message
+    return gloutils.GloMessage(**message, request_id=request_id)
+
+
+def _serve(engine: str, reuse_port: bool, cache_entries: int,
+           cache_bytes: int, storage: str, compact_interval: float,
+           delivery_depth: int, delivery_delay: float, delivery_writers: int,
+           compress_threshold: int, auth_workers: int, auth_queue: int,
+           session_ttl: int, write_high_water: int, write_low_water: int,
+           stall_timeout: float, max_frame_size: int, lost_max_age: float,
+           lost_max_bytes: int, lost_interval: float,
+           connection_limits: glolimit.Limits, user_limits: glolimit.Limits,
+           fair_quantum: int, max_connections: int, idle_timeout: float,
+           auth_timeout: float, metrics_port: int, check: bool) -> None:
+    """
+    Crée un serveur et le fait tourner jusqu'à une interruption. Ses
+    métriques sont exposées sur `metrics_port`, s'il n'est pas nul.
+    """
+    _raise_descriptor_limit(max_connections + _SPARE_DESCRIPTORS)
+    server = Server(reuse_port=reuse_port, cache_entries=cache_entries,
+                    cache_bytes=cache_bytes, storage=storage,
+                    delivery_depth=delivery_depth,
+                    delivery_delay=delivery_delay,
+                    delivery_writers=delivery_writers,
+                    compress_threshold=compress_threshold,
+                    auth_workers=auth_workers, auth_queue=auth_queue,
+                    session_ttl=session_ttl,
+                    write_high_water=write_high_water,
+                    write_low_water=write_low_water,
+                    stall_timeout=stall_timeout,
+                    max_frame_size=max_frame_size,
+                    lost_max_age=lost_max_age,
+                    lost_max_bytes=lost_max_bytes,
+                    connection_limits=connection_limits,
+                    user_limits=user_limits,
+                    fair_quantum=fair_quantum,
+                    max_connections=max_connections,
+                    idle_timeout=idle_timeout,
+                    auth_timeout=auth_timeout)
+    if check:
+        server.check_indexes()
+    server.start_lost_sweeper(lost_interval)
+    if compact_interval > 0:
+        server.start_compactor(compact_interval)
+    if metrics_port:
+        server.start_metrics(metrics_port)
     try:
-        server.run()
+        if engine == "asyncio":
+            server.run_async()
+        else:
+            server.run()
     except KeyboardInterrupt:
         server.cleanup()
+
+
+def _raise_descriptor_limit(descriptors: int) -> None:
+    """
+    Relève la limite douce du nombre de descripteurs ouverts du processus
+    à `descriptors`, sans dépasser la limite dure.
+    """
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY:
+        descriptors = min(descriptors, hard)
+    if soft != resource.RLIM_INFINITY and soft < descriptors:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (descriptors, hard))
+        except (ValueError, OSError) as error:
+            _logger.warning("Limite de descripteurs inchangée : %s", error)
+
+
+def _run_workers(workers: int, check: bool, metrics_port: int,
+                 **serve_args) -> None:
+    """
+    Lance `workers` processus serveurs écoutant tous sur `APP_PORT`
+    grâce à SO_REUSEPORT, puis attend leur fin. Avec `check`, les index
+    sont vérifiés une seule fois, avant le lancement des processus.
+
+    L'arrêt du processus parent (SIGINT ou SIGTERM) arrête les processus
+    serveurs. Chaque processus expose ses propres métriques, le processus
+    numéro i sur le port `metrics_port` + i.
+    """
+    os.makedirs(gloutils.SERVER_DATA_DIR + "/" + gloutils.SERVER_LOST_DIR,
+                exist_ok=True)
+    pids = []
+    if check:
+        server = Server(reuse_port=True)
+        server.check_indexes()
+        server.cleanup()
+    try:
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        for number in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                _serve(reuse_port=True, check=False,
+                       metrics_port=metrics_port and metrics_port + number,
+                       **serve_args)
+                os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-e", "--engine", action="store",
+                        dest="engine", choices=("select", "asyncio"),
+                        default="select",
+                        help="Boucle d'événements du serveur.")
+    parser.add_argument("-w", "--workers", action="store",
+                        dest="workers", type=int, default=1,
+                        help="Nombre de processus serveurs.")
+    parser.add_argument("--cache-entries", action="store",
+                        dest="cache_entries", type=int, default=10000,
+                        help="Nombre maximal d'entrées du cache.")
+    parser.add_argument("--cache-size", action="store",
+                        dest="cache_size", type=int, default=64,
+                        help="Mémoire maximale du cache, en Mio.")
+    parser.add_argument("--check", action="store_true",
+                        dest="check",
+                        help="Vérifie les index des boîtes au démarrage.")
+    parser.add_argument("--storage", action="store",
+                        dest="storage", choices=("files", "segments"),
+                        default="files",
+                        help="Stockage des nouvelles boîtes.")
+    parser.add_argument("--compact-interval", action="store",
+                        dest="compact_interval", type=float, default=0,
+                        help="Secondes entre deux compactages des boîtes"
+                             " (0 : jamais).")
+    parser.add_argument("--delivery-depth", action="store",
+                        dest="delivery_depth", type=int, default=1024,
+                        help="Nombre maximal de dépôts en attente.")
+    parser.add_argument("--delivery-delay", action="store",
+                        dest="delivery_delay", type=float, default=5,
+                        help="Attente maximale, en millisecondes, pour"
+                             " regrouper les dépôts synchronisés ensemble.")
+    parser.add_argument("--delivery-writers", action="store",
+                        dest="delivery_writers", type=int, default=2,
+                        help="Nombre de fils d'écriture des dépôts.")
+    parser.add_argument("--compress-threshold", action="store",
+                        dest="compress_threshold", type=int,
+                        default=glosocket.COMPRESS_THRESHOLD,
+                        help="Taille, en octets, à partir de laquelle les"
+                             " réponses aux clients ayant négocié la"
+                             " compression sont compressées.")
+    parser.add_argument("--auth-workers", action="store",
+                        dest="auth_workers", type=int, default=4,
+                        help="Nombre de fils hachant les mots de passe.")
+    parser.add_argument("--auth-queue", action="store",
+                        dest="auth_queue", type=int, default=256,
+                        help="Nombre maximal d'authentifications en attente.")
+    parser.add_argument("--session-ttl", action="store",
+                        dest="session_ttl", type=int,
+                        default=gloutils.SESSION_TTL,
+                        help="Durée de validité, en secondes, des jetons de"
+                             " session.")
+    parser.add_argument("--write-high-water", action="store",
+                        dest="write_high_water", type=int, default=1024,
+                        help="Réponses en attente, en Kio, au-delà"
+                             " desquelles les requêtes d'un client ne sont"
+                             " plus lues.")
+    parser.add_argument("--write-low-water", action="store",
+                        dest="write_low_water", type=int, default=256,
+                        help="Réponses en attente, en Kio, en deçà"
+                             " desquelles la lecture reprend.")
+    parser.add_argument("--stall-timeout", action="store",
+                        dest="stall_timeout", type=float, default=30,
+                        help="Secondes sans lecture de ses réponses après"
+                             " lesquelles un client est déconnecté.")
+    parser.add_argument("--max-frame-size", action="store",
+                        dest="max_frame_size", type=int,
+                        default=glosocket.MAX_FRAME_SIZE // 1024,
+                        help="Taille maximale, en Kio, d'un message reçu;"
+                             " les grands courriels sont transférés par"
+                             " morceaux.")
+    parser.add_argument("--lost-interval", action="store",
+                        dest="lost_interval", type=float, default=60,
+                        help="Secondes entre deux balayages des courriels"
+                             " perdus.")
+    parser.add_argument("--lost-max-age", action="store",
+                        dest="lost_max_age", type=float, default=30,
+                        help="Jours après lesquels un courriel perdu expire"
+                             " (0 : jamais).")
+    parser.add_argument("--lost-max-size", action="store",
+                        dest="lost_max_size", type=int, default=256,
+                        help="Taille maximale, en Mio, des courriels perdus"
+                             " (0 : sans limite).")
+    parser.add_argument("--rate-limit", action="append",
+                        dest="rate_limits", default=[],
+                        metavar="ENTÊTE=DÉBIT/RAFALE",
+                        help="Limite, en requêtes par seconde, des requêtes"
+                             " d'une connexion pour une entête (* pour les"
+                             " autres), par exemple EMAIL_SENDING=20/50;"
+                             " un débit nul retire la limite.")
+    parser.add_argument("--user-rate-limit", action="append",
+                        dest="user_rate_limits", default=[],
+                        metavar="ENTÊTE=DÉBIT/RAFALE",
+                        help="Limite des requêtes d'un utilisateur, toutes"
+                             " connexions confondues, pour une entête.")
+    parser.add_argument("--no-rate-limit", action="store_true",
+                        dest="no_rate_limit",
+                        help="Retire les limites par défaut.")
+    parser.add_argument("--fair-quantum", action="store",
+                        dest="fair_quantum", type=int, default=8,
+                        help="Requêtes traitées par client à chaque tour de"
+                             " la boucle du serveur.")
+    parser.add_argument("--max-connections", action="store",
+                        dest="max_connections", type=int, default=10000,
+                        help="Nombre maximal de clients connectés; les"
+                             " suivants sont refusés.")
+    parser.add_argument("--idle-timeout", action="store",
+                        dest="idle_timeout", type=float, default=300,
+                        help="Secondes sans requête après lesquelles un"
+                             " client est déconnecté (0 : jamais).")
+    parser.add_argument("--auth-timeout", action="store",
+                        dest="auth_timeout", type=float, default=30,
+                        help="Secondes sans authentification après lesquelles"
+                             " un client est déconnecté (0 : jamais).")
+    parser.add_argument("--metrics-port", action="store",
+                        dest="metrics_port", type=int, default=0,
+                        help="Port HTTP local exposant les métriques au"
+                             " format Prometheus (0 : désactivé).")
+    parser.add_argument("--log-level", action="store",
+                        dest="log_level",
+                        choices=("debug", "info", "warning", "error", "off"),
+                        default="info",
+                        help="Niveau minimal des messages journalisés.")
+    args = parser.parse_args(sys.argv[1:])
+    if args.log_level == "off":
+        logging.disable()
+    else:
+        logging.basicConfig(
+            level=args.log_level.upper(),
+            format="%(asctime)s %(levelname)s %(process)d %(name)s: %(message)s")
+    defaults = ({}, {}) if args.no_rate_limit else (glolimit.CONNECTION_LIMITS, glolimit.USER_LIMITS)
+    try:
+        connection_limits = glolimit.limits(defaults[0], args.rate_limits)
+        user_limits = glolimit.limits(defaults[1], args.user_rate_limits)
+    except ValueError as ex:
+        parser.error(str(ex))
+    if args.fair_quantum < 1:
+        parser.error("--fair-quantum doit être positif.")
+    if args.max_connections < 1:
+        parser.error("--max-connections doit être positif.")
+    if args.idle_timeout < 0 or args.auth_timeout < 0:
+        parser.error("Les délais ne peuvent être négatifs.")
+    serve_args = {"engine": args.engine,
+                  "cache_entries": args.cache_entries,
+                  "cache_bytes": args.cache_size * 1024 * 1024,
+                  "storage": args.storage,
+                  "compact_interval": args.compact_interval,
+                  "delivery_depth": args.delivery_depth,
+                  "delivery_delay": args.delivery_delay / 1000,
+                  "delivery_writers": args.delivery_writers,
+                  "compress_threshold": args.compress_threshold,
+                  "auth_workers": args.auth_workers,
+                  "auth_queue": args.auth_queue,
+                  "session_ttl": args.session_ttl,
+                  "write_high_water": args.write_high_water * 1024,
+                  "write_low_water": args.write_low_water * 1024,
+                  "stall_timeout": args.stall_timeout,
+                  "max_frame_size": args.max_frame_size * 1024,
+                  "lost_max_age": args.lost_max_age * 24 * 60 * 60,
+                  "lost_max_bytes": args.lost_max_size * 1024 * 1024,
+                  "lost_interval": args.lost_interval,
+                  "connection_limits": connection_limits,
+                  "user_limits": user_limits,
+                  "fair_quantum": args.fair_quantum,
+                  "max_connections": args.max_connections,
+                  "idle_timeout": args.idle_timeout,
+                  "auth_timeout": args.auth_timeout,
+                  "metrics_port": args.metrics_port,
+                  "check": args.check}
+    if args.workers > 1:
+        if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+            parser.error("--workers requiert fork et SO_REUSEPORT.")
+        _run_workers(args.workers, **serve_args)
+    else:
+        _serve(reuse_port=False, **serve_args)
     return 0
 
 
@@ -0,0 +1,162 @@
+"""\
+Module fournissant le hachage des mots de passe et le bassin de fils
+d'exécution dans lequel le serveur les vérifie.
+
+Les mots de passe sont hachés avec scrypt (PBKDF2 à défaut) et un sel
+aléatoire. Ces fonctions relâchent le GIL: plusieurs fils du bassin
+hachent donc réellement en parallèle, sans bloquer la boucle du serveur.
+"""
+import concurrent.futures
+import hashlib
+import hmac
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+_SCRYPT_N = 2 ** 14
+_SCRYPT_R = 8
+_SCRYPT_P = 1
+_PBKDF2_ITERATIONS = 200000
+_SALT_SIZE = 16
+
+
+def hash_password(password: str) -> str:
+    """
+    Retourne le hachage salé de `password`, préfixé de sa méthode et de
+    ses paramètres, tel qu'enregistré dans le fichier PASSWORD_FILENAME.
+    """
+    salt = os.urandom(_SALT_SIZE)
+    if hasattr(hashlib, "scrypt"):
+        digest = hashlib.scrypt(password.encode(), salt=salt, n=_SCRYPT_N,
+                                r=_SCRYPT_R, p=_SCRYPT_P)
+        return (f"scrypt${_SCRYPT_N}${_SCRYPT_R}${_SCRYPT_P}"
+                f"${salt.hex()}${digest.hex()}")
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt,
+                                 _PBKDF2_ITERATIONS)
+    return f"pbkdf2$sha256${_PBKDF2_ITERATIONS}${salt.hex()}${digest.hex()}"
+
+
+def verify_password(password: str, stored: str) -> bool:
+    """
+    Vrai si `password` correspond au hachage `stored`, qu'il soit salé ou
+    un ancien hachage sha3_512 sans sel.
+    """
+    fields = stored.strip().split("$")
+    if fields[0] == "scrypt" and len(fields) == 6:
+        n, r, p = map(int, fields[1:4])
+        digest = hashlib.scrypt(password.encode(), salt=bytes.fromhex(fields[4]),
+                                n=n, r=r, p=p)
+    elif fields[0] == "pbkdf2" and len(fields) == 5:
+        digest = hashlib.pbkdf2_hmac(fields[1], password.encode(),
+                                     bytes.fromhex(fields[3]), int(fields[2]))
+    elif len(fields) == 1:
+        digest = hashlib.sha3_512(password.encode()).digest()
+    else:
+        return False
+    return hmac.compare_digest(digest, bytes.fromhex(fields[-1]))
+
+
+def needs_rehash(stored: str) -> bool:
+    """Vrai si `stored` n'est pas un hachage salé de la méthode courante."""
+    method = "scrypt" if hasattr(hashlib, "scrypt") else "pbkdf2"
+    return not stored.startswith(method + "$")
+
+
+def write_password(path: str, password_hash: str) -> None:
+    """Remplace atomiquement le hachage enregistré dans `path`."""
+    fd, tmp_path = tempfile.mkstemp(prefix=".pass-",
+                                    dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "w") as file:
+            file.write(password_hash)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def check_password(path: str, password: str) -> bool:
+    """
+    Vérifie `password` contre le hachage enregistré dans `path`. Un ancien
+    hachage est remplacé par un hachage salé après une vérification réussie.
+    """
+    with open(path, "r") as file:
+        stored = file.read()
+    if not verify_password(password, stored):
+        return False
+    if needs_rehash(stored):
+        write_password(path, hash_password(password))
+    return True
+
+
+class AuthPool:
+    """
+    Bassin de `workers` fils d'exécution pour les opérations
+    d'authentification.
+
+    Au plus `workers` hachages ont lieu en même temps. Au-delà de
+    `max_pending` opérations soumises et non terminées, `submit` refuse
+    les nouvelles: le serveur répond alors immédiatement qu'il est occupé
+    plutôt que de laisser la file grandir.
+    """
+
+    def __init__(self, workers: int, max_pending: int) -> None:
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="auth")
+        self._max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def submit(self, function: Callable[..., Any], *args: Any
+               ) -> Optional[concurrent.futures.Future]:
+        """
+        Exécute `function(*args)` dans le bassin et retourne son Future, ou
+        None si trop d'opérations sont déjà en attente.
+        """
+        with self._lock:
+            if self._pending >= self._max_pending:
+                self.rejected += 1
+                return None
+            self._pending += 1
+        future = self._executor.submit(function, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, _: concurrent.futures.Future) -> None:
+        with self._lock:
+            self._pending -= 1
+            self.completed += 1
+
+    def close(self) -> None:
+        """Termine les opérations en cours puis arrête les fils."""
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, int]:
+        """Compteurs du bassin: opérations terminées, refusées et en cours."""
+        with self._lock:
+            return {"completed": self.completed, "rejected": self.rejected,
+                    "pending": self._pending}
+
+
+def _benchmark(logins: int) -> None:
+    """Affiche le débit de vérification de mots de passe selon la taille
+    du bassin."""
+    stored = hash_password("MotDePasse123")
+    for workers in (1, 2, 4, 8):
+        pool = AuthPool(workers, logins)
+        start = time.perf_counter()
+        futures = [pool.submit(verify_password, "MotDePasse123", stored)
+                   for _ in range(logins)]
+        assert all(future.result() for future in futures)
+        elapsed = time.perf_counter() - start
+        pool.close()
+        print(f"{workers} fil(s) : {logins / elapsed:8.1f} connexions/s")
+
+
+if __name__ == '__main__':
+    _benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 64)
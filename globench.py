@@ -0,0 +1,469 @@
+"""\
+Banc d'essai de charge du serveur.
+
+Lance un serveur local dans un dossier temporaire, ou vise un serveur
+existant, puis simule des utilisateurs concurrents qui enchaînent des
+opérations tirées selon un mélange pondéré: création de compte, connexion,
+envoi, liste, lecture et statistiques. Affiche le débit et les latences
+p50/p95/p99 par entête, ou les écrit en JSON pour comparer deux versions.
+
+Les scénarios de débit lancent le serveur sans limites de débit; le
+scénario "abusive" garde ses limites et ajoute des clients qui inondent le
+serveur de requêtes, pour mesurer la latence des autres utilisateurs.
+
+Exemples:
+    python globench.py --users 32 --duration 10
+    python globench.py --scenario large-inbox --json resultats.json
+    python globench.py --scenario slow-clients -- --engine asyncio
+    python globench.py --scenario abusive -- --no-rate-limit
+"""
+import argparse
+import json
+import os
+import random
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+import gloclient
+import glocodec
+import gloutils
+
+_PASSWORD = "MotDePasse123"
+_OPERATIONS = ("register", "login", "send", "list", "read", "stats",
+               "search")
+
+_NO_LIMITS = ["--no-rate-limit"]
+_FLOOD_DEPTH = 32
+
+SCENARIOS: Dict[str, Dict[str, object]] = {
+    "mixed": {"mix": "register=1,login=4,send=30,list=30,read=25,stats=10",
+              "server_args": _NO_LIMITS},
+    "large-inbox": {"mix": "list=40,read=40,search=10,stats=10",
+                    "inbox_size": 2000, "server_args": _NO_LIMITS},
+    "large-body": {"mix": "send=50,read=40,list=10",
+                   "body_size": 256 * 1024, "inbox_size": 20,
+                   "server_args": _NO_LIMITS},
+    "slow-clients": {"mix": "send=30,list=35,read=25,stats=10",
+                     "slow_clients": 16, "server_args": _NO_LIMITS},
+    "abusive": {"mix": "list=40,read=30,stats=20,search=10",
+                "inbox_size": 100, "flooders": 4, "think_time": 0.05},
+}
+
+
+class Recorder:
+    """Latences des requêtes et nombre d'erreurs par entête, partagés par
+    les utilisateurs simulés."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def reset(self) -> None:
+        """Oublie les requêtes enregistrées."""
+        with self._lock:
+            self.latencies.clear()
+            self.errors.clear()
+
+    def record(self, header: gloutils.Headers, latency: float,
+               ok: bool) -> None:
+        """Enregistre une requête de `latency` secondes."""
+        with self._lock:
+            self.latencies.setdefault(header.name, []).append(latency)
+            if not ok:
+                self.errors[header.name] = self.errors.get(header.name, 0) + 1
+
+    def report(self, elapsed: float) -> Dict[str, Dict[str, float]]:
+        """Débit et latences, en millisecondes, de chaque entête."""
+        report = {}
+        with self._lock:
+            for name, latencies in sorted(self.latencies.items()):
+                latencies = sorted(latencies)
+                report[name] = {
+                    "count": len(latencies),
+                    "errors": self.errors.get(name, 0),
+                    "throughput": len(latencies) / elapsed,
+                    "mean_ms": sum(latencies) / len(latencies) * 1e3,
+                    "p50_ms": _percentile(latencies, 50) * 1e3,
+                    "p95_ms": _percentile(latencies, 95) * 1e3,
+                    "p99_ms": _percentile(latencies, 99) * 1e3,
+                    "max_ms": latencies[-1] * 1e3,
+                }
+        return report
+
+
+def _percentile(ordered: Sequence[float], percent: float) -> float:
+    """Centile `percent` de `ordered` trié, par la méthode du rang le plus
+    proche."""
+    rank = max(int(len(ordered) * percent / 100 + 0.5), 1)
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class User:
+    """
+    Utilisateur simulé, connecté au serveur par sa propre connexion, qui
+    envoie ses requêtes l'une après l'autre.
+    """
+
+    def __init__(self, options: argparse.Namespace, number: int,
+                 recorder: Recorder) -> None:
+        self._options = options
+        self._recorder = recorder
+        self._random = random.Random(number)
+        self.username = f"bench{number}-{os.getpid()}"
+        self._connection = self._connect()
+        self._shown = (0, 0)
+        self._registered = 0
+
+    def _connect(self) -> gloclient.GloConnection:
+        return gloclient.GloConnection(self._options.host, self._options.port,
+                                       binary=self._options.binary,
+                                       compress=self._options.compress)
+
+    def _call(self, header: gloutils.Headers, payload: Optional[dict] = None,
+              connection: Optional[gloclient.GloConnection] = None
+              ) -> gloutils.GloMessage:
+        """Envoie une requête, attend sa réponse et enregistre sa latence."""
+        start = time.perf_counter()
+        reply = (connection or self._connection).call(header, payload)
+        self._recorder.record(header, time.perf_counter() - start,
+                              reply["header"] == gloutils.Headers.OK)
+        return reply
+
+    def setup(self) -> None:
+        """Crée le compte de l'utilisateur, en réessayant si le serveur est
+        occupé."""
+        auth = gloutils.AuthPayload(username=self.username, password=_PASSWORD)
+        while self._call(gloutils.Headers.AUTH_REGISTER, auth)["header"] \
+                != gloutils.Headers.OK:
+            time.sleep(0.05)
+
+    def fill_inbox(self, count: int) -> None:
+        """Remplit la boîte de l'utilisateur de `count` courriels."""
+        for start in range(0, count, gloutils.BATCH_MAX_RECIPIENTS // 2):
+            emails = [self._email(self.username)
+                      for _ in range(min(gloutils.BATCH_MAX_RECIPIENTS // 2,
+                                         count - start))]
+            self._call(gloutils.Headers.EMAIL_BATCH_SENDING,
+                       gloutils.EmailBatchPayload(emails=emails))
+
+    def _email(self, recipient: str) -> gloutils.EmailContentPayload:
+        return gloutils.EmailContentPayload(
+            sender=self.username,
+            destination=f"{recipient}@{gloutils.SERVER_DOMAIN}",
+            subject="Banc d'essai %d" % self._random.randrange(10 ** 6),
+            date=gloutils.get_current_utc_time(),
+            content="x" * self._options.body_size)
+
+    def run(self, operations: List[str], weights: List[float],
+            usernames: List[str], deadline: float) -> None:
+        """Enchaîne des opérations tirées au hasard jusqu'à `deadline`."""
+        while time.monotonic() < deadline:
+            operation = self._random.choices(operations, weights)[0]
+            getattr(self, "_" + operation)(usernames)
+            if self._options.think_time:
+                time.sleep(self._options.think_time)
+        self._connection.notify(gloutils.Headers.BYE)
+        self._connection.close()
+
+    def _register(self, _: List[str]) -> None:
+        # a throwaway account, on its own connection
+        self._registered += 1
+        with self._connect() as connection:
+            self._call(gloutils.Headers.AUTH_REGISTER, gloutils.AuthPayload(
+                username=f"{self.username}-{self._registered}",
+                password=_PASSWORD), connection)
+
+    def _login(self, _: List[str]) -> None:
+        self._call(gloutils.Headers.AUTH_LOGIN, gloutils.AuthPayload(
+            username=self.username, password=_PASSWORD))
+
+    def _send(self, usernames: List[str]) -> None:
+        self._call(gloutils.Headers.EMAIL_SENDING,
+                   self._email(self._random.choice(usernames)))
+
+    def _list(self, _: List[str]) -> None:
+        reply = self._call(gloutils.Headers.INBOX_PAGE_REQUEST,
+                           gloutils.InboxPageRequestPayload(
+                               offset=0, limit=gloutils.INBOX_PAGE_SIZE))
+        if reply["header"] == gloutils.Headers.OK:
+            page = reply["payload"]
+            self._shown = (page["offset"], len(page["email_list"]))
+
+    def _read(self, usernames: List[str]) -> None:
+        offset, count = self._shown
+        if not count:
+            self._list(usernames)
+            offset, count = self._shown
+            if not count:
+                return
+        choice = offset + self._random.randrange(count) + 1
+        self._call(gloutils.Headers.INBOX_READING_CHOICE,
+                   gloutils.EmailChoicePayload(choice=choice))
+
+    def _stats(self, _: List[str]) -> None:
+        self._call(gloutils.Headers.STATS_REQUEST)
+
+    def _search(self, _: List[str]) -> None:
+        # every subject contains "essai", a number matches few emails
+        query = self._random.choice(
+            ["essai", "essai %d" % self._random.randrange(10 ** 6)])
+        reply = self._call(gloutils.Headers.SEARCH_REQUEST,
+                           gloutils.SearchPayload(
+                               query=query, limit=gloutils.INBOX_PAGE_SIZE))
+        if reply["header"] == gloutils.Headers.OK:
+            self._shown = (0, len(reply["payload"]["email_list"]))
+
+
+def _slow_client(options: argparse.Namespace, deadline: float,
+                 completed: List[int]) -> None:
+    """
+    Client lent: envoie ses requêtes un octet à la fois, toutes les
+    `slow_delay` secondes, et laisse la dernière incomplète.
+    """
+    message = gloutils.GloMessage(
+        header=gloutils.Headers.AUTH_LOGIN,
+        payload=gloutils.AuthPayload(username="absent", password=_PASSWORD))
+    data = glocodec.JSON.encode(message)
+    frame = struct.pack("!I", len(data)) + data
+    with socket.create_connection((options.host, options.port)) as sock:
+        while time.monotonic() < deadline:
+            for byte in range(len(frame)):
+                if time.monotonic() >= deadline:
+                    return
+                sock.sendall(frame[byte:byte + 1])
+                time.sleep(options.slow_delay)
+            sock.recv(65536)
+            completed[0] += 1
+
+
+def _flooder(options: argparse.Namespace, number: int, deadline: float,
+             completed: List[int]) -> None:
+    """
+    Client abusif: envoie ses requêtes par rafales de `_FLOOD_DEPTH` sans
+    attendre leurs réponses, sans pause.
+    """
+    with gloclient.GloConnection(options.host, options.port,
+                                 binary=options.binary) as connection:
+        connection.call(gloutils.Headers.AUTH_REGISTER, gloutils.AuthPayload(
+            username=f"flood{number}-{os.getpid()}", password=_PASSWORD))
+        requests = [
+            (gloutils.Headers.INBOX_PAGE_REQUEST,
+             gloutils.InboxPageRequestPayload(
+                 offset=0, limit=gloutils.INBOX_PAGE_SIZE)),
+            (gloutils.Headers.STATS_REQUEST, None),
+            (gloutils.Headers.SEARCH_REQUEST,
+             gloutils.SearchPayload(query="essai"))]
+        while time.monotonic() < deadline:
+            replies = connection.call_many(
+                requests[i % len(requests)] for i in range(_FLOOD_DEPTH))
+            completed[0] += len(replies)
+
+
+def _start_server(options: argparse.Namespace, directory: str
+                  ) -> subprocess.Popen:
+    """Lance TP4_server.py dans `directory` et attend qu'il écoute."""
+    server = subprocess.Popen(
+        [sys.executable,
+         os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "TP4_server.py")] + options.server_args,
+        cwd=directory, stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection((options.host, options.port)).close()
+            return server
+        except ConnectionRefusedError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("Le serveur n'a pas démarré.")
+
+
+def _parse_mix(mix: str) -> Dict[str, float]:
+    """Analyse un mélange de la forme "send=30,list=20"."""
+    weights = {}
+    for item in mix.split(","):
+        operation, _, weight = item.partition("=")
+        if operation not in _OPERATIONS:
+            raise ValueError(f"Opération inconnue : {operation}")
+        weights[operation] = float(weight)
+    return weights
+
+
+def run(options: argparse.Namespace) -> dict:
+    """Exécute le banc d'essai et retourne ses résultats."""
+    weights = _parse_mix(options.mix)
+    recorder = Recorder()
+    users = [User(options, number, recorder) for number in range(options.users)]
+    usernames = [user.username for user in users]
+    _run_all([user.setup for user in users])
+    if options.inbox_size:
+        _run_all([lambda user=user: user.fill_inbox(options.inbox_size)
+                  for user in users])
+    # setup requests are not part of the measurement
+    recorder.reset()
+    start = time.monotonic()
+    deadline = start + options.duration
+    completed = [0]
+    flooded = [0]
+    slow = [threading.Thread(target=_slow_client,
+                             args=(options, deadline, completed), daemon=True)
+            for _ in range(options.slow_clients)]
+    slow += [threading.Thread(target=_flooder,
+                              args=(options, number, deadline, flooded),
+                              daemon=True)
+             for number in range(options.flooders)]
+    for thread in slow:
+        thread.start()
+    _run_all([lambda user=user: user.run(list(weights), list(weights.values()),
+                                         usernames, deadline)
+              for user in users])
+    elapsed = time.monotonic() - start
+    for thread in slow:
+        thread.join()
+    headers = recorder.report(elapsed)
+    total = sum(header["count"] for header in headers.values())
+    return {
+        "config": {key: value for key, value in vars(options).items()
+                   if key not in ("json", "external")},
+        "elapsed": elapsed,
+        "throughput": total / elapsed,
+        "requests": total,
+        "errors": sum(header["errors"] for header in headers.values()),
+        "slow_requests": completed[0],
+        "flood_requests": flooded[0],
+        "headers": headers,
+    }
+
+
+def _run_all(tasks: List) -> None:
+    """Exécute chaque tâche dans son fil d'exécution et attend leur fin."""
+    threads = [threading.Thread(target=task) for task in tasks]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _print_report(results: dict) -> None:
+    print(f"{'entête':<24}{'requêtes':>9}{'erreurs':>9}{'req/s':>10}"
+          f"{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}{'max (ms)':>10}")
+    for name, header in results["headers"].items():
+        print(f"{name:<24}{header['count']:>9}{header['errors']:>9}"
+              f"{header['throughput']:>10.1f}{header['p50_ms']:>10.2f}"
+              f"{header['p95_ms']:>10.2f}{header['p99_ms']:>10.2f}"
+              f"{header['max_ms']:>10.2f}")
+    print(f"Total : {results['requests']} requêtes en {results['elapsed']:.1f}"
+          f" s, {results['throughput']:.1f} req/s,"
+          f" {results['errors']} erreurs")
+    if results["config"]["slow_clients"]:
+        print(f"Clients lents : {results['slow_requests']} requêtes terminées")
+    if results["config"]["flooders"]:
+        print(f"Clients abusifs : {results['flood_requests']} requêtes"
+              " terminées")
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--scenario", action="store",
+                        dest="scenario", choices=tuple(SCENARIOS),
+                        default="mixed",
+                        help="Scénario fixant les valeurs par défaut.")
+    parser.add_argument("-u", "--users", action="store",
+                        dest="users", type=int, default=16,
+                        help="Nombre d'utilisateurs concurrents.")
+    parser.add_argument("-t", "--duration", action="store",
+                        dest="duration", type=float, default=10,
+                        help="Durée de la mesure, en secondes.")
+    parser.add_argument("-m", "--mix", action="store",
+                        dest="mix", default=None,
+                        help="Poids des opérations, par exemple"
+                             " \"send=30,list=30,read=30,stats=10\" ("
+                             + ", ".join(_OPERATIONS) + ").")
+    parser.add_argument("--body-size", action="store",
+                        dest="body_size", type=int, default=None,
+                        help="Taille du corps des courriels envoyés.")
+    parser.add_argument("--inbox-size", action="store",
+                        dest="inbox_size", type=int, default=None,
+                        help="Courriels déposés dans chaque boîte avant la"
+                             " mesure.")
+    parser.add_argument("--slow-clients", action="store",
+                        dest="slow_clients", type=int, default=None,
+                        help="Clients envoyant leurs requêtes octet par"
+                             " octet.")
+    parser.add_argument("--slow-delay", action="store",
+                        dest="slow_delay", type=float, default=0.05,
+                        help="Secondes entre deux octets d'un client lent.")
+    parser.add_argument("--flooders", action="store",
+                        dest="flooders", type=int, default=None,
+                        help="Clients envoyant des rafales de requêtes sans"
+                             " attendre leurs réponses.")
+    parser.add_argument("--think-time", action="store",
+                        dest="think_time", type=float, default=None,
+                        help="Secondes d'attente d'un utilisateur entre deux"
+                             " opérations.")
+    parser.add_argument("-b", "--binary", action="store_true",
+                        dest="binary",
+                        help="Négocie l'encodage binaire.")
+    parser.add_argument("-z", "--compress", action="store_true",
+                        dest="compress",
+                        help="Négocie la compression.")
+    parser.add_argument("-d", "--destination", action="store",
+                        dest="host", default="127.0.0.1",
+                        help="Adresse du serveur.")
+    parser.add_argument("--external", action="store_true",
+                        dest="external",
+                        help="Vise un serveur déjà lancé au lieu d'en lancer"
+                             " un.")
+    parser.add_argument("--json", action="store",
+                        dest="json", default=None,
+                        help="Fichier où écrire les résultats en JSON"
+                             " (- pour la sortie standard).")
+    parser.add_argument("server_args", nargs="*",
+                        help="Arguments du serveur lancé, après --.")
+    args = parser.parse_args(sys.argv[1:])
+    args.port = gloutils.APP_PORT
+    defaults = {"mix": SCENARIOS["mixed"]["mix"], "body_size": 1024,
+                "inbox_size": 0, "slow_clients": 0, "flooders": 0,
+                "think_time": 0}
+    defaults.update(SCENARIOS[args.scenario])
+    args.server_args = defaults.pop("server_args", []) + args.server_args
+    for key, value in defaults.items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+    try:
+        _parse_mix(args.mix)
+    except ValueError as ex:
+        parser.error(str(ex))
+
+    server = None
+    with tempfile.TemporaryDirectory(prefix="globench-") as directory:
+        if not args.external:
+            server = _start_server(args, directory)
+        try:
+            results = run(args)
+        finally:
+            if server is not None:
+                server.send_signal(signal.SIGINT)
+                server.wait()
+    if args.json == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        _print_report(results)
+        if args.json:
+            with open(args.json, "w") as file:
+                json.dump(results, file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
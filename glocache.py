@@ -0,0 +1,75 @@
+"""\
+Module fournissant un cache LRU borné en nombre d'entrées et en mémoire
+pour les données lues par le serveur.
+"""
+import collections
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+class LRUCache:
+    """
+    Cache associatif évinçant les entrées les moins récemment utilisées.
+
+    Chaque entrée est ajoutée avec une taille estimée en octets; le cache
+    ne dépasse jamais `max_entries` entrées ni `max_bytes` octets. Les
+    compteurs `hits`, `misses` et `evictions` permettent de le dimensionner.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int) -> None:
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries: "collections.OrderedDict[Hashable, Tuple[Any, int]]" \
+            = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def nbytes(self) -> int:
+        """Taille estimée des entrées en cache."""
+        return self._bytes
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Retourne la valeur associée à `key`, ou None si absente."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int) -> None:
+        """
+        Associe `value` à `key` puis évince les entrées les plus anciennes
+        jusqu'à respecter les limites. Une valeur plus grande que la limite
+        de mémoire n'est pas conservée.
+        """
+        self.invalidate(key)
+        if size > self._max_bytes or self._max_entries <= 0:
+            return
+        self._entries[key] = (value, size)
+        self._bytes += size
+        while (len(self._entries) > self._max_entries
+               or self._bytes > self._max_bytes):
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> bool:
+        """Retire `key` du cache. Retourne True si elle y était."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._bytes -= entry[1]
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        """Compteurs d'utilisation du cache."""
+        return {"entries": len(self._entries), "bytes": self._bytes,
+                "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
@@ -0,0 +1,176 @@
+"""\
+Module fournissant une connexion programmatique au serveur, capable de
+garder plusieurs requêtes en vol.
+
+Chaque requête est étiquetée d'un `request_id`; les réponses sont
+associées à leur requête par cette étiquette, quel que soit leur ordre
+d'arrivée. Une suite d'opérations scriptée ne paie donc plus un aller-
+retour réseau par requête.
+
+Les courriels peuvent aussi être envoyés et lus par morceaux
+(`send_stream` et `receive_stream`), sans jamais tenir leur corps entier
+en mémoire.
+"""
+import collections
+import itertools
+import select
+import socket
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import glocodec
+import glosocket
+import gloutils
+
+
+_STREAM_PARTS = (gloutils.Headers.EMAIL_STREAM_BEGIN,
+                 gloutils.Headers.EMAIL_STREAM_CHUNK)
+
+
+class GloConnection:
+    """
+    Connexion au serveur envoyant les requêtes sans attendre leur réponse.
+
+    Au plus `max_in_flight` requêtes restent sans réponse: au-delà, `send`
+    lit d'abord des réponses. Avec `binary` et `compress`, l'encodage
+    binaire et la compression sont négociés à la connexion.
+    """
+
+    def __init__(self, destination: str, port: int = gloutils.APP_PORT,
+                 binary: bool = False, compress: bool = False,
+                 max_in_flight: int = 128) -> None:
+        self._socket = socket.create_connection((destination, port))
+        self._reader = glosocket.FrameReader()
+        self._codec: glocodec.Codec = glocodec.JSON
+        self._compress_threshold: Optional[int] = None
+        self._max_in_flight = max_in_flight
+        self._ids = itertools.count(1)
+        self._in_flight = 0
+        self._received: Dict[int, Deque[gloutils.GloMessage]] = {}
+        if binary or compress:
+            self._negotiate(binary, compress)
+
+    def __enter__(self) -> "GloConnection":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Ferme la connexion."""
+        self._socket.close()
+
+    def _negotiate(self, binary: bool, compress: bool) -> None:
+        """Négocie l'encodage et la compression des messages suivants."""
+        encodings = [glocodec.JSON.name]
+        if binary:
+            encodings.insert(0, glocodec.BINARY.name)
+        reply = self.call(gloutils.Headers.HELLO, gloutils.HelloPayload(
+            encodings=encodings,
+            compression=[glosocket.COMPRESSION] if compress else []))
+        if reply["header"] != gloutils.Headers.OK:
+            return
+        self._codec = glocodec.CODECS.get(reply["payload"]["encodings"][0],
+                                          glocodec.JSON)
+        if glosocket.COMPRESSION in reply["payload"]["compression"]:
+            self._compress_threshold = glosocket.COMPRESS_THRESHOLD
+
+    def send(self, header: gloutils.Headers,
+             payload: Optional[dict] = None) -> int:
+        """Envoie une requête et retourne son étiquette."""
+        while self._in_flight >= self._max_in_flight:
+            self._receive()
+        # read replies already there so the server never blocks on us
+        while select.select([self._socket], [], [], 0)[0]:
+            self._receive()
+        request_id = next(self._ids)
+        self._send(header, payload, request_id)
+        self._in_flight += 1
+        return request_id
+
+    def notify(self, header: gloutils.Headers,
+               payload: Optional[dict] = None) -> None:
+        """
+        Envoie une requête à laquelle le serveur ne répond pas, comme
+        AUTH_LOGOUT ou BYE.
+        """
+        self._send(header, payload, None)
+
+    def _send(self, header: gloutils.Headers, payload: Optional[dict],
+              request_id: Optional[int]) -> None:
+        message = gloutils.GloMessage(header=header)
+        if request_id is not None:
+            message["request_id"] = request_id
+        if payload is not None:
+            message["payload"] = payload
+        glosocket.send_mesg(self._socket, self._codec.encode(message),
+                            self._compress_threshold)
+
+    def _receive(self) -> None:
+        """
+        Effectue une lecture et range les réponses complétées selon leur
+        étiquette. Lève une exception GLOSocketError si la connexion est
+        fermée.
+        """
+        for frame in self._reader.recv_from(self._socket):
+            reply = self._codec.decode(frame)
+            self._received.setdefault(reply.pop("request_id"),
+                                      collections.deque()).append(reply)
+            # a transfer by chunks answers with several messages
+            if reply["header"] not in _STREAM_PARTS:
+                self._in_flight -= 1
+
+    def receive(self, request_id: int) -> gloutils.GloMessage:
+        """Attend et retourne la réponse à la requête `request_id`."""
+        while request_id not in self._received:
+            self._receive()
+        replies = self._received[request_id]
+        reply = replies.popleft()
+        if not replies:
+            del self._received[request_id]
+        return reply
+
+    def send_stream(self, payload: gloutils.EmailContentPayload,
+                    chunks: Iterable[str]) -> int:
+        """
+        Envoie un courriel par morceaux: son en-tête, sans contenu, puis
+        chaque morceau de `chunks`, d'au plus STREAM_CHUNK_SIZE caractères.
+        Retourne l'étiquette de la requête EMAIL_STREAM_END, dont la
+        réponse est celle d'un envoi groupé.
+        """
+        self.notify(gloutils.Headers.EMAIL_STREAM_BEGIN,
+                    gloutils.EmailContentPayload(payload, content=""))
+        for chunk in chunks:
+            for start in range(0, len(chunk), gloutils.STREAM_CHUNK_SIZE):
+                self.notify(gloutils.Headers.EMAIL_STREAM_CHUNK,
+                            gloutils.EmailChunkPayload(data=chunk[
+                                start:start + gloutils.STREAM_CHUNK_SIZE]))
+        return self.send(gloutils.Headers.EMAIL_STREAM_END)
+
+    def receive_stream(self, request_id: int
+                       ) -> Iterator[gloutils.GloMessage]:
+        """
+        Retourne, au fil de leur réception, les messages du transfert par
+        morceaux répondant à la requête `request_id`, jusqu'à
+        EMAIL_STREAM_END ou une erreur.
+        """
+        while True:
+            reply = self.receive(request_id)
+            yield reply
+            if reply["header"] not in _STREAM_PARTS:
+                return
+
+    def call(self, header: gloutils.Headers,
+             payload: Optional[dict] = None) -> gloutils.GloMessage:
+        """Envoie une requête et attend sa réponse."""
+        return self.receive(self.send(header, payload))
+
+    def call_many(self, requests: Iterable[Tuple[gloutils.Headers,
+                                                 Optional[dict]]]
+                  ) -> List[gloutils.GloMessage]:
+        """
+        Envoie toutes les requêtes, avec au plus `max_in_flight` en vol,
+        puis retourne leurs réponses dans l'ordre des requêtes.
+        """
+        request_ids = [self.send(header, payload)
+                       for header, payload in requests]
+        return [self.receive(request_id) for request_id in request_ids]
@@ -0,0 +1,280 @@
+"""\
+Module fournissant les encodages des messages échangés entre le client
+et le serveur: JSON, par défaut, et un encodage binaire compact négocié
+avec l'entête HELLO.
+
+Un message binaire est formé de l'entête sur un octet, suivi de
+l'étiquette `request_id` sur huit octets si le bit de poids fort de
+l'entête est levé, puis du payload s'il y en a un. Chaque valeur est précédée d'un octet de type; les
+chaînes et les listes sont préfixées par leur longueur et les clés des
+dictionnaires sont remplacées par leur numéro dans la table des champs
+des payloads de gloutils.
+"""
+import json
+import struct
+import sys
+import timeit
+import typing
+import zlib
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+import gloutils
+
+ENCODING_JSON = "json"
+
+Buffer = Union[bytes, bytearray]
+
+_U8 = struct.Struct("!B")
+_U32 = struct.Struct("!I")
+_I64 = struct.Struct("!q")
+_FIELD = struct.Struct("!BI")
+_UNKNOWN_FIELD = 255
+_HAS_REQUEST_ID = 0x80
+_FORMAT_VERSION = 2
+
+_NONE, _FALSE, _TRUE, _INT, _STR, _LIST, _DICT, _STR_LIST = b"nftisldS"
+
+
+def _payload_fields() -> List[str]:
+    """
+    Noms des champs de tous les payloads de gloutils, dans un ordre fixe:
+    les deux pairs doivent avoir la même table pour négocier l'encodage.
+    """
+    fields: Dict[str, None] = {}
+    for name in sorted(vars(gloutils)):
+        value = getattr(gloutils, name)
+        if name.endswith("Payload") and typing.is_typeddict(value):
+            fields.update(dict.fromkeys(value.__annotations__))
+    return list(fields)
+
+
+class JsonCodec:
+    """Encodage JSON en UTF-8, compris par tous les clients."""
+
+    name = ENCODING_JSON
+
+    def encode(self, message: gloutils.GloMessage) -> bytes:
+        """Encode un message."""
+        return json.dumps(message).encode("utf-8")
+
+    def decode(self, data: Buffer) -> gloutils.GloMessage:
+        """
+        Décode un message. Lève une exception ValueError si le message est
+        mal formé ou n'est pas un objet JSON.
+        """
+        message = json.loads(data)
+        if not isinstance(message, dict):
+            raise ValueError("Le message n'est pas un objet JSON.")
+        return message
+
+
+class BinaryCodec:
+    """
+    Encodage binaire des messages.
+
+    Son nom contient une empreinte de la table des champs: deux versions
+    dont les payloads diffèrent ne négocient pas cet encodage.
+    """
+
+    def __init__(self) -> None:
+        fields = _payload_fields()
+        if len(fields) >= _UNKNOWN_FIELD:
+            raise ValueError("Trop de champs pour l'encodage binaire.")
+        self._fields = fields
+        self._field_ids = {field: bytes((number,))
+                           for number, field in enumerate(fields)}
+        self.name = "binary%d-%08x" % (_FORMAT_VERSION,
+                                       zlib.crc32("\0".join(fields).encode()))
+
+    def encode(self, message: gloutils.GloMessage) -> bytes:
+        """Encode un message."""
+        if "request_id" in message:
+            parts = [_U8.pack(message["header"] | _HAS_REQUEST_ID),
+                     _I64.pack(message["request_id"])]
+        else:
+            parts = [_U8.pack(message["header"])]
+        if "payload" in message:
+            self._encode_value(message["payload"], parts)
+        return b"".join(parts)
+
+    def _encode_value(self, value: Any, parts: List[bytes]) -> None:
+        """Ajoute l'encodage de `value` à `parts`."""
+        if isinstance(value, str):
+            data = value.encode("utf-8")
+            parts.append(_FIELD.pack(_STR, len(data)))
+            parts.append(data)
+        elif isinstance(value, dict):
+            parts.append(_FIELD.pack(_DICT, len(value)))
+            for key, item in value.items():
+                field_id = self._field_ids.get(key)
+                if field_id is None:
+                    data = key.encode("utf-8")
+                    parts.append(_FIELD.pack(_UNKNOWN_FIELD, len(data)))
+                    parts.append(data)
+                else:
+                    parts.append(field_id)
+                self._encode_value(item, parts)
+        elif value is None:
+            parts.append(b"n")
+        elif value is True:
+            parts.append(b"t")
+        elif value is False:
+            parts.append(b"f")
+        elif isinstance(value, int):
+            parts.append(b"i" + _I64.pack(value))
+        elif isinstance(value, (list, tuple)) and _is_str_list(value):
+            # lists of strings (listings) travel as one NUL-separated
+            # string, split back in a single call
+            data = "\0".join(value).encode("utf-8")
+            parts.append(_FIELD.pack(_STR_LIST, len(data)))
+            parts.append(data)
+        elif isinstance(value, (list, tuple)):
+            parts.append(_FIELD.pack(_LIST, len(value)))
+            for item in value:
+                self._encode_value(item, parts)
+        else:
+            raise TypeError(f"Type non encodable : {type(value).__name__}")
+
+    def decode(self, data: Buffer) -> gloutils.GloMessage:
+        """
+        Décode un message. Lève une exception ValueError si le message est
+        mal formé.
+        """
+        if not data:
+            raise ValueError("Message vide.")
+        message = gloutils.GloMessage(header=data[0] & ~_HAS_REQUEST_ID)
+        position = 1
+        if data[0] & _HAS_REQUEST_ID:
+            if len(data) < 9:
+                raise ValueError("Message binaire mal formé.")
+            message["request_id"], = _I64.unpack_from(data, 1)
+            position = 9
+        if len(data) > position:
+            try:
+                message["payload"], end = self._decode_value(data, position)
+            except (IndexError, KeyError, RecursionError,
+                    UnicodeDecodeError, struct.error) as ex:
+                raise ValueError("Message binaire mal formé.") from ex
+            if end != len(data):
+                raise ValueError("Octets superflus après le message.")
+        return message
+
+    def _decode_value(self, data: bytes, position: int) -> Tuple[Any, int]:
+        """Décode la valeur débutant à `position` et retourne sa fin."""
+        tag = data[position]
+        position += 1
+        if tag == _DICT:
+            count, = _U32.unpack_from(data, position)
+            position += 4
+            value = {}
+            for _ in range(count):
+                field_id = data[position]
+                if field_id == _UNKNOWN_FIELD:
+                    length, = _U32.unpack_from(data, position + 1)
+                    position += 5 + length
+                    key = data[position - length:position].decode("utf-8")
+                else:
+                    key = self._fields[field_id]
+                    position += 1
+                value[key], position = self._decode_value(data, position)
+            return value, position
+        if tag in (_STR, _STR_LIST):
+            length, = _U32.unpack_from(data, position)
+            end = position + 4 + length
+            if end > len(data):
+                raise IndexError(end)
+            text = data[position + 4:end].decode("utf-8")
+            return (text if tag == _STR else text.split("\0")), end
+        if tag == _INT:
+            return _I64.unpack_from(data, position)[0], position + 8
+        if tag == _LIST:
+            count, = _U32.unpack_from(data, position)
+            position += 4
+            items = []
+            for _ in range(count):
+                item, position = self._decode_value(data, position)
+                items.append(item)
+            return items, position
+        if tag == _NONE:
+            return None, position
+        if tag in (_TRUE, _FALSE):
+            return tag == _TRUE, position
+        raise KeyError(tag)
+
+
+def _is_str_list(value: Union[list, tuple]) -> bool:
+    """Vrai si `value` est une liste non vide de chaînes sans caractère NUL."""
+    return (bool(value) and all(isinstance(item, str) for item in value)
+            and "\0" not in "".join(value))
+
+
+Codec = Union[JsonCodec, BinaryCodec]
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+CODECS: Dict[str, Codec] = {JSON.name: JSON, BINARY.name: BINARY}
+
+
+def negotiate(offered: List[str]) -> Codec:
+    """
+    Retourne le premier encodage de `offered`, par ordre de préférence du
+    client, que ce module connaît, ou JSON.
+    """
+    for name in offered:
+        if name in CODECS:
+            return CODECS[name]
+    return JSON
+
+
+def _sample_messages() -> Dict[str, gloutils.GloMessage]:
+    """Messages représentatifs de chaque entête, pour le banc d'essai."""
+    email = gloutils.EmailContentPayload(
+        sender="alice", destination="bob@glo2000.ca",
+        subject="Rapport de la semaine", date=gloutils.get_current_utc_time(),
+        content="Bonjour, voici le résumé des activités.\n" * 40)
+    listing = [gloutils.SUBJECT_DISPLAY.format(
+        number=number, sender="alice", subject="Sujet numéro %d" % number,
+        date=email["date"]) for number in range(1, gloutils.INBOX_PAGE_SIZE + 1)]
+    headers = gloutils.Headers
+    return {
+        "AUTH_LOGIN": gloutils.GloMessage(
+            header=headers.AUTH_LOGIN,
+            payload=gloutils.AuthPayload(username="alice",
+                                         password="MotDePasse123")),
+        "INBOX_PAGE_REQUEST": gloutils.GloMessage(
+            header=headers.INBOX_PAGE_REQUEST,
+            payload=gloutils.InboxPageRequestPayload(offset=0, limit=20)),
+        "OK (page)": gloutils.GloMessage(
+            header=headers.OK,
+            payload=gloutils.InboxPagePayload(
+                email_list=listing, offset=0, total=1000, next_cursor="")),
+        "EMAIL_SENDING": gloutils.GloMessage(header=headers.EMAIL_SENDING,
+                                             payload=email),
+        "STATS (OK)": gloutils.GloMessage(
+            header=headers.OK,
+            payload=gloutils.StatsPayload(count=1000, size=12345678,
+                                          newest_date=email["date"])),
+        "OK": gloutils.GloMessage(header=headers.OK),
+    }
+
+
+def _benchmark(number: int) -> None:
+    """Affiche le coût d'encodage et de décodage par entête et encodage."""
+    print(f"{'message':<20}{'encodage':<18}{'octets':>8}"
+          f"{'encode (µs)':>13}{'decode (µs)':>13}")
+    for label, message in _sample_messages().items():
+        for codec in (JSON, BINARY):
+            data = codec.encode(message)
+            assert codec.decode(data) == json.loads(json.dumps(message))
+            timings: List[float] = []
+            for function in (lambda: codec.encode(message),
+                             lambda: codec.decode(data)):
+                bench: Callable[[], Any] = function
+                timings.append(min(timeit.repeat(bench, number=number,
+                                                 repeat=3)) / number * 1e6)
+            print(f"{label:<20}{codec.name:<18}{len(data):>8}"
+                  f"{timings[0]:>13.2f}{timings[1]:>13.2f}")
+
+
+if __name__ == '__main__':
+    _benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,178 @@
+"""\
+Module fournissant la file de dépôt des courriels du serveur.
+
+Les dépôts sont écrits par des fils d'exécution dédiés qui les regroupent
+pour les synchroniser sur disque ensemble (validation groupée): le coût
+des fsync est partagé entre tous les courriels d'un même lot. Les
+courriels destinés à des utilisateurs inexistants sont confiés au dossier
+des courriels perdus (voir glolost).
+"""
+import concurrent.futures
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import glolost
+import glostorage
+import gloutils
+
+_logger = logging.getLogger("glodelivery")
+
+
+class _Job(NamedTuple):
+    """Dépôts demandés par une requête, terminés ensemble."""
+    mailboxes: Dict[str, List[gloutils.EmailContentPayload]]
+    lost: List[Tuple[str, gloutils.EmailContentPayload]]
+    future: concurrent.futures.Future
+
+
+class DeliveryQueue:
+    """
+    File bornée de dépôts vidée par `writers` fils d'écriture.
+
+    Chaque fil prend un dépôt puis, si d'autres dépôts sont en cours,
+    attend jusqu'à `max_delay` secondes d'autres dépôts, au plus
+    `max_batch`. Il écrit le lot en regroupant les courriels par boîte et
+    synchronise enfin sur disque tous les fichiers et dossiers touchés. Le
+    résultat d'un dépôt n'est disponible qu'une fois le courriel durable.
+    Un dépôt isolé n'attend donc pas.
+
+    La file contient au plus `max_depth` dépôts: au-delà, `submit` bloque
+    jusqu'à ce qu'une place se libère.
+    """
+
+    def __init__(self, store: glostorage.MailStore, lost: glolost.LostMail,
+                 max_depth: int = 1024, max_delay: float = 0.005,
+                 writers: int = 2, max_batch: int = 256) -> None:
+        self._store = store
+        self._lost = lost
+        self._queue: "queue.Queue[Optional[_Job]]" = queue.Queue(max_depth)
+        self._max_delay = max_delay
+        self._max_batch = max_batch
+        self._stats_lock = threading.Lock()
+        self._in_flight = 0
+        self.batches = 0
+        self.jobs = 0
+        self.syncs = 0
+        self._threads = [threading.Thread(target=self._write_forever,
+                                          daemon=True)
+                         for _ in range(writers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, mailboxes: Dict[str, List[gloutils.EmailContentPayload]],
+               lost: Sequence[Tuple[str, gloutils.EmailContentPayload]] = ()
+               ) -> concurrent.futures.Future:
+        """
+        Demande le dépôt des courriels de chaque boîte de `mailboxes` et
+        l'écriture des courriels `lost` dans le dossier des courriels
+        perdus de leur destinataire.
+
+        Retourne un Future terminé lorsque tous ces courriels sont
+        durables, ou en erreur si l'un d'eux n'a pu être écrit.
+        """
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        with self._stats_lock:
+            self._in_flight += 1
+        self._queue.put(_Job(mailboxes, list(lost), future))
+        return future
+
+    def close(self) -> None:
+        """Termine les dépôts en attente puis arrête les fils d'écriture."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self) -> Dict[str, int]:
+        """Compteurs de la file: lots, dépôts et fichiers synchronisés."""
+        return {"batches": self.batches, "jobs": self.jobs,
+                "syncs": self.syncs, "queued": self._queue.qsize()}
+
+    def _write_forever(self) -> None:
+        """Boucle d'un fil d'écriture, jusqu'à la réception de None."""
+        running = True
+        while running:
+            job = self._queue.get()
+            if job is None:
+                return
+            batch = [job]
+            deadline = time.monotonic() + self._max_delay
+            while len(batch) < self._max_batch:
+                # wait for more only while other deliveries are under way
+                with self._stats_lock:
+                    waiting = self._in_flight > len(batch)
+                try:
+                    job = self._queue.get(
+                        timeout=max(0, deadline - time.monotonic())
+                        if waiting else 0)
+                except queue.Empty:
+                    break
+                if job is None:
+                    running = False
+                    break
+                batch.append(job)
+            self._write(batch)
+
+    def _write(self, batch: List[_Job]) -> None:
+        """
+        Écrit puis synchronise un lot et termine ses dépôts. Une erreur,
+        même inattendue, ne termine en échec que les dépôts qu'elle touche:
+        le fil d'écriture continue.
+        """
+        mailboxes: Dict[str, List[gloutils.EmailContentPayload]] = {}
+        for job in batch:
+            for username, payloads in job.mailboxes.items():
+                mailboxes.setdefault(username, []).extend(payloads)
+        # paths in insertion order, without duplicates
+        paths: Dict[str, None] = {}
+        errors: Dict[str, Exception] = {}
+        for username, payloads in mailboxes.items():
+            try:
+                paths.update(dict.fromkeys(
+                    self._store.deliver(username, payloads)))
+            except Exception as error:
+                _logger.error("Failed to deliver to %s: %s", username, error)
+                errors[username] = error
+        lost_errors: Dict[int, Exception] = {}
+        for number, job in enumerate(batch):
+            for recipient, payload in job.lost:
+                try:
+                    paths.update(dict.fromkeys(
+                        self._lost.write(recipient, payload)))
+                except Exception as error:
+                    _logger.error("Failed to keep lost email: %s", error)
+                    lost_errors[number] = error
+        try:
+            # file contents first, then the directory entries naming them
+            for path in sorted(paths, key=os.path.isdir):
+                _fsync(path)
+        except Exception as error:
+            for job in batch:
+                job.future.set_exception(error)
+            return
+        finally:
+            with self._stats_lock:
+                self._in_flight -= len(batch)
+                self.batches += 1
+                self.jobs += len(batch)
+                self.syncs += len(paths)
+        for number, job in enumerate(batch):
+            error = next((errors[username] for username in job.mailboxes
+                          if username in errors), lost_errors.get(number))
+            if error is None:
+                job.future.set_result(None)
+            else:
+                job.future.set_exception(error)
+
+
+def _fsync(path: str) -> None:
+    """Synchronise sur disque le fichier ou le dossier `path`."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,477 @@
+"""\
+Importe en masse des boîtes mbox ou Maildir dans les boîtes des
+utilisateurs du serveur.
+
+Chaque source est lue au fil de l'eau par une chaîne de générateurs qui
+découpent les courriels, les analysent puis les regroupent par lots: une
+source n'est jamais chargée en mémoire. Les lots sont déposés directement
+dans le stockage du serveur et synchronisés sur disque comme par la file
+de dépôt ou, avec --server, envoyés par EMAIL_BATCH_SENDING sur une
+connexion authentifiée. Les sources sont réparties entre plusieurs
+processus; la progression et le débit sont affichés pendant l'import.
+
+Les utilisateurs doivent exister. Chaque courriel importé est destiné à
+l'adresse de son utilisateur; son expéditeur, son sujet et sa date sont
+tirés de ses en-têtes.
+
+Avec --server, les limites de débit du serveur s'appliquent au compte
+importateur: par défaut, 4 requêtes EMAIL_BATCH_SENDING par seconde, soit
+au plus 4 000 courriels par seconde, et autant de gros courriels
+transférés par morceaux (EMAIL_STREAM_BEGIN). Pour un import en masse,
+lancer le serveur avec --no-rate-limit, ou retirer ces seules limites par
+un débit nul:
+    python TP4_server.py --rate-limit EMAIL_BATCH_SENDING=0
+        --user-rate-limit EMAIL_BATCH_SENDING=0
+        --rate-limit EMAIL_STREAM_BEGIN=0
+        --user-rate-limit EMAIL_STREAM_BEGIN=0
+
+Exemples:
+    python gloimport.py alice=/var/mail/alice bob=/home/bob/Maildir
+    python gloimport.py --workers 8 alice=alice.mbox bob=bob.mbox
+    python gloimport.py --server 127.0.0.1 --login import alice=alice.mbox
+"""
+import argparse
+import binascii
+import collections
+import concurrent.futures
+import datetime
+import email.errors
+import email.header
+import email.utils
+import functools
+import getpass
+import multiprocessing
+import os
+import quopri
+import re
+import sys
+import time
+from typing import Deque, Iterable, Iterator, List, NamedTuple, Optional
+
+import gloclient
+import glosocket
+import glostorage
+import gloutils
+
+_READ_SIZE = 1024 * 1024
+_BATCH_SIZE = 1000
+_BATCH_BYTES = 4 * 1024 * 1024
+_IN_FLIGHT = 4
+_HEADERS = (b"from", b"subject", b"date", b"content-type",
+            b"content-transfer-encoding")
+_LOGICAL_LINE = re.compile(rb"\n(?![ \t])")
+_CHARSET = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.IGNORECASE)
+_ADDRESS = re.compile(r"(?:[^<>\"]*<)?([^<>\"\s]+@[^<>\"\s]+)>?")
+
+
+class Options(NamedTuple):
+    """Destination des courriels importés, commune à tous les processus."""
+    search: bool
+    server: Optional[str]
+    login: str
+    password: str
+    binary: bool
+    compress: bool
+
+
+class Source(NamedTuple):
+    """Boîte mbox ou dossier Maildir à importer pour `username`."""
+    username: str
+    path: str
+
+
+class Result(NamedTuple):
+    """Bilan de l'import d'une source."""
+    source: Source
+    imported: int
+    rejected: int
+    error: str
+
+
+# set in each worker process by _init_worker
+_progress: Optional["multiprocessing.sharedctypes.Synchronized"] = None
+_options: Optional[Options] = None
+_store: Optional[glostorage.MailStore] = None
+
+
+def mbox_messages(path: str) -> Iterator[bytes]:
+    """
+    Courriels bruts d'une boîte mbox, lus ligne par ligne. Chaque courriel
+    commence par une ligne "From ", qui est retirée; les lignes ">From "
+    de son corps perdent leur premier ">" (mboxrd). Un fichier sans ligne
+    "From " est un seul courriel.
+    """
+    with open(path, "rb", buffering=_READ_SIZE) as file:
+        lines: List[bytes] = []
+        for line in file:
+            if line.startswith(b"From "):
+                if lines:
+                    yield _mbox_message(lines)
+                lines = []
+                continue
+            if line.startswith(b">") and line.lstrip(b">").startswith(b"From "):
+                line = line[1:]
+            lines.append(line)
+        if lines:
+            yield _mbox_message(lines)
+
+
+def _mbox_message(lines: List[bytes]) -> bytes:
+    data = b"".join(lines)
+    # the blank line separating it from the next message
+    return data[:-1] if data.endswith(b"\n\n") else data
+
+
+def maildir_messages(path: str) -> Iterator[bytes]:
+    """
+    Courriels bruts d'un dossier Maildir: ceux de cur puis ceux de new,
+    dans l'ordre de leurs noms, qui commencent par leur date de réception.
+    """
+    for subdir in ("cur", "new"):
+        directory = path + "/" + subdir
+        for name in sorted(os.listdir(directory)):
+            if name.startswith("."):
+                continue
+            with open(directory + "/" + name, "rb") as file:
+                yield file.read()
+
+
+def messages(path: str) -> Iterator[bytes]:
+    """Courriels bruts de la source `path`, mbox ou Maildir."""
+    if not os.path.isdir(path):
+        return mbox_messages(path)
+    if os.path.isdir(path + "/cur") and os.path.isdir(path + "/new"):
+        return maildir_messages(path)
+    raise ValueError(f"{path} n'est ni une boîte mbox ni un dossier Maildir")
+
+
+def parse_message(raw: bytes, destination: str
+                  ) -> gloutils.EmailContentPayload:
+    """
+    Convertit un courriel brut au format RFC 5322 en courriel destiné à
+    `destination`. Les en-têtes encodés sont décodés, tout comme le corps
+    d'un courriel simple encodé en base64 ou en quoted-printable; le corps
+    d'un courriel multipart est conservé tel quel.
+    """
+    if b"\r" in raw:
+        raw = raw.replace(b"\r\n", b"\n")
+    head, _, body = raw.partition(b"\n\n")
+    headers = {}
+    for line in _LOGICAL_LINE.split(head):
+        name, colon, value = line.partition(b":")
+        name = name.strip().lower()
+        if colon and name in _HEADERS and name not in headers:
+            headers[name] = _header_text(value)
+    return gloutils.EmailContentPayload(
+        sender=_sender(headers.get(b"from", "")), destination=destination,
+        subject=headers.get(b"subject", ""),
+        date=_date(headers.get(b"date")),
+        content=_body_text(body, headers.get(b"content-type", ""),
+                           headers.get(b"content-transfer-encoding", "")))
+
+
+def _header_text(value: bytes) -> str:
+    """Valeur d'un en-tête sur une seule ligne, mots encodés décodés."""
+    text = value.decode("utf-8", "replace")
+    if "=?" in text:
+        try:
+            text = str(email.header.make_header(
+                email.header.decode_header(text)))
+        except (email.errors.HeaderParseError, LookupError, UnicodeError):
+            pass
+    return " ".join(text.split())
+
+
+@functools.lru_cache(maxsize=4096)
+def _sender(value: str) -> str:
+    """Adresse d'un en-tête From; une boîte n'a que quelques expéditeurs
+    fréquents, dont l'adresse n'est extraite qu'une fois."""
+    match = _ADDRESS.fullmatch(value)
+    address = match.group(1) if match else email.utils.parseaddr(value)[1]
+    # part of the file name in the files storage
+    return (address or value).replace("/", "_")
+
+
+def _date(value: Optional[str]) -> str:
+    """Date d'un en-tête Date au format du serveur, ou l'heure courante."""
+    if value:
+        try:
+            moment = email.utils.parsedate_to_datetime(value)
+            if moment.tzinfo is None:
+                moment = moment.replace(tzinfo=datetime.timezone.utc)
+            return gloutils.format_utc_time(moment)
+        except (TypeError, ValueError, IndexError, OverflowError):
+            pass
+    return gloutils.get_current_utc_time()
+
+
+def _body_text(body: bytes, content_type: str, encoding: str) -> str:
+    """Corps d'un courriel décodé selon son encodage et son jeu de
+    caractères."""
+    if content_type.lower().startswith("multipart/"):
+        return body.decode("utf-8", "replace")
+    encoding = encoding.lower()
+    try:
+        if encoding == "base64":
+            body = binascii.a2b_base64(body)
+        elif encoding == "quoted-printable":
+            body = quopri.decodestring(body)
+    except binascii.Error:
+        pass
+    match = _CHARSET.search(content_type)
+    if match:
+        try:
+            return body.decode(match.group(1), "replace")
+        except LookupError:
+            pass
+    return body.decode("utf-8", "replace")
+
+
+def batches(payloads: Iterable[gloutils.EmailContentPayload],
+            max_count: int = _BATCH_SIZE, max_chars: int = _BATCH_BYTES
+            ) -> Iterator[List[gloutils.EmailContentPayload]]:
+    """
+    Regroupe les courriels par lots d'au plus `max_count` courriels, clos
+    dès que leurs corps comptent `max_chars` caractères.
+    """
+    batch: List[gloutils.EmailContentPayload] = []
+    size = 0
+    for payload in payloads:
+        batch.append(payload)
+        size += len(payload["content"])
+        if len(batch) >= max_count or size >= max_chars:
+            yield batch
+            batch, size = [], 0
+    if batch:
+        yield batch
+
+
+class StoreTarget:
+    """
+    Dépôt direct dans le stockage du serveur. Chaque lot est synchronisé
+    sur disque avant le suivant, comme par la file de dépôt: les fichiers
+    puis les dossiers qui les nomment. Sans `search`, l'index de recherche
+    est complété à la première recherche de l'utilisateur.
+    """
+
+    def __init__(self, store: glostorage.MailStore, username: str,
+                 search: bool) -> None:
+        if not store.exists(username):
+            raise ValueError(f"L'utilisateur {username} n'existe pas")
+        self._store = store
+        self._username = username
+        self._search = search
+        self.rejected = 0
+
+    def deliver(self, batch: List[gloutils.EmailContentPayload]) -> None:
+        """Dépose un lot et le rend durable."""
+        paths = self._store.deliver(self._username, batch, self._search)
+        for path in sorted(dict.fromkeys(paths), key=os.path.isdir):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def close(self) -> None:
+        """Rien à terminer: chaque lot est durable une fois déposé."""
+
+
+class ServerTarget:
+    """
+    Envoi groupé à un serveur, sur une connexion authentifiée comme
+    `login`. Au plus _IN_FLIGHT lots restent sans réponse; un courriel
+    trop grand pour un lot est transféré par morceaux. Les courriels que
+    le serveur n'a pas déposés sont comptés dans `rejected`.
+    """
+
+    def __init__(self, options: Options) -> None:
+        self._connection = gloclient.GloConnection(
+            options.server, binary=options.binary, compress=options.compress)
+        reply = self._connection.call(
+            gloutils.Headers.AUTH_LOGIN,
+            gloutils.AuthPayload(username=options.login,
+                                 password=options.password))
+        if reply["header"] != gloutils.Headers.OK:
+            self._connection.close()
+            raise ValueError(reply["payload"]["error_message"])
+        self._pending: Deque[int] = collections.deque()
+        self.rejected = 0
+
+    def deliver(self, batch: List[gloutils.EmailContentPayload]) -> None:
+        """
+        Envoie un lot, dont les courriels trop grands par morceaux, après
+        avoir attendu les réponses en trop.
+        """
+        emails = [payload for payload in batch
+                  if len(payload["content"]) <= _BATCH_BYTES]
+        if emails:
+            self._pending.append(self._connection.send(
+                gloutils.Headers.EMAIL_BATCH_SENDING,
+                gloutils.EmailBatchPayload(emails=emails)))
+        for payload in batch:
+            if len(payload["content"]) > _BATCH_BYTES:
+                self._pending.append(self._connection.send_stream(
+                    payload, [payload["content"]]))
+        while len(self._pending) > _IN_FLIGHT:
+            self._check(self._pending.popleft())
+
+    def close(self) -> None:
+        """Attend les réponses des derniers lots et ferme la connexion."""
+        try:
+            while self._pending:
+                self._check(self._pending.popleft())
+            self._connection.notify(gloutils.Headers.BYE)
+        finally:
+            self._connection.close()
+
+    def _check(self, request_id: int) -> None:
+        reply = self._connection.receive(request_id)
+        if reply["header"] != gloutils.Headers.OK:
+            raise ValueError(reply["payload"]["error_message"])
+        self.rejected += sum(
+            result["status"] != gloutils.DELIVERY_DELIVERED
+            for result in reply["payload"]["results"])
+
+
+def _init_worker(progress: "multiprocessing.sharedctypes.Synchronized",
+                 options: Options) -> None:
+    global _progress, _options, _store
+    _progress, _options = progress, options
+    if options.server is None:
+        _store = glostorage.MailStore()
+
+
+def import_source(source: Source) -> Result:
+    """
+    Importe une source dans la boîte de son utilisateur. Appelée dans un
+    processus du groupe, elle ajoute au compteur partagé le nombre de
+    courriels de chaque lot déposé ou envoyé.
+    """
+    destination = source.username + "@" + gloutils.SERVER_DOMAIN
+    imported = 0
+    target = None
+    try:
+        if _options.server is None:
+            target = StoreTarget(_store, source.username, _options.search)
+        else:
+            target = ServerTarget(_options)
+        payloads = (parse_message(raw, destination)
+                    for raw in messages(source.path))
+        for batch in batches(payloads):
+            target.deliver(batch)
+            imported += len(batch)
+            with _progress.get_lock():
+                _progress.value += len(batch)
+        target.close()
+    except (OSError, ValueError, glosocket.GLOSocketError) as error:
+        return Result(source, imported,
+                      target.rejected if target is not None else 0,
+                      str(error))
+    return Result(source, imported, target.rejected, "")
+
+
+def _size(source: Source) -> int:
+    try:
+        return os.path.getsize(source.path)
+    except OSError:
+        return 0
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Importe des boîtes mbox ou Maildir dans les boîtes des"
+                    " utilisateurs, directement dans le stockage du serveur"
+                    " (lancé depuis son dossier) ou par le protocole.")
+    parser.add_argument("sources", nargs="+",
+                        metavar="UTILISATEUR=SOURCE",
+                        help="Boîte mbox ou dossier Maildir à importer dans"
+                             " la boîte de l'utilisateur.")
+    parser.add_argument("-w", "--workers", action="store",
+                        dest="workers", type=int,
+                        default=os.cpu_count() or 1,
+                        help="Processus important les sources en parallèle.")
+    parser.add_argument("--no-search-index", action="store_false",
+                        dest="search",
+                        help="N'indexe pas les courriels pour la recherche"
+                             " pendant l'import; l'index est complété à la"
+                             " première recherche de chaque utilisateur.")
+    parser.add_argument("-d", "--server", action="store",
+                        dest="server", default=None,
+                        help="Adresse d'un serveur à qui envoyer les"
+                             " courriels, au lieu de les écrire dans le"
+                             " stockage. Ses limites de débit par défaut"
+                             " plafonnent l'import à environ 4 000"
+                             " courriels par seconde: lancer le serveur"
+                             " avec --no-rate-limit, ou --rate-limit et"
+                             " --user-rate-limit EMAIL_BATCH_SENDING=0.")
+    parser.add_argument("--login", action="store",
+                        dest="login", default=None,
+                        help="Compte utilisé pour envoyer les courriels au"
+                             " serveur.")
+    parser.add_argument("--password", action="store",
+                        dest="password", default=None,
+                        help="Mot de passe du compte (demandé s'il est"
+                             " omis).")
+    parser.add_argument("-b", "--binary", action="store_true",
+                        dest="binary",
+                        help="Négocie l'encodage binaire.")
+    parser.add_argument("-z", "--compress", action="store_true",
+                        dest="compress",
+                        help="Négocie la compression.")
+    parser.add_argument("--progress", action="store",
+                        dest="progress", type=float, default=1,
+                        help="Secondes entre deux affichages de la"
+                             " progression.")
+    args = parser.parse_args(sys.argv[1:])
+    sources = []
+    for spec in args.sources:
+        username, _, path = spec.partition("=")
+        if not username or not path:
+            parser.error(f"Source invalide : {spec}")
+        sources.append(Source(username, path))
+    if args.workers < 1:
+        parser.error("--workers doit être positif.")
+    if args.server is not None and args.login is None:
+        parser.error("--server requiert --login.")
+    password = args.password
+    if args.server is not None and password is None:
+        password = getpass.getpass("Mot de passe : ")
+    options = Options(args.search, args.server, args.login or "",
+                      password or "", args.binary, args.compress)
+    # largest mbox files first, so that one does not finish alone
+    sources.sort(key=_size, reverse=True)
+
+    progress = multiprocessing.Value("q", 0)
+    start = time.monotonic()
+    with concurrent.futures.ProcessPoolExecutor(
+            min(args.workers, len(sources)), initializer=_init_worker,
+            initargs=(progress, options)) as pool:
+        futures = [pool.submit(import_source, source) for source in sources]
+        pending = set(futures)
+        while pending:
+            _, pending = concurrent.futures.wait(pending,
+                                                 timeout=args.progress)
+            elapsed = time.monotonic() - start
+            print(f"{progress.value} courriels, "
+                  f"{progress.value / elapsed:.0f} courriels/s, "
+                  f"{len(futures) - len(pending)}/{len(futures)} sources",
+                  file=sys.stderr)
+    elapsed = time.monotonic() - start
+    failed = 0
+    for result in (future.result() for future in futures):
+        line = f"{result.source.username} : {result.imported} courriels" \
+               f" importés de {result.source.path}"
+        if result.rejected:
+            line += f", {result.rejected} non déposés"
+        if result.error:
+            line += f", erreur : {result.error}"
+            failed += 1
+        print(line)
+    print(f"Total : {progress.value} courriels en {elapsed:.1f} s, "
+          f"{progress.value / elapsed:.0f} courriels/s")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
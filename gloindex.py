@@ -0,0 +1,261 @@
+"""\
+Module fournissant l'index persistant des boîtes de réception du serveur.
+
+Chaque boîte possède un fichier d'index contenant une ligne d'en-tête puis
+un enregistrement compact (une ligne JSON) par courriel. Lister une boîte
+ne lit alors que cet index, jamais les courriels eux-mêmes.
+"""
+import bisect
+import contextlib
+import json
+import os
+import tempfile
+import uuid
+from typing import (Callable, Dict, Iterable, Iterator, List, NamedTuple,
+                    Optional)
+
+try:
+    import fcntl
+except ImportError:  # Windows: un seul processus serveur, aucun verrou requis
+    fcntl = None
+
+
+class IndexRecord(NamedTuple):
+    """Enregistrement de l'index pour un courriel."""
+    order: int
+    name: str
+    sender: str
+    subject: str
+    date: str
+    size: int
+
+
+@contextlib.contextmanager
+def locked(path: str, exclusive: bool) -> Iterator[None]:
+    """
+    Verrouille le dossier `path` le temps du bloc, entre processus comme
+    entre fils d'exécution.
+    """
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        os.close(fd)
+
+
+class InboxIndex:
+    """
+    Index d'une boîte de réception, tenu à jour incrémentalement.
+
+    L'index est périmé lorsque `source_path`, le dossier ou fichier où les
+    courriels sont déposés, est plus récent que lui; il est alors reconstruit
+    avec les enregistrements produits par `scan`. L'ordre d'arrivée `order`
+    est une date en nanosecondes.
+
+    Les ajouts se font en fin de fichier sous le verrou de `lock_dir`, la
+    reconstruction sous ce même verrou en mode exclusif: plusieurs processus
+    serveurs peuvent donc partager le même index. Chaque instance garde en
+    mémoire les enregistrements déjà lus et ne lit que la fin ajoutée depuis.
+
+    Le nombre de courriels et leur taille totale sont tenus à jour au fil
+    de la lecture des enregistrements: les statistiques de la boîte ne
+    demandent aucun parcours du dossier.
+    """
+
+    def __init__(self, lock_dir: str, index_path: str, source_path: str,
+                 scan: Callable[[], Iterable[IndexRecord]]) -> None:
+        self._lock_dir = lock_dir
+        self._index_path = index_path
+        self._source_path = source_path
+        self._scan = scan
+        self._records: List[IndexRecord] = []
+        self._names: Dict[str, IndexRecord] = {}
+        self._generation: Optional[bytes] = None
+        self._offset = 0
+        self._version = 0
+        self._total_size = 0
+
+    @property
+    def records(self) -> List[IndexRecord]:
+        """Enregistrements connus, du plus ancien au plus récent."""
+        return self._records
+
+    @property
+    def total_size(self) -> int:
+        """Taille totale en octets des courriels connus."""
+        return self._total_size
+
+    @property
+    def version(self) -> int:
+        """Numéro incrémenté à chaque changement de `records`."""
+        return self._version
+
+    @property
+    def stale(self) -> bool:
+        """Vrai si `refresh` reconstruirait d'abord l'index."""
+        return self._is_stale()
+
+    def copy(self) -> "InboxIndex":
+        """
+        Nouvelle instance du même index, sans enregistrement en mémoire:
+        elle peut être lue dans un autre fil d'exécution que celle-ci.
+        """
+        return InboxIndex(self._lock_dir, self._index_path,
+                          self._source_path, self._scan)
+
+    def get(self, name: str) -> Optional[IndexRecord]:
+        """Enregistrement connu du courriel `name`, None s'il est inconnu."""
+        return self._names.get(name)
+
+    def updating(self, exclusive: bool = False
+                 ) -> contextlib.AbstractContextManager:
+        """
+        Bloc dans lequel un courriel est déposé puis ajouté avec `append`.
+
+        Aucune reconstruction ne peut avoir lieu entre les deux. Un dépôt qui
+        doit aussi exclure les autres dépôts demande un verrou `exclusive`.
+        """
+        return locked(self._lock_dir, exclusive)
+
+    def append(self, record: IndexRecord) -> None:
+        """Ajoute l'enregistrement d'un courriel déposé dans la boîte."""
+        self.extend((record,))
+
+    def extend(self, records: Iterable[IndexRecord]) -> None:
+        """
+        Ajoute les enregistrements de courriels déposés dans la boîte, en
+        une seule écriture.
+
+        Un index absent n'est pas créé: il sera reconstruit au complet
+        lors de la prochaine lecture.
+        """
+        data = b"".join(_encode(record) for record in records)
+        if not data:
+            return
+        try:
+            fd = os.open(self._index_path, os.O_WRONLY | os.O_APPEND)
+        except FileNotFoundError:
+            return
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def touch(self) -> None:
+        """
+        Marque l'index à jour après une réécriture de la source qui n'a
+        changé aucun enregistrement.
+        """
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(self._index_path)
+
+    def _is_stale(self) -> bool:
+        """Vrai si l'index est absent ou plus ancien que la source."""
+        try:
+            index_mtime = os.stat(self._index_path).st_mtime_ns
+            source_mtime = os.stat(self._source_path).st_mtime_ns
+        except FileNotFoundError:
+            return True
+        return source_mtime > index_mtime
+
+    def refresh(self) -> List[IndexRecord]:
+        """
+        Met à jour les enregistrements en mémoire à partir de l'index,
+        en le reconstruisant s'il est absent ou périmé.
+        """
+        if self._is_stale():
+            self.rebuild()
+        self._sync()
+        return self._records
+
+    def _sync(self) -> None:
+        """
+        Lit la partie de l'index ajoutée depuis la dernière lecture.
+
+        La première ligne de l'index identifie sa génération: un index
+        reconstruit depuis la dernière lecture est relu au complet, même
+        si le système de fichiers a réutilisé le même inode.
+        """
+        with open(self._index_path, "rb") as file:
+            generation = file.readline()
+            if not generation.startswith(b"#"):
+                generation = b""
+                file.seek(0)
+            size = os.fstat(file.fileno()).st_size
+            if generation != self._generation or size < self._offset:
+                self._records, self._names = [], {}
+                self._generation, self._offset = generation, file.tell()
+                self._total_size = 0
+                self._version += 1
+            if size > self._offset:
+                file.seek(self._offset)
+                self._load(file.read())
+
+    def check(self) -> bool:
+        """
+        Vérifie que l'index correspond au contenu de la boîte (noms et
+        tailles) et le reconstruit sinon. Retourne True s'il était cohérent.
+        """
+        self.refresh()
+        with locked(self._lock_dir, exclusive=True):
+            self._sync()
+            expected = {record.name: record.size for record in self._scan()}
+            indexed = {record.name: record.size for record in self._records}
+            consistent = expected == indexed
+            if not consistent:
+                os.unlink(self._index_path)
+        if not consistent:
+            self.refresh()
+        return consistent
+
+    def _load(self, data: bytes) -> None:
+        """Intègre les lignes complètes de `data`, lu depuis `_offset`."""
+        end = data.rfind(b"\n") + 1
+        self._offset += end
+        for line in data[:end].splitlines():
+            record = IndexRecord(*json.loads(line))
+            if record.name in self._names:
+                continue
+            self._names[record.name] = record
+            self._total_size += record.size
+            self._version += 1
+            if self._records and record < self._records[-1]:
+                bisect.insort(self._records, record)
+            else:
+                self._records.append(record)
+
+    def rebuild(self) -> None:
+        """
+        Reconstruit l'index à partir du contenu de la boîte.
+
+        L'index est écrit dans un fichier temporaire puis renommé, les
+        lecteurs voient donc toujours un index complet.
+        """
+        with locked(self._lock_dir, exclusive=True):
+            if not self._is_stale():
+                return
+            write_index(self._index_path, sorted(self._scan()))
+
+
+def write_index(index_path: str, records: Iterable[IndexRecord]) -> None:
+    """Écrit atomiquement un nouvel index contenant `records`."""
+    fd, tmp_path = tempfile.mkstemp(prefix=".index-",
+                                    dir=os.path.dirname(index_path))
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(b"#" + uuid.uuid4().hex.encode("ascii") + b"\n")
+            file.writelines(_encode(record) for record in records)
+        os.replace(tmp_path, index_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _encode(record: IndexRecord) -> bytes:
+    """Encode un enregistrement sur une ligne."""
+    return (json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+            + "\n").encode("utf-8")
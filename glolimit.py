@@ -0,0 +1,178 @@
+"""\
+Module fournissant la limitation du débit des requêtes du serveur: des
+seaux à jetons par connexion et par utilisateur, configurés par entête.
+"""
+import time
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import gloutils
+
+Limits = Dict[str, Tuple[float, float]]
+
+# requests per second and burst, by header name; "*" for the others
+CONNECTION_LIMITS: Limits = {
+    "AUTH_REGISTER": (1, 5),
+    "AUTH_LOGIN": (2, 10),
+    "AUTH_RESUME": (2, 10),
+    "INBOX_READING_REQUEST": (20, 50),
+    "INBOX_PAGE_REQUEST": (50, 100),
+    "INBOX_READING_CHOICE": (50, 100),
+    "EMAIL_SENDING": (20, 50),
+    "EMAIL_BATCH_SENDING": (2, 10),
+    "EMAIL_STREAM_BEGIN": (2, 10),
+    "EMAIL_STREAM_REQUEST": (10, 20),
+    "STATS_REQUEST": (20, 50),
+    "SEARCH_REQUEST": (10, 20),
+}
+USER_LIMITS: Limits = {
+    "INBOX_READING_REQUEST": (40, 100),
+    "INBOX_PAGE_REQUEST": (100, 200),
+    "INBOX_READING_CHOICE": (100, 200),
+    "EMAIL_SENDING": (40, 100),
+    "EMAIL_BATCH_SENDING": (4, 20),
+    "EMAIL_STREAM_BEGIN": (4, 20),
+    "EMAIL_STREAM_REQUEST": (20, 40),
+    "STATS_REQUEST": (40, 100),
+    "SEARCH_REQUEST": (20, 40),
+}
+
+_MAX_IDLE_USERS = 10000
+
+
+def parse_limit(spec: str) -> Tuple[str, float, float]:
+    """
+    Analyse une limite de la forme "EMAIL_SENDING=20/50": l'entête (ou *
+    pour toutes les autres), le débit en requêtes par seconde et la
+    rafale. Un débit nul retire la limite.
+    """
+    header, _, value = spec.partition("=")
+    rate, _, burst = value.partition("/")
+    if header != "*" and header not in gloutils.Headers.__members__:
+        raise ValueError(f"Entête inconnue : {header}")
+    try:
+        rate_value = float(rate)
+        burst_value = float(burst) if burst else max(1.0, rate_value)
+    except ValueError as ex:
+        raise ValueError(f"Limite invalide : {spec}") from ex
+    if rate_value < 0 or burst_value < 1:
+        raise ValueError(f"Limite invalide : {spec}")
+    return header, rate_value, burst_value
+
+
+def limits(defaults: Limits, specs: List[str]) -> Limits:
+    """Limites `defaults` modifiées par les limites `specs`."""
+    table = dict(defaults)
+    for spec in specs:
+        header, rate, burst = parse_limit(spec)
+        if rate:
+            table[header] = (rate, burst)
+        else:
+            table.pop(header, None)
+    return table
+
+
+class TokenBucket:
+    """Seau de `burst` jetons, remplis au débit de `rate` par seconde."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float, now: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def delay(self, now: float) -> float:
+        """Secondes avant qu'un jeton soit disponible, 0 s'il l'est."""
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        """Consomme un jeton disponible."""
+        self.tokens -= 1
+
+
+class RateLimiter:
+    """
+    Seaux à jetons des connexions et des utilisateurs, créés à la première
+    requête de chaque entête limitée.
+
+    Une requête n'est admise que si le seau de sa connexion et celui de
+    son utilisateur, s'il est authentifié, ont chacun un jeton: les deux
+    sont alors consommés. Sinon, aucun ne l'est et `delay` retourne
+    l'attente avant de la présenter à nouveau.
+
+    Les seaux d'une connexion sont oubliés à sa fermeture; ceux des
+    utilisateurs le sont lorsqu'ils sont pleins et trop nombreux.
+    """
+
+    def __init__(self, connection_limits: Limits, user_limits: Limits
+                 ) -> None:
+        self._connection_limits = connection_limits
+        self._user_limits = user_limits
+        self._connections: Dict[Hashable, Dict[str, TokenBucket]] = {}
+        self._users: Dict[str, Dict[str, TokenBucket]] = {}
+        self.admitted = 0
+        self.throttled = 0
+
+    def delay(self, connection: Hashable, username: Optional[str],
+              header: str) -> float:
+        """
+        Admet la requête `header` de la connexion et retourne 0, ou
+        retourne les secondes à attendre avant de la présenter à nouveau.
+        """
+        now = time.monotonic()
+        buckets = []
+        bucket = self._bucket(self._connections, self._connection_limits,
+                              connection, header, now)
+        if bucket is not None:
+            buckets.append(bucket)
+        if username is not None:
+            bucket = self._bucket(self._users, self._user_limits, username,
+                                  header, now)
+            if bucket is not None:
+                buckets.append(bucket)
+        delay = max((bucket.delay(now) for bucket in buckets), default=0.0)
+        if delay:
+            self.throttled += 1
+            return delay
+        for bucket in buckets:
+            bucket.take()
+        self.admitted += 1
+        return 0.0
+
+    def forget(self, connection: Hashable) -> None:
+        """Oublie les seaux d'une connexion fermée."""
+        self._connections.pop(connection, None)
+
+    def stats(self) -> Dict[str, int]:
+        """Compteurs: requêtes admises et retardées."""
+        return {"admitted": self.admitted, "throttled": self.throttled}
+
+    def _bucket(self, owners: Dict, table: Limits, owner: Hashable,
+                header: str, now: float) -> Optional[TokenBucket]:
+        """Seau de `owner` pour `header`, None si l'entête n'est pas
+        limitée."""
+        limit = table.get(header, table.get("*"))
+        if limit is None:
+            return None
+        buckets = owners.get(owner)
+        if buckets is None:
+            if owners is self._users and len(owners) >= _MAX_IDLE_USERS:
+                self._prune(now)
+            buckets = owners[owner] = {}
+        bucket = buckets.get(header)
+        if bucket is None:
+            bucket = buckets[header] = TokenBucket(*limit, now)
+        return bucket
+
+    def _prune(self, now: float) -> None:
+        """Oublie les seaux des utilisateurs qui sont tous pleins."""
+        for username, buckets in list(self._users.items()):
+            if all(bucket.delay(now) == 0 and bucket.tokens >= bucket.burst
+                   for bucket in buckets.values()):
+                del self._users[username]
@@ -0,0 +1,286 @@
+"""\
+Module fournissant le dossier SERVER_LOST_DIR, où sont conservés les
+courriels destinés à des utilisateurs qui n'existent pas.
+
+Les courriels y sont rangés dans un sous-dossier par destinataire: à la
+création d'un compte, ses courriels sont retrouvés sans parcourir tout le
+dossier. Un fil d'exécution dédié les dépose alors dans la nouvelle boîte,
+fait expirer les plus anciens et borne la taille du dossier, hors du
+chemin des requêtes.
+"""
+import concurrent.futures
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.parse
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import gloindex
+import glostorage
+import gloutils
+
+_logger = logging.getLogger("glolost")
+
+_REDELIVERY_BATCH = 256
+_REDELIVERY_BYTES = 16 * 1024 * 1024
+
+Deliver = Callable[[Dict[str, List[gloutils.EmailContentPayload]]],
+                   concurrent.futures.Future]
+
+
+class _LostEmail(NamedTuple):
+    """Courriel en attente dans le dossier d'un destinataire."""
+    path: str
+    mtime: float
+    size: int
+
+
+def _recipient_dir(recipient: str) -> str:
+    """
+    Nom du sous-dossier des courriels destinés à `recipient`. Les noms
+    d'utilisateur valides sont conservés tels quels, les autres échappés.
+    """
+    name = urllib.parse.quote(recipient, safe="")
+    if name in ("", ".", ".."):
+        name = "%" + name.replace(".", "%2E")
+    return name
+
+
+class LostMail:
+    """
+    Courriels perdus, indexés par destinataire.
+
+    `write` range un courriel dans le dossier de son destinataire.
+    `release` demande le dépôt des courriels d'un utilisateur qui vient
+    d'être créé: le fil lancé par `start` les lit par lots et les confie à
+    `deliver`, puis les supprime une fois durables. Toutes les `interval`
+    secondes, ce fil redépose aussi les courriels des utilisateurs créés
+    par d'autres processus, supprime ceux reçus il y a plus de `max_age`
+    secondes puis les plus anciens tant que le dossier dépasse `max_bytes`
+    octets (0: sans limite).
+
+    Le redépôt et le balayage se font sous le verrou exclusif du dossier:
+    plusieurs processus serveurs peuvent partager le même dossier sans
+    déposer deux fois un courriel.
+    """
+
+    def __init__(self, store: glostorage.MailStore, max_age: float = 0,
+                 max_bytes: int = 0) -> None:
+        self._store = store
+        self._dir = gloutils.SERVER_DATA_DIR + "/" + gloutils.SERVER_LOST_DIR
+        self._max_age = max_age
+        self._max_bytes = max_bytes
+        self._released: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._stats_lock = threading.Lock()
+        self.redelivered = 0
+        self.expired = 0
+        self.evicted = 0
+        self.pending_bytes = 0
+        os.makedirs(self._dir, exist_ok=True)
+
+    def write(self, recipient: str, payload: gloutils.EmailContentPayload
+              ) -> List[str]:
+        """
+        Écrit le courriel destiné à `recipient` dans son dossier. Retourne
+        les chemins à synchroniser sur disque pour le rendre durable.
+        """
+        directory = self._dir + "/" + _recipient_dir(recipient)
+        name = payload["date"].replace(":", "-")
+        while True:
+            created = not os.path.isdir(directory)
+            os.makedirs(directory, exist_ok=True)
+            try:
+                name, stat = glostorage.write_atomic(
+                    directory, name, glostorage.email_blocks(payload))
+                break
+            except FileNotFoundError:
+                # emptied and removed by a concurrent sweep
+                continue
+        with self._stats_lock:
+            self.pending_bytes += stat.st_size
+        paths = [directory + "/" + name, directory]
+        if created:
+            paths.append(self._dir)
+        return paths
+
+    def release(self, username: str) -> None:
+        """Demande le dépôt des courriels destinés au nouvel utilisateur."""
+        self._released.put(username)
+
+    def start(self, deliver: Deliver, interval: float) -> threading.Thread:
+        """
+        Lance le fil de redépôt et de balayage, qui dépose les courriels
+        avec `deliver` et balaie le dossier toutes les `interval` secondes.
+        """
+        def run() -> None:
+            deadline = time.monotonic()
+            while True:
+                try:
+                    username = self._released.get(
+                        timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    self._safely(self.sweep, deliver)
+                    deadline = time.monotonic() + interval
+                    continue
+                if username is None:
+                    return
+                self._safely(self._redeliver_locked, deliver, username)
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def close(self) -> None:
+        """Arrête le fil de redépôt après le redépôt en cours."""
+        if self._thread is not None:
+            self._released.put(None)
+            self._thread.join()
+
+    def stats(self) -> Dict[str, int]:
+        """Compteurs: courriels redéposés, expirés, évincés et octets en
+        attente au dernier balayage."""
+        return {"redelivered": self.redelivered, "expired": self.expired,
+                "evicted": self.evicted, "pending_bytes": self.pending_bytes}
+
+    def sweep(self, deliver: Deliver) -> None:
+        """
+        Range les fichiers de l'ancienne disposition à plat, redépose les
+        courriels des utilisateurs existants puis applique l'expiration et
+        la limite de taille.
+        """
+        with gloindex.locked(self._dir, exclusive=True):
+            self._migrate()
+            now = time.time()
+            pending: List[_LostEmail] = []
+            for name in os.listdir(self._dir):
+                recipient = urllib.parse.unquote(name)
+                if (_recipient_dir(recipient) == recipient
+                        and self._store.exists(recipient)):
+                    self._safely(self._redeliver, deliver, recipient)
+                    continue
+                expired = []
+                for email in self._list(self._dir + "/" + name):
+                    if self._max_age and now - email.mtime > self._max_age:
+                        expired.append(email.path)
+                    else:
+                        pending.append(email)
+                self._remove(expired)
+                self._remove_dir(self._dir + "/" + name)
+                with self._stats_lock:
+                    self.expired += len(expired)
+            total = sum(email.size for email in pending)
+            if self._max_bytes and total > self._max_bytes:
+                pending.sort(key=lambda email: email.mtime)
+                evicted = 0
+                while total > self._max_bytes:
+                    email = pending[evicted]
+                    self._remove([email.path])
+                    self._remove_dir(os.path.dirname(email.path))
+                    total -= email.size
+                    evicted += 1
+                with self._stats_lock:
+                    self.evicted += evicted
+            with self._stats_lock:
+                self.pending_bytes = total
+
+    def _safely(self, function: Callable[..., None], *args) -> None:
+        try:
+            function(*args)
+        except Exception:
+            # keep the thread, and the sweep, going with the next recipient
+            _logger.exception("Courriels perdus")
+
+    def _redeliver_locked(self, deliver: Deliver, username: str) -> None:
+        with gloindex.locked(self._dir, exclusive=True):
+            self._redeliver(deliver, username)
+
+    def _redeliver(self, deliver: Deliver, username: str) -> None:
+        """
+        Dépose, par lots, les courriels destinés à `username` dans sa boîte
+        et les supprime une fois durables. Doit être appelée sous le verrou
+        du dossier.
+        """
+        directory = self._dir + "/" + _recipient_dir(username)
+        emails = sorted(self._list(directory),
+                        key=lambda email: email.mtime)
+        start = 0
+        while start < len(emails):
+            end, size = start, 0
+            while (end < len(emails) and end - start < _REDELIVERY_BATCH
+                   and (end == start or size < _REDELIVERY_BYTES)):
+                size += emails[end].size
+                end += 1
+            batch = emails[start:end]
+            payloads = []
+            for email in batch:
+                with open(email.path, "r", encoding="utf-8",
+                          newline="") as file:
+                    payloads.append(glostorage.parse_email(file))
+            deliver({username: payloads}).result()
+            self._remove([email.path for email in batch])
+            with self._stats_lock:
+                self.redelivered += len(batch)
+                self.pending_bytes = max(0, self.pending_bytes - size)
+            start = end
+        self._remove_dir(directory)
+
+    def _list(self, directory: str) -> List[_LostEmail]:
+        """Courriels du dossier d'un destinataire."""
+        emails = []
+        try:
+            names = os.listdir(directory)
+        except (FileNotFoundError, NotADirectoryError):
+            return emails
+        for name in names:
+            path = directory + "/" + name
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            emails.append(_LostEmail(path, stat.st_mtime, stat.st_size))
+        return emails
+
+    def _migrate(self) -> None:
+        """
+        Range dans le dossier de leur destinataire les courriels écrits à
+        plat sous le nom `destinataire_date` par les versions précédentes.
+        """
+        for name in os.listdir(self._dir):
+            path = self._dir + "/" + name
+            if os.path.isdir(path):
+                continue
+            recipient, _, date = name.rpartition("_")
+            directory = self._dir + "/" + _recipient_dir(recipient)
+            os.makedirs(directory, exist_ok=True)
+            target, suffix = directory + "/" + date, 0
+            while os.path.exists(target):
+                suffix += 1
+                target = directory + "/" + date + "_" + str(suffix)
+            os.rename(path, target)
+
+    def _remove(self, paths: List[str]) -> None:
+        """Supprime les fichiers et synchronise leur dossier."""
+        for path in paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        for directory in {os.path.dirname(path) for path in paths}:
+            try:
+                fd = os.open(directory, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _remove_dir(self, directory: str) -> None:
+        """Supprime le dossier d'un destinataire s'il est vide."""
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
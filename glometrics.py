@@ -0,0 +1,156 @@
+"""\
+Module fournissant les métriques du serveur: compteurs et histogrammes de
+latence par entête, jauges de l'état du serveur, et leur exposition au
+format texte de Prometheus sur un port HTTP local.
+"""
+import bisect
+import http.server
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import gloutils
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Timer:
+    """Requête en cours de traitement, mesurée jusqu'à sa réponse."""
+
+    __slots__ = ("header", "size", "started")
+
+    def __init__(self, header: str, size: int) -> None:
+        self.header = header
+        self.size = size
+        self.started = time.perf_counter()
+
+
+class _Histogram:
+    """Histogramme cumulatif des latences, en secondes."""
+
+    __slots__ = ("counts", "total")
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+
+
+class Metrics:
+    """
+    Métriques d'un processus serveur.
+
+    `start` mesure une requête dès son décodage et `finish` l'enregistre
+    lorsque sa réponse est transmise: nombre de requêtes, réponses en
+    erreur, octets reçus et transmis (messages encodés, avant compression)
+    et latence, par entête. Les jauges sont des fonctions évaluées à
+    chaque lecture des métriques.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._requests: Dict[str, int] = {}
+        self._errors: Dict[str, int] = {}
+        self._bytes_in: Dict[str, int] = {}
+        self._bytes_out: Dict[str, int] = {}
+        self._latency: Dict[str, _Histogram] = {}
+        self._gauges: List[Tuple[str, str, Callable[[], float]]] = []
+
+    def gauge(self, name: str, description: str,
+              value: Callable[[], float]) -> None:
+        """Ajoute la jauge `name`, dont `value` retourne la valeur."""
+        self._gauges.append((name, description, value))
+
+    def start(self, message: gloutils.GloMessage, size: int) -> Timer:
+        """Commence la mesure d'une requête de `size` octets."""
+        try:
+            header = gloutils.Headers(message["header"]).name
+        except (KeyError, ValueError):
+            header = "UNKNOWN"
+        return Timer(header, size)
+
+    def finish(self, timer: Timer, reply: Optional[gloutils.GloMessage],
+               size: int) -> None:
+        """Enregistre la requête, dont la réponse de `size` octets est
+        transmise."""
+        latency = time.perf_counter() - timer.started
+        header = timer.header
+        with self._lock:
+            self._requests[header] = self._requests.get(header, 0) + 1
+            if reply is not None and reply["header"] == gloutils.Headers.ERROR:
+                self._errors[header] = self._errors.get(header, 0) + 1
+            self._bytes_in[header] = self._bytes_in.get(header, 0) + timer.size
+            self._bytes_out[header] = self._bytes_out.get(header, 0) + size
+            histogram = self._latency.get(header)
+            if histogram is None:
+                histogram = self._latency[header] = _Histogram()
+            histogram.observe(latency)
+
+    def render(self) -> str:
+        """Retourne les métriques au format texte de Prometheus."""
+        lines: List[str] = []
+        with self._lock:
+            for name, description, values in (
+                    ("glo_requests_total", "Requêtes traitées.",
+                     self._requests),
+                    ("glo_errors_total", "Réponses en erreur.", self._errors),
+                    ("glo_received_bytes_total", "Octets des requêtes.",
+                     self._bytes_in),
+                    ("glo_sent_bytes_total", "Octets des réponses.",
+                     self._bytes_out)):
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} counter")
+                for header, value in sorted(values.items()):
+                    lines.append(f'{name}{{header="{header}"}} {value}')
+            name = "glo_request_duration_seconds"
+            lines.append(f"# HELP {name} Latence des requêtes, jusqu'à"
+                         " la transmission de leur réponse.")
+            lines.append(f"# TYPE {name} histogram")
+            for header, histogram in sorted(self._latency.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + (float("inf"),),
+                                        histogram.counts):
+                    cumulative += count
+                    label = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{name}_bucket{{header="{header}",'
+                                 f'le="{label}"}} {cumulative}')
+                lines.append(f'{name}_sum{{header="{header}"}}'
+                             f' {histogram.total}')
+                lines.append(f'{name}_count{{header="{header}"}}'
+                             f' {cumulative}')
+        for name, description, value in self._gauges:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value()}")
+        return "\n".join(lines) + "\n"
+
+
+def serve(metrics: Metrics, port: int) -> http.server.ThreadingHTTPServer:
+    """
+    Expose `metrics` à l'adresse http://127.0.0.1:`port`/metrics, dans un
+    fil d'exécution dédié.
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type",
+                             "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_) -> None:
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,396 @@
+"""\
+Module fournissant l'index de recherche plein texte des boîtes de
+réception du serveur.
+
+L'index inversé d'une boîte associe chaque terme de l'expéditeur, du sujet
+et du corps des courriels à la liste triée des courriels qui le
+contiennent. Une recherche ne lit que cet index, jamais les courriels.
+
+Le fichier d'index contient une ligne d'en-tête puis des blocs ajoutés à
+chaque dépôt. Un bloc contient les noms de ses courriels, numérotés à la
+suite de ceux des blocs précédents, puis pour chaque terme les écarts
+entre les numéros successifs de ses courriels, sur un, deux ou quatre
+octets selon le plus grand écart de la liste.
+"""
+import array
+import itertools
+import os
+import re
+import struct
+import sys
+import tempfile
+import unicodedata
+import uuid
+from typing import (Callable, Dict, Iterable, Iterator, List, NamedTuple,
+                    Sequence, Set, Tuple)
+
+import gloindex
+import gloutils
+
+_U8 = struct.Struct("!B")
+_U16 = struct.Struct("!H")
+_U32 = struct.Struct("!I")
+_WORD = re.compile(r"\w+")
+_ACCENTS = re.compile("[\u0300-\u036f]")
+_MAX_TERM_LENGTH = 64
+# a term's length is stored on one byte
+_MAX_TERM_BYTES = 255
+_MAX_BLOCKS = 32
+_SWAP = sys.byteorder == "little"
+
+
+def terms(text: str) -> Set[str]:
+    """
+    Termes indexés d'un texte: ses mots, en minuscules et sans accents,
+    d'au plus _MAX_TERM_LENGTH caractères et _MAX_TERM_BYTES octets.
+    """
+    text = text.lower()
+    if text.isascii():
+        return {word for word in _WORD.findall(text)
+                if len(word) <= _MAX_TERM_LENGTH}
+    text = _ACCENTS.sub("", unicodedata.normalize("NFKD", text))
+    return {word for word in _WORD.findall(text)
+            if len(word) <= _MAX_TERM_LENGTH
+            and len(word.encode("utf-8")) <= _MAX_TERM_BYTES}
+
+
+def email_terms(payload: gloutils.EmailContentPayload) -> Set[str]:
+    """
+    Termes indexés d'un courriel: expéditeur, sujet et corps. Un corps
+    reçu par morceaux (voir glostorage.SpooledBody) est parcouru morceau
+    par morceau.
+    """
+    content = payload["content"]
+    if isinstance(content, str):
+        return terms(payload["sender"] + "\n" + payload["subject"] + "\n"
+                     + content)
+    return body_terms(payload, content)
+
+
+def body_terms(header: gloutils.EmailContentPayload,
+               chunks: Iterable[str]) -> Set[str]:
+    """
+    Termes indexés d'un courriel dont le corps est lu par morceaux: ceux
+    de l'expéditeur et du sujet de `header`, puis ceux de chaque morceau.
+    """
+    found = terms(header["sender"] + "\n" + header["subject"])
+    tail = ""
+    for chunk in chunks:
+        # a word cut at the end of a chunk is kept for the next one
+        text = tail + chunk
+        last = None
+        for last in _WORD.finditer(text):
+            pass
+        cut = last.start() if last and last.end() == len(text) else len(text)
+        found |= terms(text[:cut])
+        # longer than any indexed term, the word only needs to stay too long
+        tail = text[cut:][-_MAX_TERM_LENGTH - 1:]
+    return found | terms(tail)
+
+
+class _Block(NamedTuple):
+    """Position d'un bloc dans le fichier et de ses courriels dans l'index."""
+    start: int
+    end: int
+    first: int
+    count: int
+
+
+class SearchIndex:
+    """
+    Index de recherche d'une boîte de réception, tenu à jour
+    incrémentalement.
+
+    Les dépôts ajoutent un bloc en fin de fichier (`append`); chaque
+    instance ne lit que les blocs ajoutés depuis sa dernière lecture. Les
+    courriels de l'index de la boîte `inbox` absents de l'index de
+    recherche, déposés avant sa création par exemple, y sont ajoutés à la
+    recherche suivante, ou par `catch_up` hors du fil des recherches, en
+    les lisant par morceaux avec `stream`, qui retourne l'en-tête d'un
+    courriel et les morceaux de son corps.
+
+    Au-delà de _MAX_BLOCKS blocs, les derniers blocs sont fusionnés et le
+    fichier est réécrit, sous le verrou exclusif de la boîte: la taille
+    d'un bloc fusionné croît géométriquement, le nombre de blocs reste
+    donc logarithmique.
+    """
+
+    def __init__(self, inbox: gloindex.InboxIndex, path: str,
+                 stream: Callable[[str], Tuple[gloutils.EmailContentPayload,
+                                               Iterator[str]]]) -> None:
+        self._inbox = inbox
+        self._path = path
+        self._stream = stream
+        self._generation = b""
+        self._offset = 0
+        self._blocks: List[_Block] = []
+        self._docs: List[str] = []
+        self._names: Set[str] = set()
+        self._postings: Dict[str, List[Tuple[int, array.array]]] = {}
+
+    def append(self, emails: Sequence[Tuple[str, gloutils.EmailContentPayload]]
+               ) -> None:
+        """
+        Ajoute les courriels déposés, avec leurs noms, en une seule
+        écriture. Un index absent n'est pas créé: il sera construit au
+        complet lors de la prochaine recherche.
+        """
+        if emails:
+            self._append_block(_encode_block(
+                [name for name, _ in emails],
+                _invert(email_terms(payload) for _, payload in emails)))
+
+    def create(self) -> None:
+        """Crée l'index vide d'une nouvelle boîte."""
+        self._write([])
+
+    def _append_block(self, data: bytes) -> None:
+        """Ajoute un bloc encodé à l'index, s'il existe."""
+        try:
+            fd = os.open(self._path, os.O_WRONLY | os.O_APPEND)
+        except FileNotFoundError:
+            return
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def search(self, query: str) -> Set[str]:
+        """
+        Noms des courriels contenant tous les termes de `query`, dans
+        n'importe lequel des champs indexés.
+        """
+        words = terms(query)
+        if not words:
+            return set()
+        self.refresh()
+        found = None
+        # rarest terms first, the intersection only shrinks
+        for word in sorted(words, key=self._frequency):
+            ids = set(self._ids(word))
+            found = ids if found is None else found & ids
+            if not found:
+                return set()
+        return {self._docs[number] for number in found}
+
+    def _frequency(self, word: str) -> int:
+        return sum(len(deltas) for _, deltas in self._postings.get(word, ()))
+
+    def _ids(self, word: str) -> Iterator[int]:
+        """Numéros des courriels contenant `word`, en ordre croissant."""
+        for first, deltas in self._postings.get(word, ()):
+            yield from itertools.islice(
+                itertools.accumulate(deltas, initial=first), 1, None)
+
+    def refresh(self) -> None:
+        """
+        Lit les blocs ajoutés depuis la dernière lecture, ajoute les
+        courriels manquants et fusionne les blocs s'ils sont trop nombreux.
+        """
+        if not self.outdated():
+            return
+        records = self._inbox.records
+        with self._inbox.updating(exclusive=True):
+            # emails delivered since `records` was read are being appended
+            self._sync()
+            missing = [record.name for record in records
+                       if record.name not in self._names]
+            if missing:
+                block = _encode_block(missing, _invert(
+                    body_terms(*self._stream(name)) for name in missing))
+                if os.path.exists(self._path):
+                    self._append_block(block)
+                else:
+                    self._write([block])
+                self._sync()
+            if len(self._blocks) > _MAX_BLOCKS:
+                self._merge()
+
+    def outdated(self) -> bool:
+        """
+        Lit les blocs ajoutés depuis la dernière lecture. Vrai s'il manque
+        des courriels de la boîte à l'index ou s'il a trop de blocs:
+        `refresh` lirait alors ces courriels ou réécrirait l'index.
+        """
+        records = self._inbox.refresh()
+        self._sync()
+        return len(self._names) < len(records) or len(self._blocks) > _MAX_BLOCKS
+
+    def catch_up(self) -> None:
+        """
+        Comme `refresh`, mais avec de nouvelles instances de cet index et de
+        celui de la boîte: l'état en mémoire de celle-ci n'est pas modifié.
+        Les courriels manquants peuvent ainsi être lus dans un autre fil
+        d'exécution que les recherches, qui ne liront ensuite que les blocs
+        écrits.
+        """
+        SearchIndex(self._inbox.copy(), self._path, self._stream).refresh()
+
+    def _sync(self) -> None:
+        """
+        Lit les blocs complets ajoutés depuis la dernière lecture, ou tout
+        l'index s'il a été réécrit depuis.
+        """
+        try:
+            file = open(self._path, "rb")
+        except FileNotFoundError:
+            return
+        with file:
+            generation = file.readline()
+            size = os.fstat(file.fileno()).st_size
+            if generation != self._generation or size < self._offset:
+                self._generation, self._offset = generation, file.tell()
+                self._blocks, self._docs, self._names = [], [], set()
+                self._postings = {}
+            if size <= self._offset:
+                return
+            file.seek(self._offset)
+            data = memoryview(file.read())
+        position = 0
+        while position + _U32.size <= len(data):
+            length, = _U32.unpack_from(data, position)
+            end = position + _U32.size + length
+            if end > len(data):
+                # a block still being written
+                break
+            self._load(data[position + _U32.size:end], self._offset + position,
+                       self._offset + end)
+            position = end
+        self._offset += position
+
+    def _load(self, body: memoryview, start: int, end: int) -> None:
+        """Intègre un bloc lu entre les positions `start` et `end`."""
+        first = len(self._docs)
+        count, = _U32.unpack_from(body, 0)
+        position = _U32.size
+        for _ in range(count):
+            length, = _U16.unpack_from(body, position)
+            position += _U16.size
+            name = bytes(body[position:position + length]).decode("utf-8")
+            position += length
+            self._docs.append(name)
+            self._names.add(name)
+        term_count, = _U32.unpack_from(body, position)
+        position += _U32.size
+        for _ in range(term_count):
+            length = body[position]
+            term = bytes(body[position + 1:position + 1 + length]).decode("utf-8")
+            position += 1 + length
+            deltas = array.array(chr(body[position]))
+            size, = _U32.unpack_from(body, position + 1)
+            position += 1 + _U32.size
+            deltas.frombytes(body[position:position + size * deltas.itemsize])
+            position += size * deltas.itemsize
+            if _SWAP:
+                deltas.byteswap()
+            self._postings.setdefault(term, []).append((first, deltas))
+        self._blocks.append(_Block(start, end, first, count))
+
+    def _merge(self) -> None:
+        """
+        Fusionne les derniers blocs, ainsi que les blocs précédents plus
+        petits qu'eux, puis réécrit l'index. Appelée sous le verrou
+        exclusif de la boîte.
+        """
+        start = len(self._blocks) - _MAX_BLOCKS // 2
+        count = sum(block.count for block in self._blocks[start:])
+        while start > 0 and self._blocks[start - 1].count <= count:
+            start -= 1
+            count += self._blocks[start].count
+        first = self._blocks[start].first
+        docs = self._docs[first:]
+        # new numbers within the merged block, duplicates dropped
+        unique: Dict[str, int] = {}
+        for name in docs:
+            unique.setdefault(name, len(unique))
+        numbers = (None if len(unique) == len(docs) else
+                   [unique[name] for name in docs])
+        postings: Dict[str, List[int]] = {}
+        for term, chunks in self._postings.items():
+            ids: List[int] = []
+            for chunk_first, deltas in chunks:
+                if chunk_first >= first:
+                    ids.extend(itertools.islice(itertools.accumulate(
+                        deltas, initial=chunk_first - first), 1, None))
+            if ids and numbers is not None:
+                ids = sorted({numbers[number] for number in ids})
+            if ids:
+                postings[term] = ids
+        with open(self._path, "rb") as file:
+            file.seek(len(self._generation))
+            kept = file.read(self._blocks[start].start - len(self._generation))
+        merged = _encode_block(list(unique), postings)
+        generation = self._write([kept, merged])
+        # only the merged block needs to be loaded again
+        self._generation = generation
+        self._offset = self._blocks[start].start + len(merged)
+        self._docs = self._docs[:first]
+        self._names = set(self._docs)
+        for term in list(self._postings):
+            chunks = [chunk for chunk in self._postings[term]
+                      if chunk[0] < first]
+            if chunks:
+                self._postings[term] = chunks
+            else:
+                del self._postings[term]
+        position = self._blocks[start].start
+        del self._blocks[start:]
+        self._load(memoryview(merged)[_U32.size:], position, self._offset)
+
+    def _write(self, blocks: List[bytes]) -> bytes:
+        """
+        Remplace atomiquement l'index par les blocs encodés `blocks`.
+        Retourne la ligne d'en-tête de la nouvelle génération.
+        """
+        generation = b"#" + uuid.uuid4().hex.encode("ascii") + b"\n"
+        fd, tmp_path = tempfile.mkstemp(prefix=".search-",
+                                        dir=os.path.dirname(self._path))
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(generation)
+                file.writelines(blocks)
+            os.replace(tmp_path, self._path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return generation
+
+
+def _invert(documents: Iterable[Set[str]]) -> Dict[str, List[int]]:
+    """Associe chaque terme aux numéros, croissants, des documents qui le
+    contiennent."""
+    postings: Dict[str, List[int]] = {}
+    for number, words in enumerate(documents):
+        for word in words:
+            postings.setdefault(word, []).append(number)
+    return postings
+
+
+def _encode_block(names: List[str], postings: Dict[str, List[int]]) -> bytes:
+    """Encode un bloc, précédé de sa longueur."""
+    parts = [_U32.pack(len(names))]
+    for name in names:
+        data = name.encode("utf-8")
+        parts.append(_U16.pack(len(data)))
+        parts.append(data)
+    # the count written must match the terms actually stored
+    encoded_terms = [(term.encode("utf-8"), ids)
+                     for term, ids in postings.items()]
+    encoded_terms = [(data, ids) for data, ids in encoded_terms
+                     if len(data) <= _MAX_TERM_BYTES]
+    parts.append(_U32.pack(len(encoded_terms)))
+    for data, ids in encoded_terms:
+        deltas = [ids[0]] + [current - previous
+                             for previous, current in zip(ids, ids[1:])]
+        largest = max(deltas)
+        code = "B" if largest < 1 << 8 else "H" if largest < 1 << 16 else "I"
+        encoded = array.array(code, deltas)
+        if _SWAP:
+            encoded.byteswap()
+        parts.append(_U8.pack(len(data)))
+        parts.append(data)
+        parts.append(code.encode("ascii"))
+        parts.append(_U32.pack(len(deltas)))
+        parts.append(encoded.tobytes())
+    body = b"".join(parts)
+    return _U32.pack(len(body)) + body
@@ -0,0 +1,199 @@
+"""\
+Module fournissant les jetons de session du serveur.
+
+Un jeton signé par HMAC est remis au client à sa connexion; il permet de
+reprendre la session plus tard sans renvoyer le mot de passe. Sa
+vérification ne lit ni le fichier du mot de passe ni son hachage.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import tempfile
+import time
+from typing import Dict, Optional, Tuple
+
+import gloindex
+
+_KEY_SIZE = 32
+# the revocation file is not rewritten below this many lines
+_COMPACT_LINES = 1024
+
+
+class SessionManager:
+    """
+    Émet, vérifie et révoque les jetons de session.
+
+    Un jeton contient le nom d'utilisateur, sa date d'expiration (après
+    `ttl` secondes) et un identifiant aléatoire, signés avec la clé
+    conservée dans `key_path`. La clé est créée au premier démarrage puis
+    partagée par tous les processus serveurs: les jetons restent valides
+    après un redémarrage.
+
+    Les identifiants des jetons révoqués sont ajoutés au fichier
+    `revoked_path`; chaque instance n'en relit que la fin ajoutée depuis
+    sa dernière lecture et oublie les jetons expirés. Lorsque ceux-ci y
+    sont majoritaires, le fichier est réécrit sans eux, sous un nouvel
+    inode; les autres instances le relisent alors en entier.
+    """
+
+    def __init__(self, key_path: str, revoked_path: str, ttl: int) -> None:
+        self._key = _load_key(key_path)
+        self._revoked_path = revoked_path
+        self._ttl = ttl
+        self._revoked: Dict[str, int] = {}
+        self._offset = 0
+        self._lines = 0
+        self._seen: Tuple[int, int] = (0, 0)
+
+    def issue(self, username: str) -> str:
+        """Retourne un nouveau jeton de session pour `username`."""
+        expiry = int(time.time()) + self._ttl
+        claims = f"{username}:{expiry}:{secrets.token_hex(16)}".encode()
+        return (_b64encode(claims) + "."
+                + _b64encode(self._sign(claims)))
+
+    def verify(self, token: str) -> Optional[str]:
+        """
+        Retourne le nom d'utilisateur du jeton s'il est authentique, non
+        expiré et non révoqué, None sinon.
+        """
+        claims = self._claims(token)
+        if claims is None:
+            return None
+        username, expiry, session_id = claims
+        if expiry <= time.time():
+            return None
+        self._refresh()
+        if session_id in self._revoked:
+            return None
+        return username
+
+    def revoke(self, token: str) -> None:
+        """Révoque le jeton, s'il est authentique, pour tous les processus."""
+        claims = self._claims(token)
+        if claims is None:
+            return
+        _, expiry, session_id = claims
+        # a rewrite must not drop a revocation appended while it runs
+        with gloindex.locked(self._directory(), exclusive=False):
+            fd = os.open(self._revoked_path,
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                os.write(fd, f"{session_id} {expiry}\n".encode())
+            finally:
+                os.close(fd)
+        self._revoked[session_id] = expiry
+
+    def _sign(self, claims: bytes) -> bytes:
+        return hmac.new(self._key, claims, hashlib.sha256).digest()
+
+    def _claims(self, token: str) -> Optional[Tuple[str, int, str]]:
+        """Retourne le contenu du jeton si sa signature est valide."""
+        if not isinstance(token, str):
+            return None
+        try:
+            encoded, signature = token.split(".")
+            claims = _b64decode(encoded)
+            if not hmac.compare_digest(_b64decode(signature),
+                                       self._sign(claims)):
+                return None
+            username, expiry, session_id = claims.decode().split(":")
+            return username, int(expiry), session_id
+        except ValueError:
+            return None
+
+    def _directory(self) -> str:
+        return os.path.dirname(self._revoked_path) or "."
+
+    def _refresh(self) -> None:
+        """
+        Lit les révocations ajoutées depuis la dernière lecture, puis
+        réécrit le fichier si les jetons expirés y sont majoritaires.
+        """
+        try:
+            stat = os.stat(self._revoked_path)
+        except FileNotFoundError:
+            return
+        if (stat.st_ino, stat.st_size) == self._seen:
+            return
+        self._read()
+        if self._lines > max(_COMPACT_LINES, 2 * len(self._revoked)):
+            self._compact()
+
+    def _read(self) -> None:
+        """Lit la fin du fichier des révocations, ou tout le fichier s'il
+        a été réécrit."""
+        now = time.time()
+        self._revoked = {session_id: expiry
+                         for session_id, expiry in self._revoked.items()
+                         if expiry > now}
+        with open(self._revoked_path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            if stat.st_ino != self._seen[0]:
+                self._offset = self._lines = 0
+            file.seek(self._offset)
+            data = file.read()
+        self._seen = (stat.st_ino, stat.st_size)
+        end = data.rfind(b"\n") + 1
+        self._offset += end
+        lines = data[:end].splitlines()
+        self._lines += len(lines)
+        for line in lines:
+            session_id, expiry = line.decode().split()
+            if int(expiry) > now:
+                self._revoked[session_id] = int(expiry)
+
+    def _compact(self) -> None:
+        """Réécrit le fichier des révocations sans les jetons expirés."""
+        directory = self._directory()
+        with gloindex.locked(directory, exclusive=True):
+            # revocations appended since the last read are kept
+            self._read()
+            fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=directory)
+            try:
+                with os.fdopen(fd, "wb") as file:
+                    file.writelines(f"{session_id} {expiry}\n".encode()
+                                    for session_id, expiry
+                                    in self._revoked.items())
+                os.replace(tmp_path, self._revoked_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            stat = os.stat(self._revoked_path)
+        self._seen = (stat.st_ino, stat.st_size)
+        self._offset = stat.st_size
+        self._lines = len(self._revoked)
+
+
+def _load_key(path: str) -> bytes:
+    """Lit la clé de signature, en la créant si elle n'existe pas."""
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # another process may still be writing it
+        for _ in range(100):
+            with open(path, "rb") as file:
+                key = file.read()
+            if len(key) == _KEY_SIZE:
+                return key
+            time.sleep(0.01)
+        raise ValueError("Clé de session invalide : " + path)
+    key = secrets.token_bytes(_KEY_SIZE)
+    try:
+        os.write(fd, key)
+    finally:
+        os.close(fd)
+    return key
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    try:
+        return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+    except (ValueError, TypeError) as ex:
+        raise ValueError("Jeton mal formé.") from ex
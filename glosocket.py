@@ -2,8 +2,25 @@
 Module fournissant les fonctions d'envoi et de réception
 de messages de taille arbitraire pour les sockets Python.
 """
+import asyncio
+import collections
+import itertools
 import socket
 import struct
+import zlib
+from typing import Deque, List, Optional, Tuple, Union
+
+
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+COMPRESSION = "zlib"
+COMPRESS_THRESHOLD = 1024
+SCRATCH_SIZE = 64 * 1024
+_COMPRESS_LEVEL = 1
+# spare high bit of the length prefix, frames never reach 2 GiB
+_COMPRESSED = 0x80000000
+_HEADER = struct.Struct("!I")
+_IOV_MAX = 64
+_HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
 
 
 class GLOSocketError(Exception):
@@ -13,55 +30,342 @@ class GLOSocketError(Exception):
     """
 
 
-def _recvall(source: socket.socket, size: int) -> bytes:
+class FrameReader:
+    """
+    Décodeur incrémental des messages préfixés par leur longueur.
+
+    Chaque appel à `recv_from` n'effectue qu'une seule lecture, il peut
+    donc suivre un `select` ou être utilisé sur un socket non bloquant.
+    Le corps de chaque message est alloué une seule fois à sa taille
+    finale puis rempli avec `recv_into`, sans concaténation.
+
+    Un message compressé est décompressé à sa réception. Un message
+    annonçant plus de `max_frame_size` octets, ou dont la décompression
+    en dépasserait autant, lève une exception GLOSocketError.
+
+    Les lectures passent par le tampon `scratch`, d'au moins
+    SCRATCH_SIZE octets, dont le contenu est recopié avant le retour de
+    `recv_from`: les décodeurs d'un même fil d'exécution peuvent donc le
+    partager. Sans `scratch`, le décodeur alloue le sien.
+    """
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE,
+                 scratch: Optional[bytearray] = None) -> None:
+        self._max_frame_size = max_frame_size
+        self._scratch = (bytearray(SCRATCH_SIZE) if scratch is None
+                         else scratch)
+        self._header = bytearray(_HEADER.size)
+        self._header_len = 0
+        self._body: Optional[memoryview] = None
+        self._body_len = 0
+        self._compressed = False
+
+    def _start_body(self) -> Optional[bytearray]:
+        """Alloue le corps annoncé par l'entête, ou le retourne s'il est vide."""
+        length, self._compressed = _parse_header(self._header,
+                                                 self._max_frame_size)
+        self._header_len = 0
+        if length == 0:
+            return bytearray()
+        self._body = memoryview(bytearray(length))
+        self._body_len = 0
+        return None
+
+    def _end_body(self) -> Optional[bytearray]:
+        """Retourne le corps courant, décompressé, s'il est complet."""
+        if self._body is None or self._body_len < len(self._body):
+            return None
+        frame = self._body.obj
+        self._body.release()
+        self._body = None
+        if self._compressed:
+            return decompress(frame, self._max_frame_size)
+        return frame
+
+    def feed(self, data: Union[bytes, bytearray, memoryview]
+             ) -> List[bytearray]:
+        """
+        Ajoute des octets reçus et retourne la liste des messages complétés.
+        """
+        frames = []
+        view = memoryview(data)
+        while view:
+            if self._body is None:
+                taken = min(len(view), _HEADER.size - self._header_len)
+                self._header[self._header_len:self._header_len + taken] = \
+                    view[:taken]
+                self._header_len += taken
+                view = view[taken:]
+                if self._header_len < _HEADER.size:
+                    break
+                frame = self._start_body()
+                if frame is not None:
+                    frames.append(frame)
+                continue
+            taken = min(len(view), len(self._body) - self._body_len)
+            self._body[self._body_len:self._body_len + taken] = view[:taken]
+            self._body_len += taken
+            view = view[taken:]
+            frame = self._end_body()
+            if frame is not None:
+                frames.append(frame)
+        return frames
+
+    def recv_from(self, source: socket.socket) -> List[bytearray]:
+        """
+        Effectue une lecture sur `source` et retourne les messages complétés.
+
+        Un socket non bloquant sans données disponibles donne une liste vide.
+        Lève une exception GLOSocketError si la connexion est fermée.
+        """
+        large_body = (self._body is not None
+                      and len(self._body) - self._body_len >= SCRATCH_SIZE)
+        target = (self._body[self._body_len:] if large_body
+                  else memoryview(self._scratch))
+        try:
+            nbytes = source.recv_into(target)
+        except BlockingIOError:
+            return []
+        except OSError as ex:
+            raise GLOSocketError("The source socket is closed.") from ex
+        finally:
+            target.release()
+        if not nbytes:
+            raise GLOSocketError("The other socket is closed.")
+        if not large_body:
+            return self.feed(memoryview(self._scratch)[:nbytes])
+        self._body_len += nbytes
+        frame = self._end_body()
+        return [] if frame is None else [frame]
+
+
+class FrameWriter:
+    """
+    Tampon d'envoi des messages préfixés par leur longueur.
+
+    Le préfixe et le corps restent des tampons distincts, transmis ensemble
+    par `sendmsg` (scatter-gather) sans être recopiés dans un nouveau tampon.
+    """
+
+    def __init__(self) -> None:
+        self._buffers: Deque[memoryview] = collections.deque()
+        self._pending = 0
+
+    def __len__(self) -> int:
+        """Nombre d'octets en attente d'envoi."""
+        return self._pending
+
+    def write(self, data: Union[bytes, bytearray],
+              compress_threshold: Optional[int] = None) -> None:
+        """
+        Ajoute un message à la file d'envoi.
+
+        Avec un `compress_threshold`, négocié avec le pair, un message d'au
+        moins autant d'octets est compressé si cela le raccourcit.
+        """
+        prefix, data = _frame(data, compress_threshold)
+        self._buffers.append(memoryview(prefix))
+        if data:
+            self._buffers.append(memoryview(data))
+        self._pending += _HEADER.size + len(data)
+
+    def _send(self, dest: socket.socket) -> int:
+        """Envoie le plus possible des premiers tampons en un appel."""
+        if _HAS_SENDMSG:
+            return dest.sendmsg(itertools.islice(self._buffers, _IOV_MAX))
+        return dest.send(self._buffers[0])
+
+    def flush(self, dest: socket.socket) -> bool:
+        """
+        Transmet les données en attente à `dest`.
+
+        Sur un socket bloquant, tout est envoyé; sur un socket non bloquant,
+        l'envoi s'arrête lorsque le noyau ne peut plus rien accepter.
+        Retourne True si le tampon est vide. Lève une exception
+        GLOSocketError en cas de problème de communication.
+        """
+        while self._buffers:
+            try:
+                sent = self._send(dest)
+            except BlockingIOError:
+                return False
+            except OSError as ex:
+                raise GLOSocketError("Cannot send data with socket") from ex
+            self._pending -= sent
+            while sent:
+                head = self._buffers[0]
+                if sent < len(head):
+                    self._buffers[0] = head[sent:]
+                    break
+                sent -= len(head)
+                self._buffers.popleft()
+        return True
+
+
+def _frame(data: Union[bytes, bytearray], compress_threshold: Optional[int]
+           ) -> Tuple[bytes, Union[bytes, bytearray]]:
+    """
+    Retourne le préfixe et le corps du message `data`, compressé s'il
+    atteint `compress_threshold` octets et que la compression le raccourcit.
+    """
+    length = len(data)
+    if compress_threshold is not None and length >= compress_threshold:
+        compressed = zlib.compress(data, _COMPRESS_LEVEL)
+        if len(compressed) < length:
+            return _HEADER.pack(len(compressed) | _COMPRESSED), compressed
+    return _HEADER.pack(length), data
+
+
+def _parse_header(header: Union[bytes, bytearray],
+                  max_frame_size: int) -> Tuple[int, bool]:
+    """
+    Retourne la longueur annoncée par le préfixe d'un message et si le
+    message est compressé.
+    """
+    length, = _HEADER.unpack(header)
+    compressed = bool(length & _COMPRESSED)
+    length &= ~_COMPRESSED
+    if length > max_frame_size:
+        raise GLOSocketError(f"Frame of {length} bytes exceeds the"
+                             f" {max_frame_size} bytes limit.")
+    return length, compressed
+
+
+def decompress(data: Union[bytes, bytearray],
+               max_frame_size: int) -> bytearray:
+    """
+    Décompresse un message reçu compressé.
+
+    La décompression s'arrête dès que `max_frame_size` octets sont
+    dépassés, une bombe de décompression ne peut donc pas épuiser la
+    mémoire. Lève une exception GLOSocketError si le message est invalide
+    ou trop grand.
+    """
+    decompressor = zlib.decompressobj()
+    try:
+        frame = decompressor.decompress(data, max_frame_size + 1)
+    except zlib.error as ex:
+        raise GLOSocketError("Invalid compressed frame.") from ex
+    if len(frame) > max_frame_size:
+        raise GLOSocketError(f"Decompressed frame exceeds the"
+                             f" {max_frame_size} bytes limit.")
+    if not decompressor.eof or decompressor.unused_data:
+        raise GLOSocketError("Invalid compressed frame.")
+    return bytearray(frame)
+
+
+def _recvall(source: socket.socket, size: int) -> bytearray:
     """
     Fonction utilitaire pour recv_mesg.
 
-    Applique socket.recv en boucle pour jusqu'à la
-    réception d'un message de la taille voulue.
+    Applique socket.recv_into en boucle dans un tampon préalloué jusqu'à
+    la réception d'un message de la taille voulue.
     """
-    msg = b""
-    while size > 0:
-        chunk_size = min(size, 4096)
+    msg = bytearray(size)
+    view = memoryview(msg)
+    received = 0
+    while received < size:
         try:
-            buffer = source.recv(chunk_size)
+            nbytes = source.recv_into(view[received:])
         except OSError as ex:
             raise GLOSocketError("The source socket is closed.") from ex
-        if not buffer:
+        if not nbytes:
             raise GLOSocketError("The other socket is closed.")
-        msg += buffer
-        size -= len(buffer)
+        received += nbytes
     return msg
 
 
-def send_mesg(dest_soc: socket.socket, message: str) -> None:
+def send_mesg(dest_soc: socket.socket, message: Union[str, bytes],
+              compress_threshold: Optional[int] = None) -> None:
     """
-    Encode le message puis le transmet à la destination.
+    Encode le message, s'il n'est pas déjà en octets, puis le transmet à
+    la destination, compressé selon `compress_threshold` (voir
+    FrameWriter.write).
 
     Lève une exception GLOSocketError en cas de problème
     de communication.
     """
-    data = message.encode(encoding='utf-8')
-    data_length = struct.pack("!I", len(data))
-    try:
-        dest_soc.sendall(data_length + data)
-    except OSError as ex:
-        raise GLOSocketError("Cannot send data with socket") from ex
+    if isinstance(message, str):
+        message = message.encode(encoding='utf-8')
+    writer = FrameWriter()
+    writer.write(message, compress_threshold)
+    writer.flush(dest_soc)
 
 
-def recv_mesg(source_soc: socket.socket) -> str:
+def recv_mesg(source_soc: socket.socket,
+              max_frame_size: int = MAX_FRAME_SIZE) -> str:
     """
     Récupère un message de la source et le décode.
 
     Lève une exception GLOSocketError en cas de problème
-    de communication.
+    de communication ou si le message dépasse `max_frame_size` octets.
+    """
+    return recv_frame(source_soc, max_frame_size).decode('utf-8')
+
+
+def recv_frame(source_soc: socket.socket,
+               max_frame_size: int = MAX_FRAME_SIZE) -> bytearray:
+    """
+    Récupère un message de la source, décompressé s'il y a lieu, sans le
+    décoder.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication ou si le message dépasse `max_frame_size` octets.
     """
     data_length = _recvall(source_soc, 4)
+    length, compressed = _parse_header(data_length, max_frame_size)
+    data = _recvall(source_soc, length)
+    if compressed:
+        return decompress(data, max_frame_size)
+    return data
+
+
+async def send_mesg_async(dest: asyncio.StreamWriter,
+                          message: Union[str, bytes],
+                          compress_threshold: Optional[int] = None,
+                          timeout: Optional[float] = None) -> None:
+    """
+    Équivalent de send_mesg pour un flux asyncio.
+
+    N'attend que le vidage du tampon de ce flux, un pair lent ne bloque
+    donc pas les autres connexions. Lève une exception GLOSocketError en
+    cas de problème de communication, ou si le tampon n'est pas vidé en
+    `timeout` secondes.
+    """
+    data = (message.encode(encoding='utf-8') if isinstance(message, str)
+            else message)
     try:
-        length, = struct.unpack("!I", data_length)
-    except struct.error as ex:
-        raise GLOSocketError("The received data was"
-                             " not the message's length") from ex
+        dest.writelines(_frame(data, compress_threshold))
+        await asyncio.wait_for(dest.drain(), timeout)
+    except asyncio.TimeoutError as ex:
+        raise GLOSocketError("The other socket stopped reading.") from ex
+    except OSError as ex:
+        raise GLOSocketError("Cannot send data with socket") from ex
 
-    data = _recvall(source_soc, length)
-    return data.decode('utf-8')
+
+async def recv_mesg_async(source: asyncio.StreamReader,
+                          max_frame_size: int = MAX_FRAME_SIZE) -> str:
+    """Équivalent de recv_mesg pour un flux asyncio."""
+    return (await recv_frame_async(source, max_frame_size)).decode('utf-8')
+
+
+async def recv_frame_async(source: asyncio.StreamReader,
+                           max_frame_size: int = MAX_FRAME_SIZE) -> bytes:
+    """
+    Équivalent de recv_frame pour un flux asyncio.
+
+    Un message partiel suspend uniquement la tâche qui le lit. Lève une
+    exception GLOSocketError en cas de problème de communication ou si
+    le message dépasse `max_frame_size` octets.
+    """
+    try:
+        data_length = await source.readexactly(4)
+        length, compressed = _parse_header(data_length, max_frame_size)
+        data = await source.readexactly(length)
+    except asyncio.IncompleteReadError as ex:
+        raise GLOSocketError("The other socket is closed.") from ex
+    except OSError as ex:
+        raise GLOSocketError("The source socket is closed.") from ex
+    if compressed:
+        return decompress(data, max_frame_size)
+    return data
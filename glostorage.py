@@ -0,0 +1,783 @@
+"""\
+Module fournissant les stockages des boîtes de réception du serveur.
+
+Deux stockages offrent la même interface:
+- `FileBackend` garde un fichier par courriel dans le dossier INBOX;
+- `SegmentBackend` ajoute les courriels à la suite dans des fichiers
+  segments par utilisateur, retrouvés grâce à un index de positions à
+  largeur fixe et lus en découpant une projection mmap.
+
+`MailStore` choisit le stockage de chaque utilisateur selon la disposition
+de son dossier. Exécuté comme script, le module migre les boîtes d'un
+fichier par courriel vers les segments (serveur arrêté).
+"""
+import argparse
+import codecs
+import collections
+import contextlib
+import io
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from typing import (BinaryIO, Dict, Iterable, Iterator, List, NamedTuple,
+                    Sequence, Set, TextIO, Tuple, Union)
+
+import gloindex
+import glosearch
+import glousers
+import gloutils
+
+INBOX_DIRNAME = "INBOX"
+SEGMENTS_DIRNAME = "SEGMENTS"
+OFFSETS_FILENAME = "offsets"
+SEGMENT_MAX_SIZE = 16 * 1024 * 1024
+
+
+class SpooledBody:
+    """
+    Corps d'un courriel reçu par morceaux, conservé dans un fichier
+    temporaire de SERVER_DATA_DIR plutôt qu'en mémoire.
+
+    Une fois fermé, il tient lieu de `content` dans un EmailContentPayload
+    à déposer: les stockages le recopient par morceaux. Il est supprimé
+    avec `discard` lorsque le dépôt est terminé.
+    """
+
+    def __init__(self) -> None:
+        fd, self.path = tempfile.mkstemp(prefix=".spool-",
+                                         dir=gloutils.SERVER_DATA_DIR)
+        self._file: BinaryIO = os.fdopen(fd, "wb")
+        self.size = 0
+
+    def write(self, text: str) -> None:
+        """Ajoute un morceau du corps."""
+        data = text.encode("utf-8")
+        self._file.write(data)
+        self.size += len(data)
+
+    def close(self) -> None:
+        """Termine l'écriture du corps."""
+        self._file.close()
+
+    def discard(self) -> None:
+        """Ferme et supprime le fichier temporaire."""
+        self._file.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+    def __iter__(self) -> Iterator[str]:
+        """Morceaux du corps, d'au plus STREAM_CHUNK_SIZE caractères."""
+        with open(self.path, "r", encoding="utf-8", newline="") as file:
+            while True:
+                text = file.read(gloutils.STREAM_CHUNK_SIZE)
+                if not text:
+                    return
+                yield text
+
+    def blocks(self) -> Iterator[bytes]:
+        """Octets du corps, par blocs d'au plus STREAM_CHUNK_SIZE octets."""
+        with open(self.path, "rb") as file:
+            while True:
+                data = file.read(gloutils.STREAM_CHUNK_SIZE)
+                if not data:
+                    return
+                yield data
+
+
+def format_header(payload: gloutils.EmailContentPayload) -> str:
+    """Met en forme l'en-tête d'un courriel, ligne vide comprise."""
+    return ("FROM: " + payload["sender"] + "\n"
+            + "TO: " + payload["destination"] + "\n"
+            + "SUBJECT: " + payload["subject"] + "\n"
+            + "DATE: " + payload["date"] + "\n"
+            + "\n")
+
+
+def format_email(payload: gloutils.EmailContentPayload) -> str:
+    """Met en forme un courriel tel qu'il est conservé par le serveur."""
+    return format_header(payload) + payload["content"]
+
+
+def email_blocks(payload: gloutils.EmailContentPayload) -> Iterator[bytes]:
+    """
+    Octets d'un courriel mis en forme par `format_email`, par blocs: son
+    corps peut être un SpooledBody, recopié sans être chargé en mémoire.
+    """
+    yield format_header(payload).encode("utf-8")
+    content = payload["content"]
+    if isinstance(content, SpooledBody):
+        yield from content.blocks()
+    else:
+        yield content.encode("utf-8")
+
+
+def email_size(payload: gloutils.EmailContentPayload) -> int:
+    """Taille en octets du courriel mis en forme par `format_email`."""
+    content = payload["content"]
+    return (len(format_header(payload).encode("utf-8"))
+            + (content.size if isinstance(content, SpooledBody)
+               else len(content.encode("utf-8"))))
+
+
+def parse_header(file: TextIO) -> gloutils.EmailContentPayload:
+    """
+    Analyse l'en-tête d'un courriel mis en forme par `format_email`. Le
+    contenu du payload retourné est vide, `file` étant positionné au début
+    du corps.
+    """
+    payload = gloutils.EmailContentPayload()
+    payload["sender"] = file.readline()[6:-1]
+    payload["destination"] = file.readline()[4:-1]
+    payload["subject"] = file.readline()[9:-1]
+    payload["date"] = file.readline()[6:-1]
+    file.readline()
+    payload["content"] = ""
+    return payload
+
+
+def parse_email(file: TextIO) -> gloutils.EmailContentPayload:
+    """Analyse un courriel mis en forme par `format_email`."""
+    payload = parse_header(file)
+    payload["content"] = file.read()
+    return payload
+
+
+def _text_chunks(file: TextIO) -> Iterator[str]:
+    """Reste de `file` par morceaux d'au plus STREAM_CHUNK_SIZE caractères,
+    le fichier étant fermé à la fin."""
+    with file:
+        while True:
+            text = file.read(gloutils.STREAM_CHUNK_SIZE)
+            if not text:
+                return
+            yield text
+
+
+def _decoded_chunks(file: BinaryIO, length: int) -> Iterator[str]:
+    """
+    `length` octets de `file`, décodés par morceaux d'au plus
+    STREAM_CHUNK_SIZE octets, le fichier étant fermé à la fin.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    with file:
+        while length > 0:
+            data = file.read(min(length, gloutils.STREAM_CHUNK_SIZE))
+            if not data:
+                break
+            length -= len(data)
+            text = decoder.decode(data)
+            if text:
+                yield text
+        text = decoder.decode(b"", final=True)
+        if text:
+            yield text
+
+
+def write_atomic(directory: str, name: str, blocks: Iterable[bytes]
+                 ) -> Tuple[str, os.stat_result]:
+    """
+    Écrit les octets de `blocks` dans un nouveau fichier `name` de
+    `directory` de façon atomique.
+
+    Le texte est écrit dans un fichier temporaire puis lié sous son nom
+    définitif: aucun lecteur ne voit de fichier partiel et deux écritures
+    simultanées ne s'écrasent pas, un suffixe unique étant ajouté au nom en
+    cas de collision. Retourne le nom final et les métadonnées du fichier.
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-",
+                                    dir=gloutils.SERVER_DATA_DIR)
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.writelines(blocks)
+            file.flush()
+            stat = os.fstat(file.fileno())
+        # on collision, suffix with the unique part of the temp name
+        final_name, suffix = name, 0
+        token = os.path.basename(tmp_path)[len(".tmp-"):]
+        while True:
+            try:
+                os.link(tmp_path, directory + "/" + final_name)
+                return final_name, stat
+            except FileExistsError:
+                suffix += 1
+                final_name = name + "_" + token + "_" + str(suffix)
+    finally:
+        os.unlink(tmp_path)
+
+
+def _user_dir(username: str) -> str:
+    return glousers.user_dir(username)
+
+
+def _index_path(username: str) -> str:
+    return _user_dir(username) + "/" + gloutils.INBOX_INDEX_FILENAME
+
+
+def _search_path(username: str) -> str:
+    return _user_dir(username) + "/" + gloutils.SEARCH_INDEX_FILENAME
+
+
+class FileBackend:
+    """Stockage d'un fichier par courriel dans le dossier INBOX."""
+
+    def __init__(self) -> None:
+        self._mailboxes: Dict[str, gloindex.InboxIndex] = {}
+
+    def _inbox(self, username: str) -> str:
+        return _user_dir(username) + "/" + INBOX_DIRNAME
+
+    def exists(self, username: str) -> bool:
+        """Vrai si l'utilisateur a une boîte dans ce stockage."""
+        return os.path.isdir(self._inbox(username))
+
+    def create_mailbox(self, username: str) -> None:
+        """Crée la boîte vide d'un nouvel utilisateur."""
+        os.mkdir(self._inbox(username))
+
+    def mailbox(self, username: str) -> gloindex.InboxIndex:
+        """Retourne l'index de la boîte de l'utilisateur."""
+        index = self._mailboxes.get(username)
+        if index is None:
+            inbox = self._inbox(username)
+            index = gloindex.InboxIndex(inbox, _index_path(username), inbox,
+                                        lambda: self._scan(username))
+            self._mailboxes[username] = index
+        return index
+
+    def _scan(self, username: str) -> Iterator[gloindex.IndexRecord]:
+        """Enregistrements d'index de tous les fichiers de la boîte."""
+        inbox = self._inbox(username)
+        for name in os.listdir(inbox):
+            stat = os.stat(inbox + "/" + name)
+            with open(inbox + "/" + name, "r") as file:
+                email = parse_header(file)
+            yield gloindex.IndexRecord(stat.st_mtime_ns, name,
+                                       email["sender"], email["subject"],
+                                       email["date"], stat.st_size)
+
+    def deliver(self, username: str,
+                payloads: Sequence[gloutils.EmailContentPayload]
+                ) -> Tuple[List[str], List[str]]:
+        """
+        Dépose les courriels dans la boîte puis les ajoute à l'index en une
+        seule écriture.
+
+        Retourne les noms des courriels et les chemins à synchroniser sur
+        disque pour rendre le dépôt durable: les fichiers des courriels puis
+        le dossier INBOX.
+        """
+        index = self.mailbox(username)
+        inbox = self._inbox(username)
+        names = []
+        paths = []
+        with index.updating():
+            records = []
+            for payload in payloads:
+                name, stat = write_atomic(
+                    inbox,
+                    payload["sender"] + "_" + payload["date"].replace(":", "-"),
+                    email_blocks(payload))
+                names.append(name)
+                paths.append(inbox + "/" + name)
+                records.append(gloindex.IndexRecord(
+                    stat.st_mtime_ns, name, payload["sender"],
+                    payload["subject"], payload["date"], stat.st_size))
+            index.extend(records)
+        paths.append(inbox)
+        return names, paths
+
+    def read(self, username: str, name: str) -> gloutils.EmailContentPayload:
+        """Lit et analyse le courriel `name` de l'utilisateur."""
+        with open(self._inbox(username) + "/" + name, "r") as file:
+            return parse_email(file)
+
+    def stream(self, username: str, name: str
+               ) -> Tuple[gloutils.EmailContentPayload, Iterator[str]]:
+        """
+        Analyse l'en-tête du courriel `name` de l'utilisateur et retourne
+        son payload, au contenu vide, et les morceaux de son corps.
+        """
+        file = open(self._inbox(username) + "/" + name, "r")
+        return parse_header(file), _text_chunks(file)
+
+    def compact(self, username: str) -> bool:
+        """Rien à compacter: chaque courriel a déjà son propre fichier."""
+        return False
+
+
+class _Offset(NamedTuple):
+    """Entrée de l'index des positions d'un stockage par segments."""
+    order: int
+    segment: int
+    offset: int
+    length: int
+
+
+_OFFSET = struct.Struct("!qIQI")
+
+
+class SegmentBackend:
+    """
+    Stockage des courriels à la suite dans des fichiers segments.
+
+    Le dossier SEGMENTS de l'utilisateur contient les segments numérotés
+    et le fichier `offsets`, dont l'entrée à largeur fixe numéro `n` donne
+    l'ordre d'arrivée, le segment, la position et la longueur du courriel
+    `n`. Le nom d'un courriel est ce numéro, qui ne change jamais.
+
+    Un segment dépassant `max_segment_size` n'est plus prolongé et les
+    numéros de segments ne sont jamais réutilisés. Le compactage recopie
+    les courriels référencés dans de nouveaux segments, éliminant les
+    octets orphelins laissés par un dépôt interrompu.
+    """
+
+    def __init__(self, max_segment_size: int = SEGMENT_MAX_SIZE,
+                 max_maps: int = 64) -> None:
+        self._max_segment_size = max_segment_size
+        self._max_maps = max_maps
+        self._mailboxes: Dict[str, gloindex.InboxIndex] = {}
+        self._maps: "collections.OrderedDict[Tuple[str, int], mmap.mmap]" \
+            = collections.OrderedDict()
+        self._maps_lock = threading.Lock()
+
+    def _dir(self, username: str) -> str:
+        return _user_dir(username) + "/" + SEGMENTS_DIRNAME
+
+    def _offsets_path(self, username: str) -> str:
+        return self._dir(username) + "/" + OFFSETS_FILENAME
+
+    def _segment_path(self, username: str, segment: int) -> str:
+        return self._dir(username) + "/" + format(segment, "08d") + ".seg"
+
+    def exists(self, username: str) -> bool:
+        """Vrai si l'utilisateur a une boîte dans ce stockage."""
+        return os.path.isdir(self._dir(username))
+
+    def create_mailbox(self, username: str) -> None:
+        """Crée la boîte vide d'un nouvel utilisateur."""
+        os.mkdir(self._dir(username))
+        with open(self._offsets_path(username), "wb"):
+            pass
+
+    def mailbox(self, username: str) -> gloindex.InboxIndex:
+        """Retourne l'index de la boîte de l'utilisateur."""
+        index = self._mailboxes.get(username)
+        if index is None:
+            index = gloindex.InboxIndex(self._dir(username),
+                                        _index_path(username),
+                                        self._offsets_path(username),
+                                        lambda: self._scan(username))
+            self._mailboxes[username] = index
+        return index
+
+    def _offsets(self, username: str) -> List[_Offset]:
+        """Entrées complètes de l'index des positions."""
+        with open(self._offsets_path(username), "rb") as file:
+            data = file.read()
+        data = data[:len(data) - len(data) % _OFFSET.size]
+        return [_Offset(*entry) for entry in _OFFSET.iter_unpack(data)]
+
+    def _segments(self, username: str) -> List[int]:
+        """Numéros des segments existants, en ordre croissant."""
+        return sorted(int(name[:-4]) for name in os.listdir(self._dir(username))
+                      if name.endswith(".seg"))
+
+    def _slice(self, username: str, entry: _Offset) -> bytes:
+        """Copie le courriel décrit par `entry` depuis la projection de son
+        segment, projeté à nouveau s'il a grandi depuis."""
+        key = (username, entry.segment)
+        end = entry.offset + entry.length
+        with self._maps_lock:
+            mapped = self._maps.get(key)
+            if mapped is None or len(mapped) < end:
+                if mapped is not None:
+                    mapped.close()
+                with open(self._segment_path(username, entry.segment),
+                          "rb") as file:
+                    mapped = mmap.mmap(file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+                self._maps[key] = mapped
+                while len(self._maps) > self._max_maps:
+                    self._maps.popitem(last=False)[1].close()
+            self._maps.move_to_end(key)
+            return mapped[entry.offset:end]
+
+    def _scan(self, username: str) -> Iterator[gloindex.IndexRecord]:
+        """Enregistrements d'index de tous les courriels des segments."""
+        for number, entry in enumerate(self._offsets(username)):
+            # the header only, unless it is longer than the first block
+            data = self._slice(username, entry._replace(
+                length=min(entry.length, gloutils.STREAM_CHUNK_SIZE)))
+            if data.count(b"\n") < 5:
+                data = self._slice(username, entry)
+            email = parse_header(io.StringIO(data.decode("utf-8", "ignore")))
+            yield gloindex.IndexRecord(entry.order, str(number),
+                                       email["sender"], email["subject"],
+                                       email["date"], entry.length)
+
+    def deliver(self, username: str,
+                payloads: Sequence[gloutils.EmailContentPayload]
+                ) -> Tuple[List[str], List[str]]:
+        """
+        Ajoute les courriels au dernier segment, puis leurs positions à
+        l'index des positions et leurs enregistrements à l'index de la
+        boîte, chacun en une seule écriture.
+
+        Les dépôts d'une même boîte sont sérialisés par un verrou exclusif.
+        Retourne les noms des courriels et les chemins à synchroniser sur
+        disque pour rendre le dépôt durable: les segments écrits, l'index
+        des positions puis, si un segment a été créé, le dossier SEGMENTS.
+        """
+        sizes = [email_size(payload) for payload in payloads]
+        index = self.mailbox(username)
+        with index.updating(exclusive=True):
+            with open(self._offsets_path(username), "r+b") as offsets:
+                # a partial entry left by an interrupted write is dropped
+                end = offsets.seek(0, os.SEEK_END)
+                end -= end % _OFFSET.size
+                offsets.truncate(end)
+                if end:
+                    offsets.seek(end - _OFFSET.size)
+                    segment = _Offset(*_OFFSET.unpack(
+                        offsets.read(_OFFSET.size))).segment
+                else:
+                    segment = max(self._segments(username), default=1)
+                entries: List[_Offset] = []
+                paths = [self._segment_path(username, segment)]
+                file = open(paths[-1], "ab")
+                try:
+                    for payload, size in zip(payloads, sizes):
+                        position = file.tell()
+                        if position and position + size > self._max_segment_size:
+                            file.close()
+                            segment += 1
+                            paths.append(self._segment_path(username, segment))
+                            file = open(paths[-1], "ab")
+                            position = file.tell()
+                        file.writelines(email_blocks(payload))
+                        entries.append(_Offset(time.time_ns(), segment,
+                                               position, size))
+                finally:
+                    file.close()
+                offsets.seek(end)
+                offsets.write(b"".join(_OFFSET.pack(*entry) for entry in entries))
+            first = end // _OFFSET.size
+            index.extend(gloindex.IndexRecord(
+                entry.order, str(first + number), payload["sender"],
+                payload["subject"], payload["date"], entry.length)
+                for number, (entry, payload)
+                in enumerate(zip(entries, payloads)))
+        paths.append(self._offsets_path(username))
+        if not end or len(paths) > 2:
+            paths.append(self._dir(username))
+        return [str(first + number) for number in range(len(entries))], paths
+
+    def _entry(self, username: str, name: str) -> _Offset:
+        """Entrée de l'index des positions du courriel numéro `name`."""
+        with open(self._offsets_path(username), "rb") as file:
+            file.seek(int(name) * _OFFSET.size)
+            return _Offset(*_OFFSET.unpack(file.read(_OFFSET.size)))
+
+    def read(self, username: str, name: str) -> gloutils.EmailContentPayload:
+        """Lit et analyse le courriel numéro `name` de l'utilisateur."""
+        for attempt in range(2):
+            entry = self._entry(username, name)
+            try:
+                text = self._slice(username, entry).decode("utf-8")
+                break
+            except FileNotFoundError:
+                # the segment was compacted away since the offset was read
+                if attempt:
+                    raise
+        return parse_email(io.StringIO(text))
+
+    def stream(self, username: str, name: str
+               ) -> Tuple[gloutils.EmailContentPayload, Iterator[str]]:
+        """
+        Analyse l'en-tête du courriel numéro `name` de l'utilisateur et
+        retourne son payload, au contenu vide, et les morceaux de son corps.
+
+        Le corps est lu par morceaux dans le segment plutôt que dans sa
+        projection, qu'une autre lecture pourrait fermer entre-temps.
+        """
+        for attempt in range(2):
+            entry = self._entry(username, name)
+            try:
+                file = open(self._segment_path(username, entry.segment), "rb")
+                break
+            except FileNotFoundError:
+                # the segment was compacted away since the offset was read
+                if attempt:
+                    raise
+        file.seek(entry.offset)
+        header = b"".join(file.readline() for _ in range(5))
+        payload = parse_header(io.StringIO(header.decode("utf-8")))
+        return payload, _decoded_chunks(file, entry.length - len(header))
+
+    def compact(self, username: str) -> bool:
+        """
+        Recopie les courriels dans le moins de segments possible si des
+        octets orphelins ou des segments superflus existent.
+
+        Les numéros des courriels ne changent pas. Les nouveaux segments
+        sont synchronisés sur disque avant le remplacement atomique de
+        l'index des positions, puis les anciens segments sont supprimés.
+        Retourne True si la boîte a été compactée.
+        """
+        directory = self._dir(username)
+        index = self.mailbox(username)
+        with index.updating(exclusive=True):
+            entries = self._offsets(username)
+            segments = self._segments(username)
+            on_disk = sum(os.path.getsize(self._segment_path(username, number))
+                          for number in segments)
+            live = sum(entry.length for entry in entries)
+            needed = max(1, -(-live // self._max_segment_size))
+            if on_disk == live and len(segments) <= needed:
+                return False
+            segment = segments[-1] if segments else 0
+            compacted: List[_Offset] = []
+            with contextlib.ExitStack() as stack:
+                sources = {}
+                for number in segments:
+                    file = stack.enter_context(open(
+                        self._segment_path(username, number), "rb"))
+                    if os.fstat(file.fileno()).st_size:
+                        sources[number] = stack.enter_context(mmap.mmap(
+                            file.fileno(), 0, access=mmap.ACCESS_READ))
+                out = None
+                for entry in entries:
+                    if out is None or (out.tell() and out.tell() + entry.length
+                                       > self._max_segment_size):
+                        if out is not None:
+                            _close_synced(out)
+                        segment += 1
+                        out = open(self._segment_path(username, segment), "wb")
+                    compacted.append(entry._replace(segment=segment,
+                                                    offset=out.tell()))
+                    out.write(sources[entry.segment][
+                        entry.offset:entry.offset + entry.length])
+                if out is None:
+                    # keep numbering past the removed segments
+                    segment += 1
+                    out = open(self._segment_path(username, segment), "wb")
+                _close_synced(out)
+            fd, tmp_path = tempfile.mkstemp(prefix=".offsets-", dir=directory)
+            with os.fdopen(fd, "wb") as file:
+                for entry in compacted:
+                    file.write(_OFFSET.pack(*entry))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self._offsets_path(username))
+            index.touch()
+            for number in segments:
+                os.unlink(self._segment_path(username, number))
+        return True
+
+    def migrate(self, username: str) -> int:
+        """
+        Convertit la boîte d'un fichier par courriel de l'utilisateur en
+        segments, dans l'ordre d'arrivée. Retourne le nombre de courriels.
+
+        Les segments sont construits dans un dossier temporaire renommé à la
+        fin; le dossier INBOX n'est supprimé qu'ensuite. Une migration
+        interrompue peut donc simplement être relancée.
+        """
+        inbox = _user_dir(username) + "/" + INBOX_DIRNAME
+        if self.exists(username):
+            # a previous run was interrupted after the rename
+            if os.path.isdir(inbox):
+                for name in os.listdir(inbox):
+                    os.unlink(inbox + "/" + name)
+                os.rmdir(inbox)
+            return 0
+        names = sorted(os.listdir(inbox),
+                       key=lambda name: os.stat(inbox + "/" + name).st_mtime_ns)
+        building = tempfile.mkdtemp(prefix=".segments-",
+                                    dir=_user_dir(username))
+        entries: List[_Offset] = []
+        records: List[gloindex.IndexRecord] = []
+        segment, out = 1, open(building + "/" + format(1, "08d") + ".seg", "wb")
+        try:
+            for name in names:
+                stat = os.stat(inbox + "/" + name)
+                with open(inbox + "/" + name, "r") as file:
+                    text = file.read()
+                email = parse_email(io.StringIO(text))
+                data = text.encode("utf-8")
+                if out.tell() and out.tell() + len(data) > self._max_segment_size:
+                    _close_synced(out)
+                    segment += 1
+                    out = open(building + "/" + format(segment, "08d") + ".seg",
+                               "wb")
+                records.append(gloindex.IndexRecord(
+                    stat.st_mtime_ns, str(len(entries)), email["sender"],
+                    email["subject"], email["date"], len(data)))
+                entries.append(_Offset(stat.st_mtime_ns, segment, out.tell(),
+                                       len(data)))
+                out.write(data)
+        finally:
+            _close_synced(out)
+        with open(building + "/" + OFFSETS_FILENAME, "wb") as file:
+            for entry in entries:
+                file.write(_OFFSET.pack(*entry))
+            file.flush()
+            os.fsync(file.fileno())
+        os.rename(building, self._dir(username))
+        gloindex.write_index(_index_path(username), records)
+        # the emails were renamed, the search index is rebuilt when needed
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(_search_path(username))
+        for name in names:
+            os.unlink(inbox + "/" + name)
+        os.rmdir(inbox)
+        return len(names)
+
+
+def _close_synced(file: io.BufferedWriter) -> None:
+    """Ferme un fichier après avoir synchronisé son contenu sur disque."""
+    file.flush()
+    os.fsync(file.fileno())
+    file.close()
+
+
+Backend = Union[FileBackend, SegmentBackend]
+
+
+class MailStore:
+    """
+    Point d'accès unique aux boîtes de réception.
+
+    Chaque utilisateur est servi par le stockage correspondant à la
+    disposition de son dossier; les nouvelles boîtes sont créées dans le
+    stockage `default` ("files" ou "segments"). Quel que soit le stockage,
+    chaque boîte a aussi son index de recherche plein texte.
+    """
+
+    def __init__(self, default: str = "files") -> None:
+        self._backends: Dict[str, Backend] = {"files": FileBackend(),
+                                              "segments": SegmentBackend()}
+        self._default = self._backends[default]
+        self._owners: Dict[str, Backend] = {}
+        self._searches: Dict[str, glosearch.SearchIndex] = {}
+
+    def _backend(self, username: str) -> Backend:
+        backend = self._owners.get(username)
+        if backend is None:
+            segments = self._backends["segments"]
+            backend = (segments if segments.exists(username)
+                       else self._backends["files"])
+            self._owners[username] = backend
+        return backend
+
+    def exists(self, username: str) -> bool:
+        """Vrai si l'utilisateur a une boîte."""
+        return any(backend.exists(username)
+                   for backend in self._backends.values())
+
+    def users(self) -> Iterator[str]:
+        """Noms des utilisateurs ayant une boîte."""
+        for username in glousers.walk():
+            if self.exists(username):
+                yield username
+
+    def create_mailbox(self, username: str) -> None:
+        """Crée la boîte vide d'un nouvel utilisateur et son index de
+        recherche."""
+        self._default.create_mailbox(username)
+        self._owners[username] = self._default
+        self._search_index(username).create()
+
+    def mailbox(self, username: str) -> gloindex.InboxIndex:
+        """Retourne l'index de la boîte de l'utilisateur."""
+        return self._backend(username).mailbox(username)
+
+    def _search_index(self, username: str) -> glosearch.SearchIndex:
+        search = self._searches.get(username)
+        if search is None:
+            backend = self._backend(username)
+            search = glosearch.SearchIndex(
+                backend.mailbox(username), _search_path(username),
+                lambda name: backend.stream(username, name))
+            self._searches[username] = search
+        return search
+
+    def deliver(self, username: str,
+                payloads: Sequence[gloutils.EmailContentPayload],
+                search: bool = True) -> List[str]:
+        """
+        Dépose les courriels dans la boîte de l'utilisateur puis, avec
+        `search`, les ajoute à son index de recherche. Retourne les chemins
+        à synchroniser sur disque pour rendre le dépôt durable.
+
+        L'index de recherche n'en fait pas partie: il est complété à partir
+        de la boîte s'il lui manque des courriels.
+        """
+        names, paths = self._backend(username).deliver(username, payloads)
+        if search:
+            self._search_index(username).append(list(zip(names, payloads)))
+        return paths
+
+    def search(self, username: str, query: str) -> Set[str]:
+        """
+        Noms des courriels de l'utilisateur contenant tous les mots de
+        `query`, sans lire les courriels.
+        """
+        return self._search_index(username).search(query)
+
+    def search_outdated(self, username: str) -> bool:
+        """
+        Vrai si l'index de recherche de l'utilisateur doit être complété ou
+        fusionné avant une recherche (voir `catch_up_search`).
+        """
+        return self._search_index(username).outdated()
+
+    def catch_up_search(self, username: str) -> None:
+        """
+        Complète et fusionne l'index de recherche de l'utilisateur, en
+        reconstruisant au besoin l'index de sa boîte. Les index en mémoire
+        ne sont pas modifiés: elle peut être appelée hors de la boucle du
+        serveur.
+        """
+        self._search_index(username).catch_up()
+
+    def read(self, username: str, name: str) -> gloutils.EmailContentPayload:
+        """Lit le courriel `name` de l'utilisateur."""
+        return self._backend(username).read(username, name)
+
+    def stream(self, username: str, name: str
+               ) -> Tuple[gloutils.EmailContentPayload, Iterator[str]]:
+        """
+        Retourne l'en-tête du courriel `name` de l'utilisateur, au contenu
+        vide, et les morceaux de son corps, lus au fil de l'itération.
+        """
+        return self._backend(username).stream(username, name)
+
+    def compact(self, username: str) -> bool:
+        """Compacte la boîte de l'utilisateur si son stockage le permet."""
+        return self._backend(username).compact(username)
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Migre les boîtes d'un fichier par courriel vers les"
+                    " segments. Le serveur doit être arrêté.")
+    parser.add_argument("usernames", nargs="*",
+                        help="Utilisateurs à migrer (tous par défaut).")
+    args = parser.parse_args(sys.argv[1:])
+    backend = SegmentBackend()
+    usernames = args.usernames or [
+        username for username in glousers.walk()
+        if os.path.isdir(_user_dir(username) + "/" + INBOX_DIRNAME)]
+    for username in usernames:
+        count = backend.migrate(username)
+        print(f"{username} : {count} courriels migrés")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -0,0 +1,84 @@
+"""\
+Module fournissant les échéances du serveur: un tas d'échéances par clé,
+repoussées sans coût au fil de l'activité des connexions.
+"""
+import heapq
+import itertools
+from typing import Dict, Hashable, List, Optional, Tuple
+
+# smaller heaps are never rebuilt
+_REBUILD_MIN = 64
+
+
+class Deadlines:
+    """
+    Échéance de chaque clé, rangée dans un tas.
+
+    Repousser une échéance ne fait que remplacer sa valeur: l'entrée déjà
+    dans le tas, plus proche, est replacée lorsqu'elle arrive à terme. Une
+    clé n'a donc qu'une entrée dans le tas tant que son échéance ne fait
+    que reculer, quel que soit le nombre de mises à jour. Une clé retirée
+    ou avancée laisse une entrée périmée; le tas est reconstruit avec les
+    seules entrées vivantes lorsque les périmées sont majoritaires.
+    """
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._counter = itertools.count()
+        self._deadlines: Dict[Hashable, float] = {}
+        # earliest live heap entry of each key
+        self._queued: Dict[Hashable, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._deadlines
+
+    def set(self, key: Hashable, deadline: float) -> None:
+        """Fixe l'échéance de `key`, en remplaçant la précédente."""
+        self._deadlines[key] = deadline
+        queued = self._queued.get(key)
+        if queued is None or deadline < queued:
+            self._push(key, deadline)
+
+    def discard(self, key: Hashable) -> None:
+        """Retire l'échéance de `key`, si elle en a une."""
+        self._deadlines.pop(key, None)
+        if self._queued.pop(key, None) is not None:
+            self._rebuild_if_stale()
+
+    def next(self) -> Optional[float]:
+        """Prochaine échéance, possiblement périmée, ou None."""
+        return self._heap[0][0] if self._heap else None
+
+    def expired(self, now: float) -> List[Hashable]:
+        """Retire et retourne les clés dont l'échéance est passée."""
+        keys = []
+        while self._heap and self._heap[0][0] <= now:
+            queued, _, key = heapq.heappop(self._heap)
+            if self._queued.get(key) == queued:
+                del self._queued[key]
+            deadline = self._deadlines.get(key)
+            if deadline is None:
+                continue
+            if deadline <= now:
+                del self._deadlines[key]
+                keys.append(key)
+            elif key not in self._queued:
+                self._push(key, deadline)
+        return keys
+
+    def _push(self, key: Hashable, deadline: float) -> None:
+        heapq.heappush(self._heap, (deadline, next(self._counter), key))
+        self._queued[key] = deadline
+        self._rebuild_if_stale()
+
+    def _rebuild_if_stale(self) -> None:
+        """Reconstruit le tas si ses entrées périmées sont majoritaires."""
+        if (len(self._heap) < _REBUILD_MIN
+                or len(self._heap) <= 2 * len(self._queued)):
+            return
+        self._heap = [(deadline, next(self._counter), key)
+                      for key, deadline in self._queued.items()]
+        heapq.heapify(self._heap)
@@ -0,0 +1,202 @@
+"""\
+Module fournissant l'annuaire des utilisateurs du serveur.
+
+Les dossiers des utilisateurs sont répartis dans SERVER_DATA_DIR selon le
+préfixe du hachage de leur nom (`ab/cd/nom`): aucun dossier ne contient
+plus de quelques centaines d'entrées, même avec des centaines de milliers
+de comptes. Les noms des utilisateurs sont tenus en mémoire: vérifier
+qu'un utilisateur existe ne consulte pas leurs dossiers.
+
+Exécuté comme script, le module range les dossiers de l'ancienne
+disposition à plat selon leur préfixe (serveur arrêté). Le serveur le fait
+aussi à son premier démarrage.
+"""
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import uuid
+from typing import Iterator, Set, Tuple
+
+import gloindex
+import gloutils
+
+_SHARD_CHARS = frozenset("0123456789abcdef")
+# flat user folders are moved here before any shard folder is created
+_STAGING_DIRNAME = ".migrate"
+
+
+def user_dir(username: str) -> str:
+    """Dossier de l'utilisateur, selon le préfixe du hachage de son nom."""
+    digest = hashlib.sha1(username.encode("utf-8")).hexdigest()
+    return (gloutils.SERVER_DATA_DIR + "/" + digest[:2] + "/" + digest[2:4]
+            + "/" + username)
+
+
+def _is_shard(name: str) -> bool:
+    return len(name) == 2 and set(name) <= _SHARD_CHARS
+
+
+def walk() -> Iterator[str]:
+    """Noms de tous les utilisateurs ayant un dossier."""
+    for first in sorted(os.listdir(gloutils.SERVER_DATA_DIR)):
+        path = gloutils.SERVER_DATA_DIR + "/" + first
+        if not _is_shard(first) or not os.path.isdir(path):
+            continue
+        for second in sorted(os.listdir(path)):
+            if _is_shard(second) and os.path.isdir(path + "/" + second):
+                yield from os.listdir(path + "/" + second)
+
+
+def _flat_users() -> Iterator[str]:
+    """Dossiers d'utilisateurs de l'ancienne disposition à plat."""
+    for name in os.listdir(gloutils.SERVER_DATA_DIR):
+        if os.path.isfile(gloutils.SERVER_DATA_DIR + "/" + name + "/"
+                          + gloutils.PASSWORD_FILENAME):
+            yield name
+
+
+def migrate() -> int:
+    """
+    Range les dossiers d'utilisateurs à plat selon le préfixe de leur nom.
+    Retourne le nombre de dossiers déplacés.
+
+    Les dossiers sont d'abord tous déplacés dans un dossier d'attente: un
+    utilisateur nommé comme un préfixe (`ab`) n'est ainsi jamais confondu
+    avec le dossier de ce préfixe. Une migration interrompue reprend avec
+    les dossiers restés en attente.
+    """
+    staging = gloutils.SERVER_DATA_DIR + "/" + _STAGING_DIRNAME
+    flat_users = list(_flat_users())
+    if not flat_users and not os.path.isdir(staging):
+        return 0
+    os.makedirs(staging, exist_ok=True)
+    for username in flat_users:
+        os.rename(gloutils.SERVER_DATA_DIR + "/" + username,
+                  staging + "/" + username)
+    count = 0
+    for username in os.listdir(staging):
+        target = user_dir(username)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.rename(staging + "/" + username, target)
+        count += 1
+    os.rmdir(staging)
+    return count
+
+
+class UserDirectory:
+    """
+    Ensemble en mémoire des noms d'utilisateurs.
+
+    Il est chargé au démarrage depuis le journal USERS_FILENAME, qui
+    contient une ligne d'en-tête identifiant sa génération puis un nom par
+    ligne; chaque création de compte y est ajoutée. Un nom inconnu fait
+    relire la fin du journal ajoutée depuis, s'il a changé: les comptes
+    créés par les autres processus serveurs sont ainsi connus sans
+    parcourir les dossiers.
+
+    Un journal absent est reconstruit, sous le verrou exclusif de
+    SERVER_DATA_DIR, en parcourant les dossiers après avoir rangé ceux de
+    l'ancienne disposition à plat.
+    """
+
+    def __init__(self) -> None:
+        self._path = gloutils.SERVER_DATA_DIR + "/" + gloutils.USERS_FILENAME
+        self._lock = threading.Lock()
+        self._users: Set[str] = set()
+        self._generation = b""
+        self._offset = 0
+        self._seen: Tuple[int, int] = (0, 0)
+        os.makedirs(gloutils.SERVER_DATA_DIR, exist_ok=True)
+        if not os.path.exists(self._path):
+            with gloindex.locked(gloutils.SERVER_DATA_DIR, exclusive=True):
+                if not os.path.exists(self._path):
+                    migrate()
+                    self._write()
+        self._sync()
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def exists(self, username: str) -> bool:
+        """
+        Vrai si l'utilisateur existe.
+
+        Un nom inconnu coûte un appel à os.stat sur le journal, et sa
+        relecture seulement s'il a changé. Ce résultat n'est pas retenu: un
+        compte créé par un autre processus est connu dès la requête
+        suivante, ce dont dépendent la création de compte (nom en double)
+        et la distribution (courriel perdu).
+        """
+        if username in self._users:
+            return True
+        self._sync()
+        return username in self._users
+
+    def add(self, username: str) -> None:
+        """Ajoute au journal un utilisateur dont le dossier est créé."""
+        fd = os.open(self._path, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, username.encode("utf-8") + b"\n")
+        finally:
+            os.close(fd)
+        self._users.add(username)
+
+    def rebuild(self) -> None:
+        """Reconstruit le journal à partir des dossiers des utilisateurs."""
+        with gloindex.locked(gloutils.SERVER_DATA_DIR, exclusive=True):
+            self._write()
+        self._sync()
+
+    def _write(self) -> None:
+        """Réécrit le journal, sous une nouvelle génération."""
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-",
+                                        dir=gloutils.SERVER_DATA_DIR)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(b"#" + uuid.uuid4().hex.encode() + b"\n")
+                file.writelines(username.encode("utf-8") + b"\n"
+                                for username in walk())
+            os.replace(tmp_path, self._path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _sync(self) -> None:
+        """Lit la partie du journal ajoutée depuis la dernière lecture."""
+        stat = os.stat(self._path)
+        if (stat.st_ino, stat.st_size) == self._seen:
+            return
+        with self._lock, open(self._path, "rb") as file:
+            generation = file.readline()
+            stat = os.fstat(file.fileno())
+            size = stat.st_size
+            self._seen = (stat.st_ino, size)
+            if generation != self._generation or size < self._offset:
+                self._users = set()
+                self._generation, self._offset = generation, file.tell()
+            if size == self._offset:
+                return
+            file.seek(self._offset)
+            data = file.read()
+            # a concurrent append may be partial
+            end = data.rfind(b"\n") + 1
+            self._offset += end
+            self._users.update(data[:end].decode("utf-8").splitlines())
+
+
+def _main() -> int:
+    argparse.ArgumentParser(
+        description="Range les dossiers des utilisateurs selon le préfixe"
+                    " du hachage de leur nom et reconstruit l'annuaire. Le"
+                    " serveur doit être arrêté.").parse_args(sys.argv[1:])
+    count = migrate()
+    UserDirectory().rebuild()
+    print(f"{count} dossiers d'utilisateurs déplacés")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
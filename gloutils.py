@@ -11,6 +11,12 @@ SERVER_DATA_DIR = "glo_server_data"
 SERVER_LOST_DIR = "LOST"
 SERVER_DOMAIN = "glo2000.ca"
 PASSWORD_FILENAME = "pass"  # nosec:B105
+INBOX_INDEX_FILENAME = "INBOX.index"
+SEARCH_INDEX_FILENAME = "SEARCH.index"
+SESSION_KEY_FILENAME = ".session_key"
+SESSION_REVOKED_FILENAME = ".session_revoked"
+USERS_FILENAME = ".users"
+SESSION_TTL = 24 * 60 * 60
 
 CLIENT_AUTH_CHOICE = """Menu de connexion
 1. Créer un compte
@@ -20,10 +26,22 @@ CLIENT_USE_CHOICE = """Menu principal
 1. Consultation de courriels
 2. Envoi de courriels
 3. Statistiques
-4. Se déconnecter"""
+4. Recherche de courriels
+5. Se déconnecter"""
 
 SUBJECT_DISPLAY = "#{number} {sender} - {subject} {date}"
 
+INBOX_PAGE_SIZE = 20
+INBOX_MAX_PAGE_SIZE = 500
+
+BATCH_MAX_RECIPIENTS = 1000
+STREAM_CHUNK_SIZE = 64 * 1024
+DELIVERY_DELIVERED = "delivered"
+DELIVERY_LOST = "lost"
+DELIVERY_EXTERNAL = "external"
+
+DELIVERY_DISPLAY = "{destination} : {status}"
+
 EMAIL_DISPLAY = """De : {sender}
 À : {to}
 Sujet : {subject}
@@ -33,7 +51,8 @@ Date : {date}
 """
 
 STATS_DISPLAY = """Nombre de messages : {count}
-Taille du dossier : {size} octets"""
+Taille du dossier : {size} octets
+Dernier message : {newest_date}"""
 
 
 class Headers(enum.IntEnum):
@@ -55,6 +74,38 @@ class Headers(enum.IntEnum):
 
     STATS_REQUEST = enum.auto()
 
+    INBOX_PAGE_REQUEST = enum.auto()
+
+    EMAIL_BATCH_SENDING = enum.auto()
+
+    HELLO = enum.auto()
+
+    AUTH_RESUME = enum.auto()
+
+    SEARCH_REQUEST = enum.auto()
+
+    EMAIL_STREAM_BEGIN = enum.auto()
+    EMAIL_STREAM_CHUNK = enum.auto()
+    EMAIL_STREAM_END = enum.auto()
+    EMAIL_STREAM_REQUEST = enum.auto()
+
+
+class HelloPayload(TypedDict, total=True):
+    """
+    Payload pour la négociation de l'encodage des messages.
+
+    Le client propose ses `encodings` par ordre de préférence; le serveur
+    répond avec le seul encodage retenu, utilisé pour tous les messages
+    suivants dans les deux sens. Sans négociation, les messages sont en
+    JSON.
+
+    De même pour `compression`: si le serveur retient "zlib", les grands
+    messages qui suivent peuvent être compressés dans les deux sens. Une
+    liste vide désactive la compression.
+    """
+    encodings: list[str]
+    compression: list[str]
+
 
 class ErrorPayload(TypedDict, total=True):
     """Payload pour les messages d'erreurs."""
@@ -67,6 +118,18 @@ class AuthPayload(TypedDict, total=True):
     password: str
 
 
+class SessionPayload(TypedDict, total=True):
+    """
+    Payload du jeton de session.
+
+    Le serveur le joint à sa réponse OK à AUTH_LOGIN et AUTH_REGISTER; le
+    client le renvoie avec AUTH_RESUME pour reprendre sa session sur une
+    nouvelle connexion. Le jeton expire après SESSION_TTL secondes et est
+    révoqué par AUTH_LOGOUT.
+    """
+    token: str
+
+
 class EmailContentPayload(TypedDict, total=True):
     """Payload pour les transferts de courriels."""
     sender: str
@@ -76,20 +139,116 @@ class EmailContentPayload(TypedDict, total=True):
     content: str
 
 
+class EmailChunkPayload(TypedDict, total=True):
+    """
+    Payload d'un morceau du corps d'un courriel transféré par morceaux.
+
+    Un transfert commence par EMAIL_STREAM_BEGIN, dont le payload est un
+    EmailContentPayload au contenu vide, se poursuit par des
+    EMAIL_STREAM_CHUNK d'au plus STREAM_CHUNK_SIZE caractères chacun et se
+    termine par EMAIL_STREAM_END, sans payload.
+
+    Le client envoie ainsi un courriel, auquel le serveur ne répond
+    qu'après EMAIL_STREAM_END, comme à EMAIL_BATCH_SENDING. Le serveur
+    répond de même à EMAIL_STREAM_REQUEST, portant un EmailChoicePayload;
+    chaque message du transfert reprend alors le `request_id` de la
+    requête.
+    """
+    data: str
+
+
+class EmailBatchPayload(TypedDict, total=True):
+    """
+    Payload pour l'envoi groupé de courriels.
+
+    Le champ `destination` de chaque courriel peut contenir plusieurs
+    adresses séparées par des virgules.
+    """
+    emails: list[EmailContentPayload]
+
+
+class DeliveryResultPayload(TypedDict, total=True):
+    """
+    Résultat de l'envoi du courriel numéro `email` du lot à `destination`:
+    DELIVERY_DELIVERED, DELIVERY_LOST ou DELIVERY_EXTERNAL.
+    """
+    email: int
+    destination: str
+    status: str
+
+
+class EmailBatchResultPayload(TypedDict, total=True):
+    """Payload pour les résultats d'un envoi groupé, par destinataire."""
+    results: list[DeliveryResultPayload]
+
+
 class EmailListPayload(TypedDict, total=True):
     """Payload pour les consulation de courriel."""
     email_list: list[str]
 
 
+class InboxPageRequestPayload(TypedDict, total=False):
+    """
+    Payload pour la demande d'une page de la liste des courriels.
+
+    La page commence à `offset` (0 pour les plus récents) ou, si `cursor`
+    est fourni, juste après le dernier courriel de la page précédente.
+    """
+    offset: int
+    limit: int
+    cursor: str
+
+
+class InboxPagePayload(TypedDict, total=True):
+    """
+    Payload pour une page de la liste des courriels.
+
+    `next_cursor` est vide s'il n'y a pas de page suivante.
+    """
+    email_list: list[str]
+    offset: int
+    total: int
+    next_cursor: str
+
+
+class SearchPayload(TypedDict, total=False):
+    """
+    Payload pour la recherche de courriels.
+
+    Les courriels retenus contiennent tous les mots de `query` dans leur
+    expéditeur, leur sujet ou leur corps, sans égard à la casse ni aux
+    accents. Au plus `limit` résultats sont retournés, les plus récents
+    d'abord.
+    """
+    query: str
+    limit: int
+
+
+class SearchResultPayload(TypedDict, total=True):
+    """
+    Payload pour les résultats d'une recherche.
+
+    `total` est le nombre de courriels retenus, avant la limite.
+    """
+    email_list: list[str]
+    total: int
+
+
 class EmailChoicePayload(TypedDict, total=True):
     """Payload pour le choix du courriel à consulter."""
     choice: int
 
 
 class StatsPayload(TypedDict, total=True):
-    """Payload pour les statistiques."""
+    """
+    Payload pour les statistiques.
+
+    `newest_date` est la date du courriel le plus récent, vide s'il n'y a
+    aucun courriel.
+    """
     count: int
     size: int
+    newest_date: str
 
 
 class GloMessage(TypedDict, total=False):
@@ -98,13 +257,28 @@ class GloMessage(TypedDict, total=False):
 
     Les classes *Payload correspondent à des entêtes spécifiques
     certaines entêtes n'ont pas besoin de payload.
+
+    Une requête peut porter un `request_id` entier, repris tel quel dans
+    sa réponse; le client peut alors envoyer d'autres requêtes sans
+    attendre cette réponse.
     """
     header: Headers
-    payload: Union[ErrorPayload, AuthPayload, EmailContentPayload,
-                   EmailListPayload, EmailChoicePayload, StatsPayload]
+    request_id: int
+    payload: Union[ErrorPayload, AuthPayload, SessionPayload,
+                   EmailContentPayload, EmailChunkPayload,
+                   EmailListPayload, EmailChoicePayload, StatsPayload,
+                   InboxPageRequestPayload, InboxPagePayload,
+                   EmailBatchPayload, EmailBatchResultPayload,
+                   HelloPayload, SearchPayload, SearchResultPayload]
 
 
 def get_current_utc_time() -> str:
     """Récupère l'heure courante au fuseau UTC et la formatte en string."""
     current_time = datetime.datetime.now(datetime.timezone.utc)
-    return current_time.strftime("%a, %d %b %Y %H:%M:%S %z")
+    return format_utc_time(current_time)
+
+
+def format_utc_time(moment: datetime.datetime) -> str:
+    """Formatte un instant au fuseau UTC, comme `get_current_utc_time`."""
+    return moment.astimezone(datetime.timezone.utc).strftime(
+        "%a, %d %b %Y %H:%M:%S %z")
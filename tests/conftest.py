@@ -0,0 +1,8 @@
+"""\
+Configuration commune des tests: les modules du serveur sont à la racine
+du dépôt, sans paquet.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,68 @@
+"""Tests des encodages des messages."""
+import json
+
+import pytest
+
+import glocodec
+import gloutils
+
+CODECS = [glocodec.JSON, glocodec.BINARY]
+
+
+@pytest.mark.parametrize("codec", CODECS, ids=lambda codec: codec.name)
+@pytest.mark.parametrize("label", sorted(glocodec._sample_messages()))
+def test_round_trip_samples(codec, label) -> None:
+    message = glocodec._sample_messages()[label]
+    assert codec.decode(codec.encode(message)) \
+        == json.loads(json.dumps(message))
+
+
+@pytest.mark.parametrize("codec", CODECS, ids=lambda codec: codec.name)
+def test_round_trip_values(codec) -> None:
+    message = gloutils.GloMessage(
+        header=gloutils.Headers.OK, request_id=-7,
+        payload={"email_list": [], "results": [{"email": 0, "status": None},
+                                               [True, False, ["a", ""]]],
+                 "champ inconnu": "é\0", "total": 2**40, "content": [""]})
+    assert codec.decode(codec.encode(message)) == message
+
+
+def test_binary_is_negotiated_by_name() -> None:
+    assert glocodec.negotiate(["inconnu", glocodec.BINARY.name,
+                               glocodec.ENCODING_JSON]) is glocodec.BINARY
+    assert glocodec.negotiate(["inconnu"]) is glocodec.JSON
+    assert glocodec.negotiate([]) is glocodec.JSON
+
+
+@pytest.mark.parametrize("data", [
+    b"", b"[1, 2]", b"5", b"null", b"{", b"\xff\xfe",
+])
+def test_json_rejects_malformed(data) -> None:
+    with pytest.raises(ValueError):
+        glocodec.JSON.decode(data)
+
+
+def test_binary_rejects_truncated() -> None:
+    data = glocodec.BINARY.encode(glocodec._sample_messages()["EMAIL_SENDING"])
+    for end in range(len(data)):
+        try:
+            glocodec.BINARY.decode(data[:end])
+        except ValueError:
+            continue
+        # a bare header is a message without payload
+        assert end == 1
+
+
+@pytest.mark.parametrize("data", [
+    b"\x81\x00",
+    b"\x01z",
+    b"\x01S\x00\x00\x00\x05ab",
+    b"\x01s\x00\x00\x00\x01\xff",
+    b"\x01d\x00\x00\x00\x01\xf0n",
+    b"\x01nn",
+    b"\x01" + b"l\x00\x00\x00\x01" * 100000 + b"n",
+], ids=["request-id-missing", "unknown-tag", "string-too-long",
+        "invalid-utf8", "unknown-field", "trailing-bytes", "nested-too-deeply"])
+def test_binary_rejects_malformed(data) -> None:
+    with pytest.raises(ValueError):
+        glocodec.BINARY.decode(data)
@@ -0,0 +1,102 @@
+"""Tests de l'index persistant des boîtes de réception."""
+import os
+from typing import List
+
+import gloindex
+from gloindex import IndexRecord
+
+
+def _record(order: int, size: int = 10) -> IndexRecord:
+    return IndexRecord(order, f"mail{order}", "alice", f"sujet {order}",
+                       "date", size)
+
+
+class _Inbox:
+    """Boîte factice: un dossier source et les enregistrements de `scan`."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.contents: List[IndexRecord] = []
+        self.scans = 0
+        os.makedirs(path + "/source")
+
+    def scan(self) -> List[IndexRecord]:
+        self.scans += 1
+        return list(self.contents)
+
+    def index(self) -> gloindex.InboxIndex:
+        return gloindex.InboxIndex(self.path, self.path + "/index",
+                                   self.path + "/source", self.scan)
+
+
+def test_missing_index_is_rebuilt(tmp_path) -> None:
+    inbox = _Inbox(str(tmp_path))
+    inbox.contents = [_record(3, 5), _record(1, 7)]
+    index = inbox.index()
+    assert index.refresh() == [_record(1, 7), _record(3, 5)]
+    assert index.total_size == 12
+    assert index.get("mail3") == _record(3, 5)
+    assert inbox.scans == 1
+    index.refresh()
+    assert inbox.scans == 1
+
+
+def test_appends_are_read_by_other_instances(tmp_path) -> None:
+    inbox = _Inbox(str(tmp_path))
+    writer, reader = inbox.index(), inbox.index()
+    writer.refresh()
+    reader.refresh()
+    version = reader.version
+    writer.extend([_record(5), _record(2)])
+    writer.append(_record(5))
+    assert reader.refresh() == [_record(2), _record(5)]
+    assert reader.version > version
+    assert reader.total_size == 20
+
+
+def test_partial_line_waits_for_its_end(tmp_path) -> None:
+    inbox = _Inbox(str(tmp_path))
+    index = inbox.index()
+    index.refresh()
+    line = gloindex._encode(_record(1))
+    with open(index._index_path, "ab") as file:
+        file.write(line[:5])
+    assert index.refresh() == []
+    with open(index._index_path, "ab") as file:
+        file.write(line[5:])
+    assert index.refresh() == [_record(1)]
+
+
+def test_rebuild_starts_a_new_generation(tmp_path) -> None:
+    inbox = _Inbox(str(tmp_path))
+    first, second = inbox.index(), inbox.index()
+    first.refresh()
+    first.extend([_record(1), _record(2), _record(3)])
+    assert len(second.refresh()) == 3
+    # the new index is shorter: the reader must not resume at its offset
+    gloindex.write_index(first._index_path, [_record(9)])
+    assert second.refresh() == [_record(9)]
+    assert second.total_size == 10
+
+
+def test_stale_index_is_rebuilt(tmp_path) -> None:
+    inbox = _Inbox(str(tmp_path))
+    index = inbox.index()
+    index.refresh()
+    inbox.contents = [_record(4)]
+    stat = os.stat(index._index_path)
+    os.utime(inbox.path + "/source",
+             ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert index.refresh() == [_record(4)]
+    assert inbox.scans == 2
+
+
+def test_check_rebuilds_inconsistent_index(tmp_path) -> None:
+    inbox = _Inbox(str(tmp_path))
+    inbox.contents = [_record(1), _record(2)]
+    index = inbox.index()
+    assert index.check()
+    inbox.contents.append(_record(3))
+    assert not index.check()
+    assert index.refresh() == inbox.contents
+    assert index.check()
@@ -0,0 +1,101 @@
+"""Tests des seaux à jetons de la limitation du débit."""
+import time
+
+import pytest
+
+import glolimit
+
+
+class _Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> _Clock:
+    clock = _Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    return clock
+
+
+def test_bucket_refills_up_to_its_burst() -> None:
+    bucket = glolimit.TokenBucket(rate=2, burst=3, now=0)
+    for _ in range(3):
+        assert bucket.delay(0) == 0
+        bucket.take()
+    assert bucket.delay(0) == pytest.approx(0.5)
+    assert bucket.delay(0.25) == pytest.approx(0.25)
+    assert bucket.delay(100) == 0
+    assert bucket.tokens == 3
+
+
+@pytest.mark.parametrize("spec, expected", [
+    ("EMAIL_SENDING=20/50", ("EMAIL_SENDING", 20, 50)),
+    ("EMAIL_SENDING=0.5", ("EMAIL_SENDING", 0.5, 1)),
+    ("*=10", ("*", 10, 10)),
+    ("STATS_REQUEST=0", ("STATS_REQUEST", 0, 1)),
+])
+def test_parse_limit(spec, expected) -> None:
+    assert glolimit.parse_limit(spec) == expected
+
+
+@pytest.mark.parametrize("spec", [
+    "INCONNUE=1", "EMAIL_SENDING=x", "EMAIL_SENDING=-1", "EMAIL_SENDING=5/0",
+    "EMAIL_SENDING",
+])
+def test_parse_limit_rejects(spec) -> None:
+    with pytest.raises(ValueError):
+        glolimit.parse_limit(spec)
+
+
+def test_limits_override_and_remove() -> None:
+    table = glolimit.limits(glolimit.CONNECTION_LIMITS,
+                            ["EMAIL_SENDING=1/2", "EMAIL_BATCH_SENDING=0"])
+    assert table["EMAIL_SENDING"] == (1, 2)
+    assert "EMAIL_BATCH_SENDING" not in table
+    assert "EMAIL_BATCH_SENDING" in glolimit.CONNECTION_LIMITS
+
+
+def test_connection_bucket(clock) -> None:
+    limiter = glolimit.RateLimiter({"STATS_REQUEST": (1, 2)}, {})
+    assert limiter.delay("a", None, "STATS_REQUEST") == 0
+    assert limiter.delay("a", None, "STATS_REQUEST") == 0
+    assert limiter.delay("a", None, "STATS_REQUEST") == pytest.approx(1)
+    # other connections and unlimited headers are not affected
+    assert limiter.delay("b", None, "STATS_REQUEST") == 0
+    assert limiter.delay("a", None, "SEARCH_REQUEST") == 0
+    clock.now += 1
+    assert limiter.delay("a", None, "STATS_REQUEST") == 0
+    assert limiter.stats() == {"admitted": 5, "throttled": 1}
+
+
+def test_user_bucket_is_shared(clock) -> None:
+    limiter = glolimit.RateLimiter({"*": (10, 10)},
+                                   {"EMAIL_SENDING": (1, 2)})
+    assert limiter.delay("a", "alice", "EMAIL_SENDING") == 0
+    assert limiter.delay("b", "alice", "EMAIL_SENDING") == 0
+    assert limiter.delay("c", "alice", "EMAIL_SENDING") > 0
+    assert limiter.delay("c", "bob", "EMAIL_SENDING") == 0
+    # a refused request consumes no token of its connection
+    assert limiter._connections["c"]["EMAIL_SENDING"].tokens == 9
+
+
+def test_forget_connection(clock) -> None:
+    limiter = glolimit.RateLimiter({"STATS_REQUEST": (1, 1)}, {})
+    limiter.delay("a", None, "STATS_REQUEST")
+    assert limiter.delay("a", None, "STATS_REQUEST") > 0
+    limiter.forget("a")
+    assert limiter.delay("a", None, "STATS_REQUEST") == 0
+
+
+def test_full_user_buckets_are_pruned(clock, monkeypatch) -> None:
+    monkeypatch.setattr(glolimit, "_MAX_IDLE_USERS", 3)
+    limiter = glolimit.RateLimiter({}, {"EMAIL_SENDING": (1, 1)})
+    for username in ("a", "b", "c"):
+        limiter.delay("x", username, "EMAIL_SENDING")
+    clock.now += 10
+    limiter.delay("x", "d", "EMAIL_SENDING")
+    assert set(limiter._users) == {"d"}
@@ -0,0 +1,63 @@
+"""Tests du redépôt des courriels perdus."""
+import concurrent.futures
+from typing import Dict, List
+
+import pytest
+
+import glolost
+import gloutils
+
+
+def _email(recipient: str) -> gloutils.EmailContentPayload:
+    return gloutils.EmailContentPayload(
+        sender="alice@glo2000.ca", destination=recipient + "@glo2000.ca",
+        subject="sujet", date="date", content="corps")
+
+
+class _Store:
+    """Magasin où tous les utilisateurs existent."""
+
+    def exists(self, username: str) -> bool:
+        return True
+
+
+class _Deliver:
+    """Dépôt qui échoue pour « alice » et retient les autres courriels."""
+
+    def __init__(self) -> None:
+        self.delivered: Dict[str, List[gloutils.EmailContentPayload]] = {}
+
+    def __call__(self, emails) -> concurrent.futures.Future:
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        if "alice" in emails:
+            future.set_exception(RuntimeError("inattendue"))
+        else:
+            self.delivered.update(emails)
+            future.set_result(None)
+        return future
+
+
+@pytest.fixture
+def lost(tmp_path, monkeypatch) -> glolost.LostMail:
+    monkeypatch.chdir(tmp_path)
+    lost = glolost.LostMail(_Store())
+    for recipient in ("alice", "bob"):
+        lost.write(recipient, _email(recipient))
+    return lost
+
+
+def test_sweep_continues_after_a_failed_recipient(lost) -> None:
+    deliver = _Deliver()
+    lost.sweep(deliver)
+    assert list(deliver.delivered) == ["bob"]
+    assert lost.redelivered == 1
+
+
+def test_thread_survives_a_failed_redelivery(lost) -> None:
+    deliver = _Deliver()
+    lost.release("alice")
+    lost.release("bob")
+    lost.start(deliver, interval=3600)
+    lost.close()
+    assert list(deliver.delivered) == ["bob"]
+    assert lost._thread is not None and not lost._thread.is_alive()
@@ -0,0 +1,164 @@
+"""Tests de l'index de recherche plein texte."""
+import contextlib
+from typing import Dict, Iterator, List, Tuple
+
+import gloindex
+import glosearch
+import gloutils
+
+
+def _email(subject: str, content: str = "") -> gloutils.EmailContentPayload:
+    return gloutils.EmailContentPayload(
+        sender="alice@glo2000.ca", destination="bob@glo2000.ca",
+        subject=subject, date="date", content=content)
+
+
+class _Inbox:
+    """Boîte factice: ses courriels et leurs enregistrements d'index."""
+
+    def __init__(self) -> None:
+        self.emails: Dict[str, gloutils.EmailContentPayload] = {}
+        self.streamed: List[str] = []
+
+    def add(self, name: str, payload: gloutils.EmailContentPayload) -> None:
+        self.emails[name] = payload
+
+    @property
+    def records(self) -> List[gloindex.IndexRecord]:
+        return [gloindex.IndexRecord(number, name, "", "", "", 0)
+                for number, name in enumerate(self.emails)]
+
+    def refresh(self) -> List[gloindex.IndexRecord]:
+        return self.records
+
+    def copy(self) -> "_Inbox":
+        return self
+
+    def updating(self, exclusive: bool = False
+                 ) -> contextlib.AbstractContextManager:
+        return contextlib.nullcontext()
+
+    def stream(self, name: str
+               ) -> Tuple[gloutils.EmailContentPayload, Iterator[str]]:
+        self.streamed.append(name)
+        payload = self.emails[name]
+        content = payload["content"]
+        return payload, iter([content[:3], content[3:]])
+
+    def index(self, path: str) -> glosearch.SearchIndex:
+        return glosearch.SearchIndex(self, path, self.stream)
+
+
+def test_terms_are_folded() -> None:
+    assert glosearch.terms("Été, RÉUNION à 10h!") == {"ete", "reunion", "a",
+                                                     "10h"}
+    assert glosearch.terms("x" * 65) == set()
+
+
+def test_body_terms_keep_words_cut_between_chunks() -> None:
+    found = glosearch.body_terms(_email("Sujet"), ["bonj", "our le mon", "de"])
+    assert {"bonjour", "le", "monde", "sujet", "alice"} <= found
+    assert "bonj" not in found and "mon" not in found
+
+
+def test_search_intersects_terms(tmp_path) -> None:
+    inbox = _Inbox()
+    index = inbox.index(str(tmp_path / "search"))
+    index.create()
+    emails = [("0", _email("Réunion lundi", "ordre du jour")),
+              ("1", _email("Réunion mardi", "budget")),
+              ("2", _email("Vacances", "budget de l'été"))]
+    for name, payload in emails:
+        inbox.add(name, payload)
+    index.append(emails[:2])
+    index.append(emails[2:])
+    assert index.search("reunion") == {"0", "1"}
+    assert index.search("BUDGET réunion") == {"1"}
+    assert index.search("budget ete") == {"2"}
+    assert index.search("absent budget") == set()
+    assert index.search("!!") == set()
+    assert inbox.streamed == []
+
+
+def test_missing_emails_are_indexed(tmp_path) -> None:
+    inbox = _Inbox()
+    inbox.add("0", _email("Ancien", "déposé avant l'index"))
+    index = inbox.index(str(tmp_path / "search"))
+    assert index.search("depose") == {"0"}
+    inbox.add("1", _email("Nouveau", "déposé ensuite"))
+    assert index.search("depose") == {"0", "1"}
+    assert inbox.streamed == ["0", "1"]
+
+
+def test_catch_up_leaves_the_instance_unchanged(tmp_path) -> None:
+    inbox = _Inbox()
+    inbox.add("0", _email("Ancien", "déposé avant l'index"))
+    index = inbox.index(str(tmp_path / "search"))
+    assert index.outdated()
+    index.catch_up()
+    assert inbox.streamed == ["0"]
+    assert not index._names
+    assert not index.outdated()
+    assert index.search("depose") == {"0"}
+    assert inbox.streamed == ["0"]
+
+
+def test_merged_blocks_keep_results(tmp_path) -> None:
+    inbox = _Inbox()
+    path = str(tmp_path / "search")
+    index = inbox.index(path)
+    index.create()
+    reader = inbox.index(path)
+    reader.refresh()
+    for number in range(3 * glosearch._MAX_BLOCKS):
+        name = str(number)
+        payload = _email(f"pair{number % 2} commun", f"numéro{number}")
+        inbox.add(name, payload)
+        index.append([(name, payload)])
+        if number % 10 == 0:
+            # an email indexed twice keeps a single name after a merge
+            index.append([(name, payload)])
+    everyone = {str(number) for number in range(3 * glosearch._MAX_BLOCKS)}
+    assert index.search("commun") == everyone
+    assert len(index._blocks) <= glosearch._MAX_BLOCKS
+    assert index.search("pair0") == {name for name in everyone
+                                     if int(name) % 2 == 0}
+    assert index.search("numero10 commun") == {"10"}
+    # instances that read the previous generation read the new one
+    assert reader.search("pair1") == {name for name in everyone
+                                      if int(name) % 2 == 1}
+    assert inbox.index(path).search("commun") == everyone
+    assert inbox.streamed == []
+
+
+def test_large_gaps_between_ids(tmp_path) -> None:
+    inbox = _Inbox()
+    index = inbox.index(str(tmp_path / "search"))
+    names = [str(number) for number in range(70001)]
+    ids = [0, 255, 256, 300, 65835, 70000]
+    index._write([glosearch._encode_block(names, {"rare": ids})])
+    index._sync()
+    assert list(index._ids("rare")) == ids
+
+
+def test_terms_longer_than_255_bytes(tmp_path) -> None:
+    word = "\U00020000" * 64
+    assert glosearch.terms(word + " court") == {"court"}
+    block = glosearch._encode_block(["0"], {word: [0], "court": [0]})
+    index = _Inbox().index(str(tmp_path / "search"))
+    index._write([block])
+    index._sync()
+    assert list(index._ids("court")) == [0]
+
+
+def test_search_after_a_long_word(tmp_path) -> None:
+    inbox = _Inbox()
+    index = inbox.index(str(tmp_path / "search"))
+    index.create()
+    emails = [("0", _email("Sujet", "\U00020000" * 64 + " mot")),
+              ("1", _email("Autre", "mot"))]
+    for name, payload in emails:
+        inbox.add(name, payload)
+        index.append([(name, payload)])
+    assert index.search("mot") == {"0", "1"}
+    assert index.search("autre") == {"1"}
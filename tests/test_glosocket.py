@@ -0,0 +1,106 @@
+"""Tests du décodage incrémental des messages de glosocket."""
+import socket
+import struct
+import zlib
+from typing import Optional
+
+import pytest
+
+import glosocket
+
+
+def _frames(*messages: bytes, threshold: Optional[int] = None) -> bytes:
+    writer = glosocket.FrameWriter()
+    for message in messages:
+        writer.write(message, threshold)
+    left, right = socket.socketpair()
+    with left, right:
+        writer.flush(left)
+        left.shutdown(socket.SHUT_WR)
+        return b"".join(iter(lambda: right.recv(65536), b""))
+
+
+def test_feed_byte_by_byte() -> None:
+    data = _frames(b"hello", b"", b"world" * 100)
+    reader = glosocket.FrameReader()
+    frames = []
+    for i in range(len(data)):
+        frames.extend(reader.feed(data[i:i + 1]))
+    assert frames == [b"hello", b"", b"world" * 100]
+
+
+def test_feed_split_header_and_body() -> None:
+    data = _frames(b"first", b"second")
+    reader = glosocket.FrameReader()
+    assert reader.feed(data[:2]) == []
+    assert reader.feed(data[2:7]) == []
+    assert reader.feed(data[7:]) == [b"first", b"second"]
+
+
+def test_recv_from_large_body_in_pieces() -> None:
+    body = bytes(range(256)) * (3 * glosocket.SCRATCH_SIZE // 256)
+    data = _frames(body, b"tail")
+    reader = glosocket.FrameReader()
+    left, right = socket.socketpair()
+    with left, right:
+        right.setblocking(False)
+        frames = []
+        for start in range(0, len(data), 10000):
+            left.sendall(data[start:start + 10000])
+            while True:
+                received = reader.recv_from(right)
+                if not received:
+                    break
+                frames.extend(received)
+    assert frames == [body, b"tail"]
+
+
+def test_recv_from_closed_socket() -> None:
+    reader = glosocket.FrameReader()
+    left, right = socket.socketpair()
+    with right:
+        left.close()
+        with pytest.raises(glosocket.GLOSocketError):
+            reader.recv_from(right)
+
+
+def test_frame_over_limit() -> None:
+    reader = glosocket.FrameReader(max_frame_size=16)
+    with pytest.raises(glosocket.GLOSocketError):
+        reader.feed(_frames(b"x" * 17))
+
+
+def test_compressed_frames_in_pieces() -> None:
+    messages = [b"a" * 100000, b"court", bytes(range(256)) * 4]
+    data = _frames(*messages, threshold=16)
+    # the repetitive message is compressed, the short one is not
+    assert len(data) < 100000
+    reader = glosocket.FrameReader()
+    frames = []
+    for start in range(0, len(data), 7):
+        frames.extend(reader.feed(data[start:start + 7]))
+    assert frames == messages
+
+
+def test_compressed_frame_over_limit() -> None:
+    data = _frames(b"a" * 1000, threshold=16)
+    assert len(data) < 100
+    reader = glosocket.FrameReader(max_frame_size=999)
+    with pytest.raises(glosocket.GLOSocketError):
+        reader.feed(data)
+
+
+def test_invalid_compressed_frame() -> None:
+    body = zlib.compress(b"message") + b"superflu"
+    reader = glosocket.FrameReader()
+    with pytest.raises(glosocket.GLOSocketError):
+        reader.feed(struct.pack("!I", len(body) | 0x80000000) + body)
+    with pytest.raises(glosocket.GLOSocketError):
+        glosocket.FrameReader().feed(struct.pack("!I", 0x80000004) + b"abcd")
+
+
+def test_recv_frame_decompresses() -> None:
+    left, right = socket.socketpair()
+    with left, right:
+        glosocket.send_mesg(left, "é" * 5000, glosocket.COMPRESS_THRESHOLD)
+        assert glosocket.recv_mesg(right) == "é" * 5000
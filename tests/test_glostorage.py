@@ -0,0 +1,93 @@
+"""Tests du stockage des courriels par segments."""
+import os
+
+import pytest
+
+import glostorage
+import glousers
+import gloutils
+
+
+def _email(number: int, content: str = "") -> gloutils.EmailContentPayload:
+    return gloutils.EmailContentPayload(
+        sender="alice@glo2000.ca", destination="bob@glo2000.ca",
+        subject=f"sujet {number}", date="date",
+        content=content or f"corps {number}\nsur deux lignes")
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch) -> glostorage.SegmentBackend:
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(glousers.user_dir("bob"))
+    backend = glostorage.SegmentBackend(max_segment_size=300)
+    backend.create_mailbox("bob")
+    return backend
+
+
+def test_deliver_then_read(backend) -> None:
+    names, paths = backend.deliver("bob", [_email(0), _email(1)])
+    more, _ = backend.deliver("bob", [_email(2, "x" * 500), _email(3)])
+    assert names + more == ["0", "1", "2", "3"]
+    assert paths[-1] == backend._dir("bob")
+    # small segments: each overflowing email starts a new one
+    assert len(backend._segments("bob")) > 1
+    for number in range(4):
+        email = backend.read("bob", str(number))
+        assert email["subject"] == f"sujet {number}"
+        assert email["content"] == _email(number, "x" * 500 if number == 2
+                                          else "")["content"]
+    records = backend.mailbox("bob").refresh()
+    assert [record.name for record in records] == ["0", "1", "2", "3"]
+
+
+def test_stream_matches_read(backend) -> None:
+    backend.deliver("bob", [_email(0, "é" * 40000)])
+    payload, chunks = backend.stream("bob", "0")
+    assert payload["subject"] == "sujet 0"
+    assert "".join(chunks) == backend.read("bob", "0")["content"]
+
+
+def test_partial_offset_entry_is_dropped(backend) -> None:
+    backend.deliver("bob", [_email(0)])
+    with open(backend._offsets_path("bob"), "ab") as file:
+        file.write(b"\0" * 5)
+    names, _ = backend.deliver("bob", [_email(1)])
+    assert names == ["1"]
+    assert backend.read("bob", "1")["subject"] == "sujet 1"
+
+
+def test_compact_removes_orphan_bytes(backend) -> None:
+    backend.deliver("bob", [_email(0), _email(1)])
+    last = backend._segments("bob")[-1]
+    with open(backend._segment_path("bob", last), "ab") as file:
+        file.write(b"orphelin" * 10)
+    before = backend._segments("bob")
+    assert backend.compact("bob")
+    assert not set(before) & set(backend._segments("bob"))
+    assert [backend.read("bob", name)["subject"] for name in ("0", "1")] \
+        == ["sujet 0", "sujet 1"]
+    assert not backend.compact("bob")
+    names, _ = backend.deliver("bob", [_email(2)])
+    assert names == ["2"]
+    assert backend.read("bob", "2")["subject"] == "sujet 2"
+
+
+def test_migrate_from_files(tmp_path, monkeypatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(glousers.user_dir("bob"))
+    files = glostorage.FileBackend()
+    files.create_mailbox("bob")
+    for number in range(5):
+        names, _ = files.deliver("bob", [_email(number)])
+        path = files._inbox("bob") + "/" + names[0]
+        os.utime(path, ns=(number * 10**9, number * 10**9))
+    segments = glostorage.SegmentBackend(max_segment_size=300)
+    assert segments.migrate("bob") == 5
+    assert not os.path.exists(files._inbox("bob"))
+    assert [segments.read("bob", str(number))["subject"]
+            for number in range(5)] == [f"sujet {number}" for number in range(5)]
+    records = segments.mailbox("bob").refresh()
+    assert [record.subject for record in records] \
+        == [f"sujet {number}" for number in range(5)]
+    # already migrated
+    assert segments.migrate("bob") == 0
@@ -0,0 +1,89 @@
+"""Tests du tas d'échéances."""
+import random
+
+import glotimer
+
+
+def test_expired_in_order() -> None:
+    deadlines = glotimer.Deadlines()
+    deadlines.set("b", 2)
+    deadlines.set("a", 1)
+    deadlines.set("c", 3)
+    assert deadlines.next() == 1
+    assert deadlines.expired(0.5) == []
+    assert deadlines.expired(2) == ["a", "b"]
+    assert "a" not in deadlines and "c" in deadlines
+    assert len(deadlines) == 1
+
+
+def test_postponed_deadline() -> None:
+    deadlines = glotimer.Deadlines()
+    deadlines.set("a", 1)
+    for step in range(100):
+        deadlines.set("a", 2 + step)
+    # postponing only replaces the value
+    assert len(deadlines._heap) == 1
+    assert deadlines.expired(50) == []
+    assert deadlines.next() == 101
+    assert deadlines.expired(101) == ["a"]
+
+
+def test_advanced_deadline() -> None:
+    deadlines = glotimer.Deadlines()
+    deadlines.set("a", 10)
+    deadlines.set("a", 1)
+    assert deadlines.expired(1) == ["a"]
+    assert deadlines.expired(10) == []
+
+
+def test_discard() -> None:
+    deadlines = glotimer.Deadlines()
+    deadlines.set("a", 1)
+    deadlines.discard("a")
+    deadlines.discard("inconnue")
+    assert "a" not in deadlines
+    assert deadlines.expired(5) == []
+    # set again after a discard, the key gets a fresh entry
+    deadlines.set("a", 10)
+    assert deadlines.expired(9) == []
+    assert deadlines.expired(10) == ["a"]
+
+
+def test_discarded_entries_do_not_accumulate() -> None:
+    deadlines = glotimer.Deadlines()
+    deadlines.set("vivante", 1e9)
+    for key in range(10000):
+        deadlines.set(key, 1e9)
+        deadlines.discard(key)
+    assert len(deadlines) == 1
+    assert len(deadlines._heap) <= max(glotimer._REBUILD_MIN, 2)
+    assert deadlines.next() == 1e9
+
+
+def test_matches_a_dictionary() -> None:
+    rng = random.Random(2000)
+    deadlines = glotimer.Deadlines()
+    expected = {}
+    now = 0.0
+    for _ in range(20000):
+        key = rng.randrange(200)
+        action = rng.random()
+        if action < 0.45:
+            deadline = now + rng.random() * 10
+            deadlines.set(key, deadline)
+            expected[key] = deadline
+        elif action < 0.7:
+            deadlines.discard(key)
+            expected.pop(key, None)
+        else:
+            now += rng.random()
+            due = sorted(key for key, deadline in expected.items()
+                         if deadline <= now)
+            assert sorted(deadlines.expired(now)) == due
+            for key in due:
+                del expected[key]
+        assert len(deadlines) == len(expected)
+        if expected:
+            assert deadlines.next() <= min(expected.values())
+        assert len(deadlines._heap) <= max(glotimer._REBUILD_MIN,
+                                           2 * len(expected) + 1)
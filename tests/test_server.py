@@ -0,0 +1,302 @@
+"""\
+Tests des requêtes mal formées: chacune reçoit une réponse ERROR, ou ferme
+la connexion, sans arrêter le serveur ni affecter les autres requêtes.
+"""
+import asyncio
+import contextlib
+import json
+import os
+import socket
+import threading
+from typing import Callable, Iterator
+
+import pytest
+
+import gloauth
+import gloindex
+import glosearch
+import glosocket
+import glostorage
+import glousers
+import gloutils
+import TP4_server
+
+H = gloutils.Headers
+PASSWORD = "MotDePasse123"
+EMAIL = {"sender": "badu@glo2000.ca", "destination": "badu@glo2000.ca",
+         "subject": "sujet", "date": "date", "content": "corps"}
+
+
+class _Stopped(Exception):
+    pass
+
+
+def _start_select(server: TP4_server.Server) -> Callable[[], None]:
+    """Lance la boucle select dans un fil; retourne son arrêt."""
+    stopping = threading.Event()
+    select = server._selector.select
+
+    def select_until_stopped(timeout=None):
+        if stopping.is_set():
+            raise _Stopped
+        return select(0.05 if timeout is None else min(timeout, 0.05))
+
+    def run() -> None:
+        with contextlib.suppress(_Stopped):
+            server.run()
+
+    server._selector.select = select_until_stopped
+    thread = threading.Thread(target=run)
+    thread.start()
+
+    def stop() -> None:
+        stopping.set()
+        thread.join()
+    return stop
+
+
+def _start_asyncio(server: TP4_server.Server) -> Callable[[], None]:
+    """
+    Lance la boucle asyncio dans un fil; retourne son arrêt, après lequel
+    les tâches des clients sont elles aussi annulées.
+    """
+    started = threading.Event()
+    running = {}
+
+    async def serve() -> None:
+        running["loop"] = asyncio.get_running_loop()
+        running["task"] = asyncio.current_task()
+        started.set()
+        await server._run_async()
+
+    def run() -> None:
+        with contextlib.suppress(asyncio.CancelledError):
+            asyncio.run(serve())
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    started.wait()
+
+    def stop() -> None:
+        running["loop"].call_soon_threadsafe(running["task"].cancel)
+        thread.join()
+    return stop
+
+
+@pytest.fixture(params=["select", "asyncio"])
+def port(request, tmp_path, monkeypatch) -> Iterator[int]:
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(gloutils, "APP_PORT", 0)
+    server = TP4_server.Server(auth_workers=1, connection_limits={},
+                               user_limits={})
+    start = _start_select if request.param == "select" else _start_asyncio
+    stop = start(server)
+    try:
+        yield server._server_socket.getsockname()[1]
+    finally:
+        stop()
+        server.cleanup()
+
+
+class _Client:
+    """Client envoyant des messages JSON quelconques."""
+
+    def __init__(self, port: int) -> None:
+        self.socket = socket.create_connection(("127.0.0.1", port))
+        self.socket.settimeout(10)
+
+    def send(self, message: object) -> None:
+        glosocket.send_mesg(self.socket, json.dumps(message))
+
+    def call(self, message: object) -> dict:
+        self.send(message)
+        return json.loads(glosocket.recv_mesg(self.socket))
+
+    def alive(self) -> bool:
+        reply = self.call({"header": H.HELLO, "payload": {"encodings": []}})
+        return reply["header"] == H.OK
+
+
+@pytest.fixture
+def client(port) -> Iterator[_Client]:
+    client = _Client(port)
+    reply = client.call({"header": H.AUTH_REGISTER,
+                         "payload": {"username": "badu", "password": PASSWORD}})
+    assert reply["header"] == H.OK
+    yield client
+    client.socket.close()
+
+
+@pytest.mark.parametrize("message", [
+    {"header": H.STATS_REQUEST},
+    {"header": H.INBOX_PAGE_REQUEST, "payload": {}},
+    {"header": H.SEARCH_REQUEST, "payload": {"query": "sujet"}},
+    {"header": H.INBOX_READING_CHOICE, "payload": {"choice": 1}},
+], ids=["stats", "page", "search", "choice"])
+def test_unauthenticated(port, message) -> None:
+    client = _Client(port)
+    with client.socket:
+        assert client.call(message)["header"] == H.ERROR
+        assert client.alive()
+
+
+@pytest.mark.parametrize("message", [
+    {"payload": 1},
+    {"header": H.HELLO, "payload": None},
+    {"header": H.INBOX_PAGE_REQUEST, "payload": None},
+    {"header": H.INBOX_PAGE_REQUEST, "payload": [1]},
+    {"header": H.INBOX_PAGE_REQUEST, "payload": {"cursor": "!!"}},
+    {"header": H.INBOX_READING_CHOICE, "payload": {"choice": "abc"}},
+    {"header": H.EMAIL_STREAM_REQUEST, "payload": {"choice": 999}},
+    {"header": H.EMAIL_SENDING, "payload": None},
+    {"header": H.EMAIL_SENDING, "payload": dict(EMAIL, subject=None)},
+    {"header": H.EMAIL_SENDING, "payload": dict(EMAIL, content=5)},
+    {"header": H.EMAIL_BATCH_SENDING, "payload": None},
+    {"header": H.EMAIL_BATCH_SENDING, "payload": {"emails": 5}},
+    {"header": H.EMAIL_BATCH_SENDING, "payload": {"emails": [EMAIL, {}]}},
+    {"header": H.SEARCH_REQUEST, "payload": 5},
+    {"header": H.SEARCH_REQUEST, "payload": {"limit": "x"}},
+    {"header": H.AUTH_RESUME, "payload": {"token": 5}},
+    {"header": H.AUTH_LOGIN, "payload": {"username": 5, "password": "x"}},
+    {"header": H.EMAIL_STREAM_END},
+], ids=lambda message: json.dumps(message)[:60])
+def test_malformed_request(client, message) -> None:
+    assert client.call(message)["header"] == H.ERROR
+    assert client.alive()
+    assert client.call({"header": H.STATS_REQUEST})["header"] == H.OK
+
+
+def test_valid_requests_still_work(client) -> None:
+    assert client.call({"header": H.EMAIL_SENDING,
+                        "payload": EMAIL})["header"] == H.OK
+    reply = client.call({"header": H.STATS_REQUEST})
+    assert reply["payload"]["count"] == 1
+
+
+def test_invalid_chunk_fails_the_upload(client) -> None:
+    header = {key: value for key, value in EMAIL.items() if key != "content"}
+    client.send({"header": H.EMAIL_STREAM_BEGIN, "payload": header})
+    client.send({"header": H.EMAIL_STREAM_CHUNK, "payload": {"data": 5}})
+    client.send({"header": H.EMAIL_STREAM_CHUNK, "payload": {"data": "x"}})
+    assert client.call({"header": H.EMAIL_STREAM_END})["header"] == H.ERROR
+    client.send({"header": H.EMAIL_STREAM_BEGIN, "payload": header})
+    client.send({"header": H.EMAIL_STREAM_CHUNK, "payload": {"data": "x"}})
+    assert client.call({"header": H.EMAIL_STREAM_END})["header"] == H.OK
+
+
+def test_corrupt_password_file(client, port) -> None:
+    path = glousers.user_dir("badu") + "/" + gloutils.PASSWORD_FILENAME
+    with open(path, "w") as file:
+        file.write("scrypt$x$1$1$zz$zz")
+    other = _Client(port)
+    with other.socket:
+        reply = other.call({"header": H.AUTH_LOGIN, "payload": {
+            "username": "badu", "password": PASSWORD}})
+        assert reply["header"] == H.ERROR
+        assert other.alive()
+
+
+@pytest.mark.parametrize("payload", [
+    {"username": "badu", "password": 5},
+    {"username": "badu", "password": None},
+    {"username": "badu"},
+], ids=["int", "null", "missing"])
+def test_login_password_not_a_string(client, port, payload) -> None:
+    other = _Client(port)
+    with other.socket:
+        reply = other.call({"header": H.AUTH_LOGIN, "payload": payload})
+        assert reply["header"] == H.ERROR
+        reply = other.call({"header": H.AUTH_REGISTER, "payload": dict(
+            payload, username="autre")})
+        assert reply["header"] == H.ERROR
+        assert other.alive()
+    assert client.call({"header": H.STATS_REQUEST})["header"] == H.OK
+
+
+def test_failed_continuation(client, port, monkeypatch) -> None:
+    def fail(*_):
+        raise RuntimeError("inattendue")
+    monkeypatch.setattr(gloauth, "check_password", fail)
+    other = _Client(port)
+    with other.socket:
+        for request_id in (None, 7):
+            message = {"header": H.AUTH_LOGIN, "payload": {
+                "username": "badu", "password": PASSWORD}}
+            if request_id is not None:
+                message["request_id"] = request_id
+            reply = other.call(message)
+            assert reply["header"] == H.ERROR
+            assert reply.get("request_id") == request_id
+        assert other.alive()
+    assert client.call({"header": H.STATS_REQUEST})["header"] == H.OK
+
+
+def _drop_index() -> None:
+    """Supprime l'index de la boîte de « badu », s'il existe."""
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(glostorage._index_path("badu"))
+
+
+@pytest.mark.parametrize("message", [
+    {"header": H.STATS_REQUEST},
+    {"header": H.INBOX_READING_REQUEST},
+    {"header": H.INBOX_PAGE_REQUEST, "payload": {}},
+    {"header": H.SEARCH_REQUEST, "payload": {"query": "corps"}},
+], ids=["stats", "list", "page", "search"])
+def test_stale_index_rebuilt_off_the_loop(client, monkeypatch, message) -> None:
+    assert client.call({"header": H.EMAIL_SENDING,
+                        "payload": EMAIL})["header"] == H.OK
+    threads = []
+    rebuild = gloindex.InboxIndex.rebuild
+
+    def record(index) -> None:
+        threads.append(threading.current_thread().name)
+        rebuild(index)
+    monkeypatch.setattr(gloindex.InboxIndex, "rebuild", record)
+    for request_id in (None, 7):
+        _drop_index()
+        if request_id is not None:
+            message = dict(message, request_id=request_id)
+        reply = client.call(message)
+        assert reply["header"] == H.OK
+        assert reply.get("request_id") == request_id
+    assert len(threads) == 2
+    assert all(name.startswith("index") for name in threads)
+    assert client.call({"header": H.STATS_REQUEST})["payload"]["count"] == 1
+
+
+def test_search_catch_up_off_the_loop(client, monkeypatch) -> None:
+    assert client.call({"header": H.EMAIL_SENDING,
+                        "payload": EMAIL})["header"] == H.OK
+    threads = []
+    body_terms = glosearch.body_terms
+
+    def record(*args):
+        threads.append(threading.current_thread().name)
+        return body_terms(*args)
+    monkeypatch.setattr(glosearch, "body_terms", record)
+    os.unlink(glostorage._search_path("badu"))
+    reply = client.call({"header": H.SEARCH_REQUEST,
+                         "payload": {"query": "corps"}})
+    assert reply["header"] == H.OK and reply["payload"]["total"] == 1
+    assert threads and all(name.startswith("index") for name in threads)
+
+
+def test_failed_rebuild(client, monkeypatch) -> None:
+    def fail(_) -> None:
+        raise OSError("disque plein")
+    monkeypatch.setattr(gloindex.InboxIndex, "rebuild", fail)
+    _drop_index()
+    assert client.call({"header": H.STATS_REQUEST})["header"] == H.ERROR
+    assert client.alive()
+
+
+@pytest.mark.parametrize("data", [b"[1, 2]", b"{", b"\xff"],
+                         ids=["array", "truncated", "not-utf8"])
+def test_undecodable_message_closes_connection(client, port, data) -> None:
+    bad = _Client(port)
+    with bad.socket:
+        glosocket.send_mesg(bad.socket, data)
+        with pytest.raises(glosocket.GLOSocketError):
+            glosocket.recv_mesg(bad.socket)
+    assert client.alive()